@@ -0,0 +1,66 @@
+# edl : common library for the energy-dashboard tool-chain
+# Copyright (C) 2019  Todd Greenwood-Geer (Enviro Software Solutions, LLC)
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+"""
+chmod.py : benchmark keeping downloaded files read only
+
+Compares sweeping the whole download directory after every url, which is
+what web.download used to do, with protecting each file once as it is
+written plus a single sweep per run.
+
+    $ python bench/chmod.py --files 10000 --urls 100
+"""
+
+import os
+import sys
+# run from a checkout, without installing edl
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from edl.resources import web
+import argparse
+import stat
+import tempfile
+import time
+
+def populate(path, count):
+    for i in range(count):
+        with open(os.path.join(path, "%06d.zip" % i), 'w') as f:
+            f.write("x")
+
+def per_url_sweep(path, urls):
+    for i in range(urls):
+        web.protect(path, ".zip")
+
+def once(path, urls):
+    web.protect(path, ".zip")
+    for i in range(urls):
+        os.chmod(os.path.join(path, "%06d.zip" % i), web.READ_ONLY)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--files", type=int, default=10000)
+    parser.add_argument("--urls", type=int, default=100)
+    args = parser.parse_args()
+    for func in [per_url_sweep, once]:
+        with tempfile.TemporaryDirectory() as path:
+            populate(path, args.files)
+            start = time.perf_counter()
+            func(path, args.urls)
+            elapsed = time.perf_counter() - start
+            for f in os.listdir(path):
+                os.chmod(os.path.join(path, f), stat.S_IWUSR | stat.S_IRUSR)
+        print("%-14s files=%d urls=%d elapsed=%.3fs" % (func.__name__, args.files, args.urls, elapsed))
@@ -0,0 +1,114 @@
+# edl : common library for the energy-dashboard tool-chain
+# Copyright (C) 2019  Todd Greenwood-Geer (Enviro Software Solutions, LLC)
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+db.py : benchmark the insert engines of db.DbMgr
+
+Builds a db of --size-mb (kept in --dir, so it is only built once), then
+inserts --files 'rows' files into a copy of it with MemDb (whole db copied
+into memory and back) and with FileDb (WAL writes to the file), the latter
+committing every file or every --batch-files files. Each run is a process
+of its own, which reports its time, peak memory and bytes written.
+
+    $ python bench/db.py --size-mb 2048 --dir /var/tmp/edl-bench
+"""
+
+import os
+import sys
+# run from a checkout, without installing edl
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from edl.resources import db
+import argparse
+import json
+import logging
+import multiprocessing
+import resource
+import shutil
+import sqlite3
+import time
+
+DDL = "CREATE TABLE IF NOT EXISTS report_data (id TEXT, opr_date TEXT, interval_num INTEGER, data_item TEXT, value REAL, PRIMARY KEY (id));"
+
+def rows(prefix, count):
+    for i in range(count):
+        yield ("%s-%012d" % (prefix, i), "2019-09-%02d" % (i % 28 + 1), i % 24 + 1, "RMD_AVG_MIL_%d" % (i % 50), i * 0.25)
+
+def build(db_file, size_mb):
+    cnx = sqlite3.connect(db_file)
+    cnx.execute(DDL)
+    batch = 0
+    while os.path.getsize(db_file) < size_mb * 1024 * 1024:
+        cnx.executemany("INSERT INTO report_data VALUES (?, ?, ?, ?, ?)", rows("base%06d" % batch, 100000))
+        cnx.commit()
+        batch += 1
+    cnx.close()
+
+def write_files(sql_dir, files, count):
+    names = []
+    for f in range(files):
+        name = "f%04d.rows" % f
+        with open(os.path.join(sql_dir, name), 'w') as fh:
+            fh.write(json.dumps({"ddl": [DDL]}) + "\n")
+            fh.write(json.dumps({"table": "report_data", "columns": ["id", "opr_date", "interval_num", "data_item", "value"], "rows": list(rows("new%04d" % f, count))}) + "\n")
+        names.append(name)
+    return names
+
+def written_bytes():
+    try:
+        with open("/proc/self/io") as f:
+            return dict(l.split(": ") for l in f.read().splitlines())["write_bytes"]
+    except (OSError, KeyError):
+        return "?"
+
+def run(engine, batch_files, sql_dir, db_dir, names):
+    logger = logging.getLogger()
+    start = time.perf_counter()
+    with db.DbMgr(logger, "bench", engine, memdb_max_bytes=float("inf")) as dbmgr:
+        router = db.ShardRouter(logger, "bench", db_dir)
+        for (idx, name) in enumerate(names):
+            db.insert_file(logger, "bench", dbmgr, router, sql_dir, name, idx)
+            if (idx + 1) % batch_files == 0:
+                dbmgr.commit()
+        dbmgr.commit()
+    elapsed = time.perf_counter() - start
+    print("%-8s batch_files=%-3d %.2fs peak_rss=%dMB write_bytes=%s" % (engine, batch_files, elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024, written_bytes()))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size-mb", type=int, default=2048)
+    parser.add_argument("--files", type=int, default=20)
+    parser.add_argument("--rows", type=int, default=5000)
+    parser.add_argument("--batch-files", type=int, default=db.BATCH_FILES)
+    parser.add_argument("--dir", default="/var/tmp/edl-bench")
+    args = parser.parse_args()
+    base = os.path.join(args.dir, "base_%dmb.db" % args.size_mb)
+    sql_dir = os.path.join(args.dir, "sql")
+    db_dir = os.path.join(args.dir, "db")
+    for d in [args.dir, sql_dir]:
+        if not os.path.exists(d):
+            os.makedirs(d)
+    if not os.path.exists(base):
+        build(base, args.size_mb)
+    names = write_files(sql_dir, args.files, args.rows)
+    for (engine, batch_files) in [("memory", args.batch_files), ("file", 1), ("file", args.batch_files)]:
+        if os.path.exists(db_dir):
+            shutil.rmtree(db_dir)
+        os.makedirs(db_dir)
+        shutil.copy(base, os.path.join(db_dir, db.gen_db_name("bench", 0)))
+        p = multiprocessing.Process(target=run, args=(engine, batch_files, sql_dir, db_dir, names))
+        p.start()
+        p.join()
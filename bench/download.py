@@ -0,0 +1,88 @@
+# edl : common library for the energy-dashboard tool-chain
+# Copyright (C) 2019  Todd Greenwood-Geer (Enviro Software Solutions, LLC)
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+"""
+download.py : benchmark web.download against a local http stub
+
+The stub answers every request after `--latency` seconds with a `--size`
+byte body, which stands in for the round trip to the upstream server.
+
+Every worker count is run twice: without the per-host rate limit, which
+shows the overhead of the download loop itself, and with the `--delay`
+between requests to a host that the feeds use (web.DOWNLOAD_DELAY), which
+bounds the throughput against a single host to 1 / delay urls per second
+whatever the number of workers. The limited runs only fetch `--limited-urls`
+urls, they take about (urls - 1) * delay seconds.
+
+    $ python bench/download.py --urls 200 --latency 0.05 --workers 1 8
+"""
+
+import os
+import sys
+# run from a checkout, without installing edl
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from edl.resources import web
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import argparse
+import logging
+import tempfile
+import threading
+import time
+
+def stub_server(latency, size):
+    body = os.urandom(size)
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            time.sleep(latency)
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        def log_message(self, *args):
+            pass
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def run(logger, server, url_count, delay, workers):
+    host = "http://127.0.0.1:%d" % server.server_address[1]
+    urls = ["%s/report/%d" % (host, i) for i in range(url_count)]
+    with tempfile.TemporaryDirectory() as path:
+        state_file = os.path.join(path, "state.txt")
+        start = time.perf_counter()
+        downloaded = list(web.download(logger, "bench", delay, urls, state_file, path, workers=workers))
+        elapsed = time.perf_counter() - start
+    assert len(downloaded) == url_count
+    return elapsed
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--urls", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--size", type=int, default=64 * 1024)
+    parser.add_argument("--delay", type=float, default=web.DOWNLOAD_DELAY)
+    parser.add_argument("--limited-urls", type=int, default=4)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 4, 8])
+    args = parser.parse_args()
+    logger = logging.getLogger(__name__)
+    server = stub_server(args.latency, args.size)
+    for workers in args.workers:
+        for (delay, url_count) in [(0, args.urls), (args.delay, args.limited_urls)]:
+            elapsed = run(logger, server, url_count, delay, workers)
+            print("workers=%-3d delay=%-4g urls=%-4d elapsed=%.2fs throughput=%.2f urls/s" % (workers, delay, url_count, elapsed, url_count / elapsed))
+    server.shutdown()
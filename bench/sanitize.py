@@ -0,0 +1,97 @@
+# edl : common library for the energy-dashboard tool-chain
+# Copyright (C) 2019  Todd Greenwood-Geer (Enviro Software Solutions, LLC)
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+sanitize.py : benchmark identifier sanitization and value quoting
+
+Compares rendering the insert statements and row batches of a document
+with the re.sub/format/encode code that ran for every row before, against
+the cached identifiers, column lists and insert prefixes, and checks that
+both render the same statements. Uses the synthetic document of walker.py.
+
+    $ python bench/sanitize.py --nodes 200000
+"""
+
+import os
+import sys
+# run from a checkout, without installing edl
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from edl.resources import xmlparser
+from walker import document
+import argparse
+import codecs
+import logging
+import re
+import time
+import uuid
+
+class UncachedTransformer(xmlparser.XML2SQLTransormer):
+    """sanitizes, joins and quotes everything for every row"""
+    def sqlite_sanitize(self, s):
+        return re.sub('[^a-zA-Z0-9_]', '', s).lower()
+
+    def row_columns(self, t, local_keys, parent_pk_keys):
+        columns = []
+        columns.extend(self.sqlite_sanitize_all(local_keys))
+        columns.extend(["%s_%s"%(self.sqlite_sanitize(t.parent), self.sqlite_sanitize(k)) for k in parent_pk_keys])
+        return tuple(columns)
+
+    def table_insert_row(self, stack):
+        row = self.row(stack)
+        if row is None:
+            return None
+        (t, local_keys, local_values, parent_pk_keys, parent_pk_values) = row
+        columns = self.row_columns(t, local_keys, parent_pk_keys)
+        values  = []
+        values.extend(self.sqlite_sanitize_values(local_keys, local_values))
+        values.extend(self.sqlite_sanitize_values(parent_pk_keys, parent_pk_values))
+        table   = self.sqlite_sanitize(t.name)
+        return (table, """INSERT OR IGNORE INTO {table} ({columns}) VALUES ({values});""".format(table=table, columns=", ".join(columns), values=", ".join(values)))
+
+    def quote_identifier(self, s, errors="strict"):
+        encodable = s.encode("utf-8", errors).decode("utf-8")
+        nul_index = encodable.find("\x00")
+        if nul_index >= 0:
+            error = UnicodeEncodeError("NUL-terminated utf-8", encodable,
+                                       nul_index, nul_index + 1, "NUL not allowed")
+            error_handler = codecs.lookup_error(errors)
+            replacement, _ = error_handler(error)
+            encodable = encodable.replace("\x00", replacement)
+        return "\"" + encodable.replace("\"", "\"\"") + "\""
+
+def run(transformer_class, nodes):
+    # the same synthetic ids for both transformers
+    ids = iter(range(10 ** 9))
+    uuid.uuid4 = lambda: "id%09d" % next(ids)
+    xst = transformer_class(logging.getLogger(), None)
+    xst.json = document(nodes)
+    xst.scan_all()
+    start = time.perf_counter()
+    sql = xst.insertion_sql()
+    rendered = time.perf_counter()
+    rows = len(xst.insertion_rows())
+    bound = time.perf_counter()
+    print("%-22s rows=%d insertion_sql=%.3fs insertion_rows=%.3fs" % (transformer_class.__name__, rows, rendered - start, bound - rendered))
+    return sql
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--nodes", type=int, default=200000)
+    args = parser.parse_args()
+    old = run(UncachedTransformer, args.nodes)
+    new = run(xmlparser.XML2SQLTransormer, args.nodes)
+    print("same statements: %s" % (old == new))
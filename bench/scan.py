@@ -0,0 +1,68 @@
+# edl : common library for the energy-dashboard tool-chain
+# Copyright (C) 2019  Todd Greenwood-Geer (Enviro Software Solutions, LLC)
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+"""
+scan.py : benchmark XML2SQLTransormer.scan_all and insertion_sql
+
+Compares looking up the (child, parent) tables of every node by searching
+the stack, which find_parent_child_tables used to do, with the table path
+that the Walker keeps up to date. Uses the synthetic document of walker.py,
+with --profile the top functions of each run are printed.
+
+    $ python bench/scan.py --nodes 200000 --profile
+"""
+
+import os
+import sys
+# run from a checkout, without installing edl
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from edl.resources import xmlparser
+from walker import document
+import argparse
+import cProfile
+import logging
+import pstats
+import time
+
+class StackSearchTransformer(xmlparser.XML2SQLTransormer):
+    """looks up tables by searching the stack"""
+    def walker(self, **handlers):
+        return xmlparser.Walker(self.logger, **handlers)
+
+def run(transformer_class, nodes):
+    xst = transformer_class(logging.getLogger(), None)
+    xst.json = document(nodes)
+    start = time.perf_counter()
+    xst.scan_all()
+    scanned = time.perf_counter()
+    rows = len(xst.insertion_sql())
+    inserted = time.perf_counter()
+    print("%-22s rows=%d scan_all=%.3fs insertion_sql=%.3fs" % (transformer_class.__name__, rows, scanned - start, inserted - scanned))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--nodes", type=int, default=200000)
+    parser.add_argument("--profile", action="store_true")
+    args = parser.parse_args()
+    for transformer_class in [StackSearchTransformer, xmlparser.XML2SQLTransormer]:
+        if args.profile:
+            profile = cProfile.Profile()
+            profile.runcall(run, transformer_class, args.nodes)
+            pstats.Stats(profile).sort_stats("tottime").print_stats(6)
+        else:
+            run(transformer_class, args.nodes)
@@ -0,0 +1,86 @@
+# edl : common library for the energy-dashboard tool-chain
+# Copyright (C) 2019  Todd Greenwood-Geer (Enviro Software Solutions, LLC)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+shards.py : benchmark the parallel insert of db.insert
+
+Writes --files 'rows' files spread over 1, 2, 4, ... --shards months, and
+inserts them with the 'month' partition, so into as many shards, once with
+one process and once with a writer process per shard.
+
+    $ python bench/shards.py --shards 8 --dir /var/tmp/edl-bench-shards
+"""
+
+import os
+import sys
+# run from a checkout, without installing edl
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from edl.resources import db
+import argparse
+import json
+import logging
+import shutil
+import time
+import uuid
+
+DDL = "CREATE TABLE IF NOT EXISTS report_data (id TEXT, opr_date TEXT, interval_num INTEGER, data_item TEXT, value REAL, PRIMARY KEY (id));"
+
+COLUMNS = ["id", "opr_date", "interval_num", "data_item", "value"]
+
+def rows(month, count):
+    for i in range(count):
+        yield (str(uuid.uuid4()), "2019-%02d-%02d" % (month, i % 28 + 1), i % 24 + 1, "RMD_AVG_MIL_%d" % (i % 50), i * 0.25)
+
+def write_files(sql_dir, files, shards, count):
+    names = []
+    for f in range(files):
+        name = "f%04d.rows" % f
+        with open(os.path.join(sql_dir, name), 'w') as fh:
+            fh.write(json.dumps({"ddl": [DDL]}) + "\n")
+            fh.write(json.dumps({"table": "report_data", "columns": COLUMNS, "rows": list(rows(f % shards + 1, count))}) + "\n")
+        names.append(name)
+    return names
+
+def run(sql_dir, db_dir, names, workers):
+    for d in [db_dir, os.path.join(os.path.dirname(db_dir), "save")]:
+        if os.path.exists(d):
+            shutil.rmtree(d)
+        os.makedirs(d)
+    start = time.perf_counter()
+    inserted = list(db.insert(logging.getLogger(), "bench", sql_dir, db_dir, names, partition="month", workers=workers))
+    assert len(inserted) == len(names)
+    return time.perf_counter() - start
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--shards", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--files", type=int, default=64)
+    parser.add_argument("--rows", type=int, default=20000)
+    parser.add_argument("--dir", default="/var/tmp/edl-bench-shards")
+    args = parser.parse_args()
+    sql_dir = os.path.join(args.dir, "sql")
+    db_dir = os.path.join(args.dir, "db")
+    shards = 1
+    while shards <= args.shards:
+        if os.path.exists(sql_dir):
+            shutil.rmtree(sql_dir)
+        os.makedirs(sql_dir)
+        names = write_files(sql_dir, args.files, shards, args.rows)
+        serial = run(sql_dir, db_dir, names, 1)
+        parallel = run(sql_dir, db_dir, names, shards)
+        print("shards=%-3d serial %.2fs parallel %.2fs speedup %.2fx" % (shards, serial, parallel, serial / parallel))
+        shards *= 2
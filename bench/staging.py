@@ -0,0 +1,108 @@
+# edl : common library for the energy-dashboard tool-chain
+# Copyright (C) 2019  Todd Greenwood-Geer (Enviro Software Solutions, LLC)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+staging.py : benchmark the insert modes of db.insert_file
+
+Builds a db of --size-mb with random (uuid) primary keys, like the dbs of
+the parse key mode 'uuid', kept in --dir so it is only built once. Then
+inserts --files 'rows' files into a copy of it, directly and through the
+staging tables, committing every db.BATCH_FILES files, each followed by
+db.finish with an index on interval_start_gmt. Each run is a process of
+its own.
+
+    $ python bench/staging.py --size-mb 1024 --dir /var/tmp/edl-bench
+"""
+
+import os
+import sys
+# run from a checkout, without installing edl
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from edl.resources import db
+import argparse
+import json
+import logging
+import multiprocessing
+import shutil
+import sqlite3
+import time
+import uuid
+
+DDL = "CREATE TABLE IF NOT EXISTS report_data (id TEXT, interval_start_gmt TEXT, interval_num INTEGER, data_item TEXT, value REAL, PRIMARY KEY (id));"
+
+COLUMNS = ["id", "interval_start_gmt", "interval_num", "data_item", "value"]
+
+def rows(count):
+    for i in range(count):
+        yield (str(uuid.uuid4()), "2019-09-%02dT%02d:00:00-00:00" % (i % 28 + 1, i % 24), i % 24 + 1, "RMD_AVG_MIL_%d" % (i % 50), i * 0.25)
+
+def build(db_file, size_mb):
+    cnx = sqlite3.connect(db_file)
+    cnx.execute(DDL)
+    while os.path.getsize(db_file) < size_mb * 1024 * 1024:
+        cnx.executemany("INSERT INTO report_data VALUES (?, ?, ?, ?, ?)", rows(100000))
+        cnx.commit()
+    cnx.close()
+
+def write_files(sql_dir, files, count):
+    names = []
+    for f in range(files):
+        name = "f%04d.rows" % f
+        with open(os.path.join(sql_dir, name), 'w') as fh:
+            fh.write(json.dumps({"ddl": [DDL]}) + "\n")
+            fh.write(json.dumps({"table": "report_data", "columns": COLUMNS, "rows": list(rows(count))}) + "\n")
+        names.append(name)
+    return names
+
+def run(mode, sql_dir, db_dir, names):
+    logger = logging.getLogger()
+    start = time.perf_counter()
+    with db.DbMgr(logger, "bench") as dbmgr:
+        router = db.ShardRouter(logger, "bench", db_dir)
+        for (idx, name) in enumerate(names):
+            db.insert_file(logger, "bench", dbmgr, router, sql_dir, name, idx, mode)
+            if (idx + 1) % db.BATCH_FILES == 0:
+                dbmgr.commit()
+        dbmgr.commit()
+        loaded = time.perf_counter() - start
+        db.finish(logger, "bench", dbmgr, ["interval_start_gmt"], mode)
+    print("%-7s load %.2fs finish %.2fs" % (mode, loaded, time.perf_counter() - start - loaded))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size-mb", type=int, default=1024)
+    parser.add_argument("--files", type=int, default=20)
+    parser.add_argument("--rows", type=int, default=20000)
+    parser.add_argument("--dir", default="/var/tmp/edl-bench")
+    args = parser.parse_args()
+    base = os.path.join(args.dir, "base_uuid_%dmb.db" % args.size_mb)
+    sql_dir = os.path.join(args.dir, "sql")
+    db_dir = os.path.join(args.dir, "db")
+    for d in [args.dir, sql_dir]:
+        if not os.path.exists(d):
+            os.makedirs(d)
+    if not os.path.exists(base):
+        build(base, args.size_mb)
+    names = write_files(sql_dir, args.files, args.rows)
+    for mode in db.INSERT_MODES:
+        if os.path.exists(db_dir):
+            shutil.rmtree(db_dir)
+        os.makedirs(db_dir)
+        shutil.copy(base, os.path.join(db_dir, db.gen_db_name("bench", 0)))
+        p = multiprocessing.Process(target=run, args=(mode, sql_dir, db_dir, names))
+        p.start()
+        p.join()
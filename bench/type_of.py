@@ -0,0 +1,76 @@
+# edl : common library for the energy-dashboard tool-chain
+# Copyright (C) 2019  Todd Greenwood-Geer (Enviro Software Solutions, LLC)
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+"""
+type_of.py : benchmark SqlTypeEnum.type_of
+
+Compares the int()/float() exception cascade that type_of used to run on
+every value with the pattern based classifier, on typical OASIS values,
+and checks that both agree on --fuzz random strings.
+
+    $ python bench/type_of.py --fuzz 1000000
+"""
+
+import os
+import sys
+# run from a checkout, without installing edl
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from edl.resources.xmlparser import SqlTypeEnum
+import argparse
+import random
+import timeit
+
+VALUES = ["RMD_AVG_MIL", "AS_CAISO_EXP", "2019-09-05T08:00:00-00:00", "2426.9", "-12.25", "24", "3600", None]
+
+ALPHABET = list("0123456789+-._eE \t\n") + ["\xa0", "\x1c", "\u2003", "\u0663", "\uff11", "\u00b2", "inf", "Infinity", "nan", "x", "i", "\u0131"]
+
+def exceptions(element):
+    """the previous type_of"""
+    if element is None:
+        return SqlTypeEnum.NULL
+    try:
+        int(element)
+        return SqlTypeEnum.INTEGER
+    except:
+        try:
+            float(element)
+            return SqlTypeEnum.REAL
+        except:
+            try:
+                str(element)
+                return SqlTypeEnum.TEXT
+            except:
+                return SqlTypeEnum.BLOB
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--number", type=int, default=200000)
+    parser.add_argument("--fuzz", type=int, default=100000)
+    args = parser.parse_args()
+    for v in VALUES:
+        old = timeit.timeit(lambda: exceptions(v), number=args.number)
+        new = timeit.timeit(lambda: SqlTypeEnum.type_of(v), number=args.number)
+        print("%-28r exceptions=%.3fs patterns=%.3fs" % (v, old, new))
+    rnd = random.Random(0)
+    mismatches = 0
+    for i in range(args.fuzz):
+        s = "".join(rnd.choice(ALPHABET) for _ in range(rnd.randint(0, 7)))
+        if exceptions(s) != SqlTypeEnum.type_of(s):
+            mismatches += 1
+            print("mismatch %r: %s != %s" % (s, exceptions(s), SqlTypeEnum.type_of(s)))
+    print("fuzz=%d mismatches=%d" % (args.fuzz, mismatches))
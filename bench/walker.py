@@ -0,0 +1,111 @@
+# edl : common library for the energy-dashboard tool-chain
+# Copyright (C) 2019  Todd Greenwood-Geer (Enviro Software Solutions, LLC)
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+"""
+walker.py : benchmark the xmlparser.Walker traversal
+
+Walks a synthetic OASIS shaped document of about --nodes nodes with no-op
+handlers and with the XML2SQLTransormer scan handlers, and compares with
+the recursive walk that copied the stack at every node, which Walker used
+to do. Also walks a document --depth levels deep, past the recursion limit.
+
+    $ python bench/walker.py --nodes 1000000
+"""
+
+import os
+import sys
+# run from a checkout, without installing edl
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from edl.resources import xmlparser
+from collections import OrderedDict
+import argparse
+import logging
+import time
+
+class RecursiveWalker(xmlparser.Walker):
+    """the previous, recursive Walker"""
+    def walk(self, name, obj):
+        self._walk([(name, obj)])
+
+    def _walk(self, stack):
+        (name, obj) = stack[-1]
+        if isinstance(obj, dict):
+            self.dict_handler_func(stack)
+            for k, v in obj.items():
+                self._walk(stack + [(k, v)])
+        elif isinstance(obj, list):
+            self.list_handler_func(stack)
+            for idx, item in enumerate(obj):
+                self._walk(stack + [(idx, item)])
+        else:
+            self.item_handler_func(stack)
+        stack.pop()
+
+def document(nodes):
+    """OASIS shaped document, a REPORT_DATA is 8 nodes"""
+    items = []
+    for i in range(max(1, nodes // 8 // 100)):
+        items.append(OrderedDict([
+            ("REPORT_HEADER", OrderedDict([("SYSTEM", "OASIS"), ("TZ", "PPT"), ("REPORT", "R%d" % i), ("UOM", "MW")])),
+            ("REPORT_DATA", [OrderedDict([
+                ("DATA_ITEM", "D%d" % (j % 3)),
+                ("RESOURCE_NAME", "RES_%d" % i),
+                ("OPR_DATE", "2019-09-05"),
+                ("INTERVAL_NUM", str(j % 24 + 1)),
+                ("INTERVAL_START_GMT", "2019-09-05T07:00:00-00:00"),
+                ("INTERVAL_END_GMT", "2019-09-05T08:00:00-00:00"),
+                ("VALUE", "%d.5" % j)]) for j in range(100)]),
+            ]))
+    return OrderedDict([("OASISReport", OrderedDict([
+        ("MessageHeader", OrderedDict([("TimeDate", "2019-09-07T14:50:16-00:00"), ("Source", "OASIS")])),
+        ("MessagePayload", OrderedDict([("RTO", OrderedDict([("name", "CAISO"), ("REPORT_ITEM", items)]))])),
+        ]))])
+
+def deep(depth):
+    doc = OrderedDict([("leaf", "1")])
+    for i in range(depth):
+        doc = OrderedDict([("level", doc)])
+    return doc
+
+def timed(walker_class, doc, scan):
+    counts = [0]
+    def count(stack):
+        counts[0] += 1
+    if scan:
+        xst = xmlparser.XML2SQLTransormer(logging.getLogger(), None)
+        walker = walker_class(xst.logger, item_handler_func=xst.scan_item, list_handler_func=xst.scan_container, dict_handler_func=xst.scan_container)
+    else:
+        walker = walker_class(None, item_handler_func=count, list_handler_func=count, dict_handler_func=count)
+    start = time.perf_counter()
+    try:
+        walker.walk("root", doc)
+        result = "%.3fs" % (time.perf_counter() - start)
+    except RecursionError:
+        result = "RecursionError"
+    return (result, counts[0])
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--nodes", type=int, default=1000000)
+    parser.add_argument("--depth", type=int, default=5000)
+    args = parser.parse_args()
+    doc = document(args.nodes)
+    for (label, d, scan) in [("noop", doc, False), ("scan", doc, True), ("deep", deep(args.depth), False)]:
+        for walker_class in [RecursiveWalker, xmlparser.Walker]:
+            (result, nodes) = timed(walker_class, d, scan)
+            print("%-5s %-16s nodes=%s elapsed=%s" % (label, walker_class.__name__, nodes or "-", result))
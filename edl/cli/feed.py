@@ -18,15 +18,16 @@ from edl.resources.exec import runyield
 from jinja2 import Environment, PackageLoader, select_autoescape
 from pathlib import Path
 from shutil import make_archive, rmtree
+import edl.resources.db as db
 import edl.resources.log as log
 import edl.resources.filesystem as filesystem
+import edl.resources.web as web
 import os
 import shutil
 import stat
 import sys
 import tarfile
 import re
-import requests
 import json
 import traceback
 
@@ -189,8 +190,10 @@ def prune(logger, feed, ed_path, stage):
     p           = pre_prune(logger, feed, ed_path, stage)
     ext         = STAGE_DIRS[stage]
     ending      = ".%s" % ext
+    # parse writes sql scripts or row batches, see db.ENDINGS
+    endings     = db.ENDINGS if stage == 'parse' else [ending]
     try:
-        files = filesystem.glob_dir(p, ending)
+        files = [f for e in endings for f in filesystem.glob_dir(p, e)]
         count = 0
         for f in files:
             os.remove(os.path.join(p, f))
@@ -201,7 +204,7 @@ def prune(logger, feed, ed_path, stage):
             "path"      : ed_path,
             "feed"      : feed,
             "target_dir": p,
-            "ending"    : ending,
+            "ending"    : endings,
             "removed"   : count,
             "message"   : "pruned target_dir",
             })
@@ -212,7 +215,7 @@ def prune(logger, feed, ed_path, stage):
             "path"      : ed_path,
             "feed"      : feed,
             "target_dir": p,
-            "ending"    : ending,
+            "ending"    : endings,
             "ERROR"     : "failed to prune target_dir",
             "exception" : str(e)
             })
@@ -509,12 +512,10 @@ def restore_from_s3(logger, feed, ed_path, service):
     url_tuples = s3_artifact_urls(chlogger, feed, ed_path, service)
     try:
         for (url, target) in url_tuples:
-            r = requests.get(url)
-            if r.status_code == 200:
-                with open(target, 'wb') as fd:
-                    for chunk in r.iter_content(chunk_size=128):
-                        fd.write(chunk)
-                logger.info(chlogger, {
+            # only move artifacts that changed since they were last restored
+            (status_code, _) = web.fetch(url, target, validators=web.local_validators(target))
+            if status_code == 200:
+                log.info(chlogger, {
                     "name"      : __name__,
                     "method"    : "restore_from_s3",
                     "feed"      : feed,
@@ -524,6 +525,17 @@ def restore_from_s3(logger, feed, ed_path, service):
                     "target"    : target,
                     "message"   : "Restore succeeded",
                     })
+            elif status_code == 304:
+                log.info(chlogger, {
+                    "name"      : __name__,
+                    "method"    : "restore_from_s3",
+                    "feed"      : feed,
+                    "path"      : ed_path,
+                    "service"   : service,
+                    "url"       : url,
+                    "target"    : target,
+                    "message"   : "Restore skipped, artifact not modified",
+                    })
             else:
                 log.error(chlogger, {
                     "name"      : __name__,
@@ -533,6 +545,7 @@ def restore_from_s3(logger, feed, ed_path, service):
                     "service"   : service,
                     "url"       : url,
                     "target"    : target,
+                    "status_code": status_code,
                     "ERROR"     : "Failed to retrieve artifact from S3",
                     })
                 target_parts = os.path.splitext(target)
@@ -14,13 +14,112 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+from concurrent.futures import ProcessPoolExecutor
+import csv
+import datetime
+import functools
+import gzip
+import hashlib
+import json
 import os
 import logging
+import re
 import sqlite3
 from edl.resources import log
 from edl.resources import filesystem
+from edl.resources.window import Window
+
+ENDINGS = [".sql", ".rows", ".sql.gz", ".rows.gz"]
+"""endings of the files `insert` loads, see `xmlparser.OUTPUT_FORMATS`,
+.gz files are decompressed while they are read, see `open_file`"""
+
+DB_ENGINES = ["file", "memory"]
+"""how `insert` writes the dbs, see `DbMgr`"""
+
+DB_ENGINE = "file"
+"""default db engine"""
+
+MEMDB_MAX_BYTES = 64 * 1024 * 1024
+"""dbs larger than this are written with FileDb, even with the 'memory' engine"""
+
+CACHE_KIB = 256 * 1024
+"""page cache of a FileDb, in KiB"""
+
+BATCH_FILES = 64
+"""files per transaction, see `insert`"""
+
+BATCH_ROWS = 500000
+"""rows (or sql statements) per transaction, see `insert`"""
+
+INSERT_MODES = ["direct", "staged"]
+"""how `insert_file` loads a file, see `stage` and `merge`"""
+
+INSERT_MODE = "direct"
+"""default insert mode"""
+
+ANALYSIS_LIMIT = 1000
+"""rows of an index that ANALYZE samples, so it stays quick on large dbs, see `finish`"""
+
+INSERT_WORKERS = 1
+"""default number of processes writing shards in parallel, see `insert`"""
+
+SHARDS_FILE = "shards.json"
+"""name of the shard registry in the db directory, see `ShardRouter`"""
+
+PARTITIONS = {"month": 7, "year": 4}
+"""partition -> length of the date prefix that names it, see `read_partition`"""
+
+PARTITION_COLUMNS = ["opr_date", "interval_start_gmt"]
+"""columns whose dates partition the files, in order of preference"""
+
+DATE = re.compile(r"\d{4}-\d{2}-\d{2}")
+
+INSERT = re.compile(r"\s*INSERT OR IGNORE INTO (\w+) \(([^)]*)\) VALUES \((.*)\);\s*$", re.DOTALL)
+"""the insert statements of `xmlparser.XML2SQLTransormer.insert_row`"""
+
+class FileDb():
+    """
+    Writes straight to the db file, in WAL mode with synchronous=NORMAL, so
+    a commit appends the changed pages to the WAL instead of rewriting the
+    db, and only a checkpoint syncs. Unlike MemDb, memory does not grow
+    with the db, and a run only writes the pages it changes.
+
+    On close the WAL is checkpointed and the db goes back to the rollback
+    journal, so the db is a single file again for dist and arch.
+    """
+    def __init__(self, db_path, cache_kib=CACHE_KIB):
+        self.db_path = db_path
+        self.cache_kib = cache_kib
+        self.cnx = None
+    def open(self):
+        cnx = self.cnx = sqlite3.connect(self.db_path)
+        cnx.execute("PRAGMA journal_mode=WAL")
+        cnx.execute("PRAGMA synchronous=NORMAL")
+        cnx.execute("PRAGMA cache_size=-%d" % self.cache_kib)
+        cnx.execute("PRAGMA temp_store=MEMORY")
+        return cnx
+    def close(self):
+        cnx = self.cnx
+        cnx.commit()
+        cnx.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        try:
+            cnx.execute("PRAGMA journal_mode=DELETE")
+        except sqlite3.OperationalError:
+            # a reader has the db open, it stays in WAL mode until the
+            # next run, which is still consistent
+            pass
+        cnx.close()
+        self.cnx = None
+    def db(self):
+        return self.cnx
+    def __repr__(self):
+        return str(self.db_path)
 
 class MemDb():
+    """
+    Copies the whole db into memory on open and back on close, only meant
+    for small dbs, see MEMDB_MAX_BYTES.
+    """
     def __init__(self, db_path):
         self.db_path = db_path
         self.filedb = None
@@ -34,6 +133,8 @@ class MemDb():
         source.backup(dest)
         return dest
     def close(self):
+        # a backup waits for open transactions
+        self.memdb.commit()
         # source
         source = self.memdb
         # dest
@@ -47,10 +148,20 @@ class MemDb():
         return str(self.db_path)
 
 class DbMgr():
-    def __init__(self, logger, resource_name):
+    """
+    Opens each db once per run, with FileDb, or with MemDb when the engine
+    is 'memory' and the db is at most memdb_max_bytes.
+    """
+    def __init__(self, logger, resource_name, engine=DB_ENGINE, memdb_max_bytes=MEMDB_MAX_BYTES):
+        if engine not in DB_ENGINES:
+            raise Exception("unknown db engine: '%s', expected one of %s" % (engine, DB_ENGINES))
         self.dbs = {}
         self.resource_name = resource_name
         self.logger = logger
+        self.engine = engine
+        self.memdb_max_bytes = memdb_max_bytes
+        self.uncommitted = 0
+        """rows inserted since the last `commit`"""
     def get(self, db_path):
         log.debug(self.logger, {
             "name"      : __name__,
@@ -59,17 +170,28 @@ class DbMgr():
             "db_path"   : db_path,
             })
         if db_path not in self.dbs:
-            db = MemDb(db_path)
-            cnx = db.open()
+            size = os.path.getsize(db_path) if os.path.exists(db_path) else 0
+            if self.engine == "memory" and size <= self.memdb_max_bytes:
+                db = MemDb(db_path)
+            else:
+                db = FileDb(db_path)
+            db.open()
             self.dbs[db_path] = db
             log.debug(self.logger, {
                 "name"      : __name__,
                 "src"       : self.resource_name,
                 "method"    : "DbMgr.get",
                 "db_path"   : db_path,
-                "message"   : "Created in memory db",
+                "db_size"   : size,
+                "message"   : "Opened %s" % type(db).__name__,
                 })
         return self.dbs[db_path].db()
+    def commit(self):
+        for v in self.dbs.values():
+            # staging tables of the 'staged' insert mode, see `stage`
+            merge(v.db())
+            v.db().commit()
+        self.uncommitted = 0
     def __enter__(self):
         return self
     def __exit__(self, type, value, traceback):
@@ -80,119 +202,793 @@ class DbMgr():
                 "src"       : self.resource_name,
                 "method"    : "DbMgr.__exit__",
                 "db_path"   : k,
-                "message"   : "Closed in memory db",
+                "message"   : "Closed %s" % v.__class__.__name__,
                 })
 
     def __repr__(self):
         return str(self.dbs.keys())
 
-def insert(logger, resource_name, sql_dir, db_dir, new_files):
+def insert(logger, resource_name, sql_dir, db_dir, new_files, engine=DB_ENGINE, batch_files=BATCH_FILES, batch_rows=BATCH_ROWS, partition=None, mode=INSERT_MODE, indexes=None, workers=INSERT_WORKERS):
+    """
+    Insert new_files from sql_dir into the dbs in db_dir, yielding the name
+    of every file once it is committed (with the 'file' engine), so the
+    state file never lists a file that a crash could still lose.
+
+    engine      : one of DB_ENGINES, see `DbMgr`
+    batch_files : files per transaction
+    batch_rows  : the transaction is also committed once this many rows
+                  were inserted, whichever comes first
+    partition   : None, or one of PARTITIONS to put the files of every
+                  month (or year) in shards of their own, see `ShardRouter`
+    mode        : one of INSERT_MODES, see `insert_file`
+    indexes     : secondary indexes to build once the files are in, see
+                  `finish`
+    workers     : number of processes writing shards in parallel, see
+                  `_insert_parallel`, files are then yielded in the order
+                  they are committed
+
+    Every file is inserted in a savepoint of the transaction, so a file
+    that fails only rolls back itself, see `load_file`.
+    """
     chlogger = logger.getChild(__name__)
-    with DbMgr(chlogger, resource_name) as dbmgr:
-        new_files_count = len(new_files)
-        if not os.path.exists(db_dir):
-            os.makedirs(db_dir)
-        if not os.path.exists(db_dir):
-            raise Exception("Failed to create db_dir: %s" % db_dir)
-        log.info(chlogger, {
-            "name"      : __name__,
-            "src"       : resource_name,
-            "method"    : "insert",
-            "sql_dir"   : sql_dir,
-            "db_dir"    : db_dir,
-            "new_files" : new_files_count,
-            })
+    # new_files may be a stream of files as they arrive (see pipeline.py)
+    new_files_count = len(new_files) if hasattr(new_files, '__len__') else None
+    if not os.path.exists(db_dir):
+        os.makedirs(db_dir)
+    if not os.path.exists(db_dir):
+        raise Exception("Failed to create db_dir: %s" % db_dir)
+    if mode not in INSERT_MODES:
+        raise Exception("unknown insert mode: '%s', expected one of %s" % (mode, INSERT_MODES))
+    router = ShardRouter(chlogger, resource_name, db_dir, partition)
+    log.info(chlogger, {
+        "name"      : __name__,
+        "src"       : resource_name,
+        "method"    : "insert",
+        "sql_dir"   : sql_dir,
+        "db_dir"    : db_dir,
+        "new_files" : new_files_count,
+        "workers"   : workers,
+        })
+    options = (logger, resource_name, sql_dir, engine, batch_rows, mode, indexes)
+    if workers <= 1:
+        yield from _insert_serial(options, router, new_files, batch_files)
+    else:
+        yield from _insert_parallel(options, router, new_files, batch_files, workers)
+
+    save_dir        = os.path.join(os.path.dirname(db_dir), "save")
+    save_state_file = os.path.join(save_dir, "state.txt")
+    db_files        = filesystem.glob_dir(db_dir, ".db")
+    with open(save_state_file, 'w') as f:
+        for dbf in db_files:
+            f.write("%s\n" % dbf)
+            log.debug(logger, {
+                "name"      : __name__,
+                "method"    : "insert",
+                "resource"  : resource_name,
+                "db_file"   : dbf,
+                "state_file": save_state_file,
+                "message"   : "added db_file to state file",
+                })
+
+def _insert_serial(options, router, new_files, batch_files):
+    """
+    Insert new_files in this process, through one DbMgr for all shards,
+    see `insert`.
+    """
+    (logger, resource_name, sql_dir, engine, batch_rows, mode, indexes) = options
+    chlogger = logger.getChild(__name__)
+    with DbMgr(chlogger, resource_name, engine) as dbmgr:
+        inserted = []
+        batch = 0
         for (idx, sql_file_name) in enumerate(new_files):
-            yield insert_file(logger, resource_name, dbmgr, sql_dir, db_dir, sql_file_name, idx, depth=0, max_depth=5)
-       
-        save_dir        = os.path.join(os.path.dirname(db_dir), "save")
-        save_state_file = os.path.join(save_dir, "state.txt")
-        db_files        = filesystem.glob_dir(db_dir, ".db")
-        with open(save_state_file, 'w') as f:
-            for dbf in db_files:
-                f.write("%s\n" % dbf)
-                log.debug(logger, {
+            name = insert_file(logger, resource_name, dbmgr, router, sql_dir, sql_file_name, idx, mode)
+            if name is not None:
+                inserted.append(name)
+            batch += 1
+            if batch >= batch_files or dbmgr.uncommitted >= batch_rows:
+                dbmgr.commit()
+                router.save()
+                yield from inserted
+                inserted = []
+                batch = 0
+        dbmgr.commit()
+        router.save()
+        yield from inserted
+        finish(chlogger, resource_name, dbmgr, indexes, mode)
+
+def _insert_parallel(options, router, new_files, batch_files, workers):
+    """
+    Insert new_files with `workers` writer processes, see `insert`. The
+    files are routed here, and queue up per shard until batch_files of
+    them are waiting. They then go to a writer process as one job, see
+    `_insert_batch`, unless the shard still has a job in flight. So every
+    shard has a single writer at a time, as sqlite wants, while different
+    shards are written in parallel. Once all files are in, every shard
+    that was written is finished in parallel too, see `_finish_db`.
+    """
+    (logger, resource_name, sql_dir, engine, batch_rows, mode, indexes) = options
+    chlogger = logger.getChild(__name__)
+    pending  = {}
+    """db file -> [(idx, sql file name, tables)] waiting for a job"""
+    window   = Window(workers)
+    """jobs in flight, (db file, [(idx, sql file name, tables)])"""
+    written  = set()
+
+    def submit(pool, full_only):
+        busy = set([db_file for (db_file, batch) in window.jobs()])
+        for db_file in sorted(pending):
+            if db_file in busy or (full_only and len(pending[db_file]) < batch_files):
+                continue
+            batch = pending.pop(db_file)
+            window.add(pool.submit(_insert_batch, options, db_file, [(idx, f) for (idx, f, tables) in batch]), (db_file, batch))
+
+    def complete(done):
+        inserted = []
+        for (future, (db_file, batch)) in done:
+            try:
+                loaded = set(future.result())
+            except Exception as e:
+                log.error(chlogger, {
                     "name"      : __name__,
-                    "method"    : "insert",
-                    "resource"  : resource_name,
-                    "db_file"   : dbf,
-                    "state_file": save_state_file,
-                    "message"   : "added db_file to state file",
+                    "src"       : resource_name,
+                    "method"    : "_insert_parallel",
+                    "db_file"   : db_file,
+                    "files"     : len(batch),
+                    "ERROR"     : "insert batch failed",
+                    "exception" : str(e),
                     })
+                loaded = set()
+            for (idx, f, tables) in batch:
+                if f in loaded:
+                    router.add(db_file, tables)
+                    inserted.append(f)
+                    written.add(db_file)
+                else:
+                    router.release(db_file, tables)
+        router.save()
+        return inserted
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for (item, done) in window.feed(enumerate(new_files), more=lambda: bool(pending)):
+            yield from complete(done)
+            if item is not None:
+                (idx, sql_file_name) = item
+                routed = route_file(logger, resource_name, router, sql_dir, sql_file_name, idx)
+                if routed is not None:
+                    (db_file, tables) = routed
+                    pending.setdefault(db_file, []).append((idx, sql_file_name, tables))
+            # once all files are in, the batches that are not full go too
+            submit(pool, not window.exhausted)
+        if mode == "staged" or indexes:
+            for future in [pool.submit(_finish_db, options, db_file) for db_file in sorted(written)]:
+                future.result()
+
+def _insert_batch(options, db_file, files):
+    """
+    Load files, [(idx, sql file name)], into db_file in a writer process,
+    see `_insert_parallel`. Return the names of the files that were
+    committed.
+    """
+    (logger, resource_name, sql_dir, engine, batch_rows, mode, indexes) = options
+    chlogger = logger.getChild(__name__)
+    loaded = []
+    with DbMgr(chlogger, resource_name, engine) as dbmgr:
+        for (idx, sql_file_name) in files:
+            if load_file(logger, resource_name, dbmgr, db_file, sql_dir, sql_file_name, idx, mode) is not None:
+                loaded.append(sql_file_name)
+            if dbmgr.uncommitted >= batch_rows:
+                dbmgr.commit()
+        dbmgr.commit()
+    return loaded
 
-def insert_file(logger, resource_name, dbmgr, sql_dir, db_dir, sql_file_name, idx, depth, max_depth):
+def _finish_db(options, db_file):
+    (logger, resource_name, sql_dir, engine, batch_rows, mode, indexes) = options
+    chlogger = logger.getChild(__name__)
+    with DbMgr(chlogger, resource_name, engine) as dbmgr:
+        dbmgr.get(db_file)
+        finish(chlogger, resource_name, dbmgr, indexes, mode)
+
+def insert_file(logger, resource_name, dbmgr, router, sql_dir, sql_file_name, idx, mode=INSERT_MODE):
+    """
+    Insert sql_file_name into the shard that the router picks for its ddl,
+    see `route_file` and `load_file`. Return sql_file_name, or None when
+    the file failed, in which case nothing of it is left in the db.
+    """
+    routed = route_file(logger, resource_name, router, sql_dir, sql_file_name, idx)
+    if routed is None:
+        return None
+    (db_file, tables) = routed
+    if load_file(logger, resource_name, dbmgr, db_file, sql_dir, sql_file_name, idx, mode) is None:
+        router.release(db_file, tables)
+        return None
+    router.add(db_file, tables)
+    return sql_file_name
+
+def route_file(logger, resource_name, router, sql_dir, sql_file_name, idx):
+    """
+    Return (db file, tables) for sql_file_name, the shard that the router
+    picks for its ddl and the result of `table_fingerprints`, or None when
+    the file can not be read.
+    """
     chlogger    = logger.getChild(__name__)
-    db_name     = gen_db_name(resource_name, depth)
     sql_file    = os.path.join(sql_dir, sql_file_name)
-    db_file     = os.path.join(db_dir, db_name)
-    if depth > max_depth:
+    try:
+        tables  = table_fingerprints(read_ddl(sql_file))
+        return (router.route(tables, read_partition(sql_file, router.partition)), tables)
+    except Exception as e:
         log.error(chlogger, {
             "name"      : __name__,
             "src"       : resource_name,
-            "method"    : "insert_file",
-            "db_file"   : db_file,
+            "method"    : "route_file",
             "file_idx"  : idx,
             "sql_file"  : sql_file,
-            "depth"     : depth,
-            "max_depth" : max_depth,
-            "dbmgr"     : str(dbmgr),
-            "ERROR"     :"insert sql_file failed, max_depth exceeded",
+            "ERROR"     : "route sql_file failed",
+            "exception": str(e),
             })
-        return
+        return None
 
-    log.info(chlogger, {
-        "name"      : __name__,
-        "src"       : resource_name,
-        "method"    : "insert_file",
-        "db_file"   : db_file,
-        "file_idx"  : idx,
-        "sql_file"  : sql_file,
-        "depth"     : depth,
-        "dbmgr"     : str(dbmgr),
-        "message"   : "started",
-        })
-        
-    cnx = dbmgr.get(db_file)
+def load_file(logger, resource_name, dbmgr, db_file, sql_dir, sql_file_name, idx, mode=INSERT_MODE):
+    """
+    Load sql_file_name into db_file in a savepoint. Return sql_file_name,
+    or None when the file failed, in which case nothing of it is left in
+    the db.
+
+    With mode 'staged' the rows go to staging tables first, see `stage`,
+    which are merged into the tables in primary key order when the batch
+    is committed, see `DbMgr.commit`.
+    """
+    chlogger    = logger.getChild(__name__)
+    sql_file    = os.path.join(sql_dir, sql_file_name)
     try:
-        with open(sql_file, 'r') as sf:
-            log.debug(chlogger, {
-                "name"      : __name__,
-                "src"       : resource_name,
-                "method"    : "insert_file",
-                "db_file"   : db_file,
-                "file_idx"  : idx,
-                "sql_file"  : sql_file,
-                "depth"     : depth,
-                "dbmgr"     : str(dbmgr),
-                "message"   : "started",
-                })
-            cnx.executescript(sf.read())
-            log.debug(chlogger, {
-                "name"      : __name__,
-                "src"       : resource_name,
-                "method"    : "insert_file",
-                "db_file"   : db_file,
-                "file_idx"  : idx,
-                "sql_file"  : sql_file,
-                "depth"     : depth,
-                "dbmgr"     : str(dbmgr),
-                "message"   : "completed",
-                })
+        log.info(chlogger, {
+            "name"      : __name__,
+            "src"       : resource_name,
+            "method"    : "load_file",
+            "db_file"   : db_file,
+            "file_idx"  : idx,
+            "sql_file"  : sql_file,
+            "dbmgr"     : str(dbmgr),
+            "message"   : "started",
+            })
+        cnx = dbmgr.get(db_file)
+        with open_file(sql_file) as sf:
+            if not cnx.in_transaction:
+                # otherwise releasing the savepoint would commit
+                cnx.execute("BEGIN")
+            cnx.execute("SAVEPOINT insert_file")
+            try:
+                if mode == "staged":
+                    ddl = read_ddl(sql_file)
+                    stage(cnx, ddl, table_fingerprints(ddl))
+                if sql_file.endswith((".rows", ".rows.gz")):
+                    rows = load_rows(cnx, sf)
+                else:
+                    rows = load_sql(cnx, sf)
+                cnx.execute("RELEASE insert_file")
+            except:
+                cnx.execute("ROLLBACK TO insert_file")
+                cnx.execute("RELEASE insert_file")
+                raise
+        dbmgr.uncommitted += rows
+        log.debug(chlogger, {
+            "name"      : __name__,
+            "src"       : resource_name,
+            "method"    : "load_file",
+            "db_file"   : db_file,
+            "file_idx"  : idx,
+            "sql_file"  : sql_file,
+            "dbmgr"     : str(dbmgr),
+            "message"   : "completed",
+            })
         return sql_file_name
     except Exception as e:
         log.error(chlogger, {
             "name"      : __name__,
             "src"       : resource_name,
-            "method"    : "insert_file",
+            "method"    : "load_file",
             "file_idx"  : idx,
             "db_file"   : db_file,
             "sql_file"  : sql_file,
-            "depth"     : depth,
             "dbmgr"     : str(dbmgr),
             "ERROR"     : "insert sql_file failed",
             "exception": str(e),
             })
-        insert_file(logger, resource_name, dbmgr, sql_dir, db_dir, sql_file, idx, depth+1, max_depth)
+        return None
+
+def stage(cnx, ddl, tables):
+    """
+    Create the tables of a file (ddl), and a staging table for each of
+    them, unless the transaction already has one: an empty copy in the
+    temp schema, without the primary key or any index. Unqualified names
+    resolve to the temp schema first, so the inserts of the file go to the
+    staging tables as they are, while its create table statements still
+    only look at the main schema. The staging tables are merged on commit,
+    see `merge`.
+    """
+    for statement in ddl:
+        cnx.execute(statement)
+    for table in tables:
+        cnx.execute('CREATE TEMP TABLE IF NOT EXISTS "%s" AS SELECT * FROM main."%s" WHERE 0' % (table, table))
+
+def merge(cnx):
+    """
+    Move the rows of the staging tables (see `stage`) into the tables, in
+    primary key order, so the keys of a whole batch of files fill the
+    b-tree of a table page by page instead of at random places. Of rows
+    with the same key the first one inserted wins, as it does when they
+    are inserted directly.
+    """
+    tables = [name for (name,) in cnx.execute("SELECT name FROM temp.sqlite_master WHERE type='table'")]
+    for table in tables:
+        columns = sorted([(pk, name) for (cid, name, ctype, notnull, dflt, pk) in cnx.execute('PRAGMA main.table_info("%s")' % table) if pk > 0])
+        order = ", ".join(['"%s"' % name for (pk, name) in columns] + ["rowid"])
+        cnx.execute('INSERT OR IGNORE INTO main."%s" SELECT * FROM temp."%s" ORDER BY %s' % (table, table, order))
+        cnx.execute('DROP TABLE temp."%s"' % table)
+
+def finish(logger, resource_name, dbmgr, indexes=None, mode=INSERT_MODE):
+    """
+    Build the secondary indexes (see `build_indexes`) of every db of the
+    run, once, after all of its files are in. The query planner statistics
+    are then refreshed with ANALYZE, when the db was loaded through the
+    staging tables or got new indexes.
+    """
+    for db_path in sorted(dbmgr.dbs):
+        cnx = dbmgr.get(db_path)
+        (created, unmatched) = build_indexes(cnx, indexes or [])
+        if unmatched:
+            log.warning(logger, {
+                "name"      : __name__,
+                "src"       : resource_name,
+                "method"    : "finish",
+                "db_path"   : db_path,
+                "indexes"   : unmatched,
+                "message"   : "no table has the columns of these indexes",
+                })
+        if mode != "staged" and not created:
+            continue
+        cnx.execute("PRAGMA analysis_limit=%d" % ANALYSIS_LIMIT)
+        cnx.execute("ANALYZE")
+        dbmgr.commit()
+        log.info(logger, {
+            "name"      : __name__,
+            "src"       : resource_name,
+            "method"    : "finish",
+            "db_path"   : db_path,
+            "indexes"   : created,
+            "message"   : "analyzed",
+            })
+
+def build_indexes(cnx, indexes):
+    """
+    Create the secondary indexes on every table of cnx that has all of
+    their columns, e.g. ["interval_start_gmt", ["opr_date", "data_item"]]
+    for an index on interval_start_gmt and one on (opr_date, data_item).
+    Column names are sanitized like the names of the parser, so
+    "OPR_DATE" is opr_date.
+
+    Return (names of the indexes that were created, column lists of the
+    indexes that no table has the columns of).
+    """
+    # xmlparser imports this module
+    from edl.resources.xmlparser import sanitize
+    created = []
+    matched = set()
+    indexes = [tuple([sanitize(c) for c in ([index] if isinstance(index, str) else index)]) for index in indexes]
+    existing = set([name for (name,) in cnx.execute("SELECT name FROM main.sqlite_master WHERE type='index'")])
+    tables = [name for (name,) in cnx.execute("SELECT name FROM main.sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%'")]
+    for table in sorted(tables):
+        columns = set([c[1] for c in cnx.execute('PRAGMA main.table_info("%s")' % table)])
+        for index_columns in indexes:
+            if not set(index_columns) <= columns:
+                continue
+            matched.add(index_columns)
+            name = gen_index_name(table, index_columns)
+            if name in existing:
+                continue
+            cnx.execute('CREATE INDEX "%s" ON "%s" (%s)' % (name, table, ", ".join(['"%s"' % c for c in index_columns])))
+            existing.add(name)
+            created.append(name)
+    return (created, [list(index_columns) for index_columns in indexes if index_columns not in matched])
+
+class ShardRouter():
+    """
+    Picks the shard (see `gen_db_name`) of every file from the create
+    table statements of the file, before it is loaded. A file goes to the
+    first shard where each of its tables is missing, or has the same keys
+    and at least the columns of the file (see `compatible`), otherwise to a
+    new shard. Declared types do not matter, sqlite takes any value in any
+    column, so a column that is INTEGER in one file and REAL in the next
+    does not split a feed. So every file is loaded once, and files of the
+    same schema variant end up in the same shard.
+
+    The tables of every shard are kept in db_dir/shards.json, see
+    `report`. Shards that are not in there yet, e.g. the dbs of runs before
+    the registry, are read from the db files.
+
+    With a partition ('month' or 'year') the shards of a partition, e.g.
+    <feed>_2019-09_00.db, only take the files of that partition, see
+    `read_partition`. The shards are then also listed in the catalog db,
+    <feed>_catalog.db, with the time they last changed, so only those need
+    to be distributed again.
+    """
+    def __init__(self, logger, resource_name, db_dir, partition=None):
+        if partition is not None and partition not in PARTITIONS:
+            raise Exception("unknown partition: '%s', expected one of %s" % (partition, sorted(PARTITIONS)))
+        self.logger         = logger
+        self.resource_name  = resource_name
+        self.db_dir         = db_dir
+        self.partition      = partition
+        self.shards_file    = os.path.join(db_dir, SHARDS_FILE)
+        self.catalog_file   = os.path.join(db_dir, gen_catalog_name(resource_name))
+        self.shards         = read_shards(self.shards_file)
+        """db file name -> {"tables": {table : fingerprint}, "files": files loaded, "partition": partition, "updated": time}"""
+        for (db_file, shard) in self.shards.items():
+            if not all(isinstance(f, dict) for f in shard["tables"].values()):
+                # fingerprints of an older registry, read them again
+                db_path = os.path.join(db_dir, db_file)
+                shard["tables"] = db_fingerprints(db_path) if os.path.exists(db_path) else {}
+        self.routes         = {}
+        """(partition, fingerprints of a file) -> db file name, to skip the search"""
+        self.claims         = {}
+        """db file name -> {table : [fingerprint of every file]} of the files
+        routed but not loaded yet, see `route` and `release`"""
+        self.changed        = set()
+        """shards changed since the last `save`"""
+        shard_name = re.compile(r"^%s_(?:(\d{4}(?:-\d{2})?)_)?\d{2}\.db$" % re.escape(resource_name))
+        for db_file in sorted(filesystem.glob_dir(db_dir, ".db")):
+            m = shard_name.match(db_file)
+            if db_file not in self.shards and m is not None:
+                self.shards[db_file] = {"tables": db_fingerprints(os.path.join(db_dir, db_file)), "files": None, "partition": m.group(1)}
+                self.changed.add(db_file)
+
+    def route(self, tables, partition=None):
+        """
+        Return the path of the shard for a file with tables, the result of
+        `table_fingerprints`, in partition (see `read_partition`).
+
+        The tables are claimed for the shard until the file is recorded
+        with `add`, or given up with `release`, so files routed before it
+        is loaded (see `_insert_parallel`) do not get other schemas. Claims
+        are not saved to the registry.
+        """
+        key = (partition, json.dumps(tables, sort_keys=True))
+        db_file = self.routes.get(key)
+        if db_file is None:
+            for (name, shard) in sorted(self.shards.items()):
+                if shard.get("partition") != partition:
+                    continue
+                known = self.tables(name)
+                if all(compatible(known.get(t), f) for (t, f) in tables.items()):
+                    db_file = name
+                    break
+            else:
+                db_file = self.new_shard(tables, partition)
+            self.routes[key] = db_file
+        claims = self.claims.setdefault(db_file, {})
+        for (t, f) in tables.items():
+            claims.setdefault(t, []).append(f)
+        return os.path.join(self.db_dir, db_file)
+
+    def tables(self, db_file):
+        """
+        Return {table : fingerprint} of the shard, with the claimed tables
+        it does not have yet, as the first file that claimed them creates
+        them.
+        """
+        tables = dict(self.shards[db_file]["tables"])
+        for (t, claims) in self.claims.get(db_file, {}).items():
+            if claims:
+                tables.setdefault(t, claims[0])
+        return tables
+
+    def new_shard(self, tables, partition=None):
+        depth = 0
+        while gen_db_name(self.resource_name, depth, partition) in self.shards:
+            depth += 1
+        db_file = gen_db_name(self.resource_name, depth, partition)
+        self.shards[db_file] = {"tables": {}, "files": 0, "partition": partition}
+        log.info(self.logger, {
+            "name"      : __name__,
+            "src"       : self.resource_name,
+            "method"    : "ShardRouter.new_shard",
+            "db_file"   : db_file,
+            "partition" : partition,
+            "tables"    : sorted(tables.keys()),
+            "message"   : "new partition, or schema conflicts with its shards",
+            })
+        return db_file
+
+    def add(self, db_path, tables):
+        """
+        Record that a file with tables, routed to db_path, was loaded.
+        """
+        db_file = os.path.basename(db_path)
+        self.unclaim(db_file, tables)
+        shard = self.shards[db_file]
+        for (t, f) in tables.items():
+            # a table the shard has already keeps its columns
+            shard["tables"].setdefault(t, f)
+        if shard["files"] is not None:
+            shard["files"] += 1
+        self.changed.add(db_file)
+
+    def release(self, db_path, tables):
+        """
+        Give up the claim of a file with tables, routed to db_path, that
+        failed to load, see `route`.
+        """
+        self.unclaim(os.path.basename(db_path), tables)
+        # cached routes may rely on the claim
+        self.routes = {}
+
+    def unclaim(self, db_file, tables):
+        claims = self.claims.get(db_file, {})
+        for (t, f) in tables.items():
+            if f in claims.get(t, []):
+                claims[t].remove(f)
+
+    def save(self):
+        if not self.changed:
+            return
+        updated = datetime.datetime.utcnow().isoformat(timespec='seconds')
+        for db_file in self.changed:
+            self.shards[db_file]["updated"] = updated
+        tmpfile = "%s.tmp" % self.shards_file
+        with open(tmpfile, 'w') as f:
+            f.write(json.dumps(self.shards, indent=4, sort_keys=True))
+        os.replace(tmpfile, self.shards_file)
+        if self.partition is not None:
+            write_catalog(self.catalog_file, dict([(k, self.shards[k]) for k in self.changed]))
+        self.changed = set()
+
+def write_catalog(catalog_file, shards):
+    """
+    Insert or replace shards, see `ShardRouter.shards`, in the catalog db.
+    """
+    cnx = sqlite3.connect(catalog_file)
+    try:
+        with cnx:
+            cnx.execute("CREATE TABLE IF NOT EXISTS shards (db_file TEXT, partition TEXT, files INTEGER, tables TEXT, updated TEXT, PRIMARY KEY (db_file));")
+            cnx.executemany("INSERT OR REPLACE INTO shards (db_file, partition, files, tables, updated) VALUES (?, ?, ?, ?, ?);",
+                [(k, v.get("partition"), v["files"], json.dumps(v["tables"], sort_keys=True), v["updated"]) for (k, v) in sorted(shards.items())])
+    finally:
+        cnx.close()
+
+def read_shards(shards_file):
+    if not os.path.exists(shards_file):
+        return {}
+    with open(shards_file, 'r') as f:
+        return json.load(f)
+
+def report(logger, resource_name, db_dir):
+    """
+    Log and return the schema variant of every shard in db_dir:
+
+        {db file : {"tables": {table : fingerprint}, "files": files loaded, ...}}
+
+    where "files" is None for shards that predate the registry.
+    """
+    shards = ShardRouter(logger, resource_name, db_dir).shards
+    for (db_file, shard) in sorted(shards.items()):
+        log.info(logger, {
+            "name"      : __name__,
+            "src"       : resource_name,
+            "method"    : "report",
+            "db_file"   : db_file,
+            "partition" : shard.get("partition"),
+            "files"     : shard["files"],
+            "tables"    : shard["tables"],
+            })
+    return shards
+
+def read_ddl(sql_file):
+    """
+    Return the create table statements at the start of sql_file, without
+    reading the rest of it.
+    """
+    with open_file(sql_file) as f:
+        if sql_file.endswith((".rows", ".rows.gz")):
+            return json.loads(f.readline()).get('ddl', [])
+        ddl = []
+        for statement in statements(f):
+            if not statement.lstrip().upper().startswith("CREATE"):
+                break
+            ddl.append(statement)
+        return ddl
+
+def read_partition(sql_file, partition):
+    """
+    Return the partition of sql_file, e.g. '2019-09' for 'month' or '2019'
+    for 'year', from the first date in one of the PARTITION_COLUMNS, or None
+    when partition is None or the file has no such date. The whole file goes
+    to that partition, so the parent rows of a report stay with their
+    children.
+    """
+    if partition is None:
+        return None
+    for value in read_dates(sql_file):
+        if isinstance(value, str) and DATE.match(value):
+            return value[:PARTITIONS[partition]]
+    return None
+
+def read_dates(sql_file):
+    """
+    Yield the values of the first of the PARTITION_COLUMNS of every table
+    in sql_file that has one, reading no further than the caller does.
+    """
+    with open_file(sql_file) as f:
+        if sql_file.endswith((".rows", ".rows.gz")):
+            for line in f:
+                record = json.loads(line)
+                column = partition_column(record.get('columns', []))
+                if column is not None:
+                    for row in record['rows']:
+                        yield row[column]
+            return
+        for statement in statements(f):
+            m = INSERT.match(statement)
+            if m is None:
+                continue
+            column = partition_column([c.strip() for c in m.group(2).split(",")])
+            if column is not None:
+                # values are numbers or "quoted", see quote_identifier
+                values = next(csv.reader([m.group(3)], skipinitialspace=True))
+                yield values[column]
+
+def partition_column(columns):
+    for c in PARTITION_COLUMNS:
+        if c in columns:
+            return list(columns).index(c)
+    return None
+
+def compatible(known, fingerprint):
+    """
+    Return whether a table of a file, with fingerprint, can be loaded into
+    a shard whose table has the known fingerprint: the shard does not have
+    the table (known is None), or it has the same key and all the columns
+    of the file.
+    """
+    if known is None:
+        return True
+    return known["key"] == fingerprint["key"] and set(fingerprint["columns"]) <= set(known["columns"])
+
+def table_fingerprints(ddl):
+    """
+    Return {table : fingerprint} for the create table statements ddl, see
+    `table_fingerprint`.
+    """
+    return dict(table_fingerprint(statement.strip()) for statement in ddl)
+
+@functools.lru_cache(maxsize=1024)
+def table_fingerprint(create_table):
+    """
+    Return (table, fingerprint) for a create table statement, see
+    `schema_fingerprint`.
+    """
+    cnx = sqlite3.connect(":memory:")
+    try:
+        cnx.execute(create_table)
+        (table,) = cnx.execute("SELECT name FROM sqlite_master WHERE type='table'").fetchone()
+        return (table, schema_fingerprint(cnx, table))
+    finally:
+        cnx.close()
+
+def db_fingerprints(db_path):
+    """
+    Return {table : fingerprint} for the tables of the db at db_path.
+    """
+    cnx = sqlite3.connect(db_path)
+    try:
+        # sqlite_stat1 and the like are not part of the schema, see `finish`
+        tables = [t for (t,) in cnx.execute("SELECT name FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%'")]
+        return dict([(t, schema_fingerprint(cnx, t)) for t in tables])
+    finally:
+        cnx.close()
+
+def schema_fingerprint(cnx, table):
+    """
+    Return the fingerprint of table as sqlite sees it, so it does not
+    depend on the order of the columns or on formatting:
+
+        {"key": hash of the primary key and foreign keys, "columns": [names]}
+
+    see `compatible`.
+    """
+    info = list(cnx.execute("PRAGMA table_info(%s)" % table))
+    primary_key = [name for (pk, name) in sorted([(pk, name) for (cid, name, ctype, notnull, dflt, pk) in info if pk > 0])]
+    foreign_keys = sorted([(row[2], row[3], row[4]) for row in cnx.execute("PRAGMA foreign_key_list(%s)" % table)])
+    return {
+            "key"       : hashlib.blake2b(repr((primary_key, foreign_keys)).encode('utf-8'), digest_size=8).hexdigest(),
+            "columns"   : sorted([row[1] for row in info]),
+            }
+
+def insert_statement(table, columns):
+    """
+    Return the parameterized insert statement for table and columns, which
+    are sanitized names, see `xmlparser.XML2SQLTransormer.insert_values`.
+    """
+    return "INSERT OR IGNORE INTO {table} ({columns}) VALUES ({params});".format(
+            table=table, columns=", ".join(columns), params=", ".join(["?"] * len(columns)))
+
+def load_record(cnx, record):
+    """
+    Load one record of the 'rows' format into cnx, see `load_rows`. Return
+    the number of rows.
+    """
+    if 'ddl' in record:
+        for ddl in record['ddl']:
+            cnx.execute(ddl)
+        return 0
+    cnx.executemany(insert_statement(record['table'], record['columns']), record['rows'])
+    return len(record['rows'])
+
+def load_rows(cnx, f):
+    """
+    Load the open 'rows' file f into cnx. The 'rows' format is json lines,
+    a first line with the create table statements:
+
+        {"ddl": ["CREATE TABLE IF NOT EXISTS ...", ...]}
+
+    and then batches of rows for a table, loaded with executemany:
+
+        {"table": "report_data", "columns": ["id", ...], "rows": [["...", ...], ...]}
+
+    Return the number of rows.
+    """
+    rows = 0
+    for line in f:
+        rows += load_record(cnx, json.loads(line))
+    return rows
+
+def open_file(sql_file):
+    """
+    Open sql_file for reading as text, .gz files are decompressed on the
+    fly, so they are never in memory as a whole either.
+    """
+    if sql_file.endswith(".gz"):
+        return gzip.open(sql_file, 'rt')
+    return open(sql_file, 'r')
+
+def load_sql(cnx, f):
+    """
+    Execute the statements of the open sql file f one at a time, in the
+    transaction of cnx, unlike executescript which commits first. Return
+    the number of statements.
+    """
+    count = 0
+    for statement in statements(f):
+        cnx.execute(statement)
+        count += 1
+    return count
+
+def statements(f):
+    """
+    Yield the statements of the open sql file f. The file is read a line
+    at a time, so only the current statement is in memory.
+    """
+    lines = []
+    for line in f:
+        lines.append(line)
+        # a statement can only end on a line with a semicolon, so
+        # statements over many lines are not scanned again for every line
+        if ';' not in line:
+            continue
+        statement = "".join(lines)
+        if sqlite3.complete_statement(statement):
+            yield statement
+            lines = []
+    statement = "".join(lines)
+    if statement.strip():
+        # the last statement may lack its semicolon
+        yield statement
+
+def gen_db_name(resource_name, depth, partition=None):
+    if partition is None:
+        return "%s_%02d.db" % (resource_name, depth)
+    return "%s_%s_%02d.db" % (resource_name, partition, depth)
+
+def gen_index_name(table, columns):
+    return "ix_%s_%s" % (table, "_".join(columns))
 
-def gen_db_name(resource_name, depth):
-    return "%s_%02d.db" % (resource_name, depth)
+def gen_catalog_name(resource_name):
+    return "%s_catalog.db" % resource_name
@@ -0,0 +1,260 @@
+# edl : common library for the energy-dashboard tool-chain
+# Copyright (C) 2019  Todd Greenwood-Geer (Enviro Software Solutions, LLC)
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+"""
+pipeline.py : stream files through the download, unzip, parse and insert
+stages
+
+Running the stage scripts (src/10_down.py ... src/40_inse.py) one after the
+other means every zip is downloaded before the first one is unzipped, and
+so on. The pipeline runs the same stage generators concurrently, connected
+by bounded queues, so a file flows through all stages as soon as it lands.
+
+Each stage still appends to its own state file as items complete, exactly
+like the stage scripts do, so a crashed pipeline resumes where it left off
+either as a pipeline or with the stage scripts.
+
+Run from a feed directory:
+
+    $ python -m edl.resources.pipeline [loglevel]
+"""
+
+from edl.resources import db
+from edl.resources import filesystem
+from edl.resources import log
+from edl.resources import state
+from edl.resources import time as xtime
+from edl.resources import web
+from edl.resources import xmlparser
+from edl.resources import zp
+import datetime
+import json
+import logging
+import os
+import queue
+import sys
+import threading
+import zipfile as zf
+
+QUEUE_SIZE = 64
+"""max items waiting between two stages"""
+
+_DONE = object()
+"""end of stream marker"""
+
+class Stage():
+    """
+    A pipeline stage: runs `func(items)`, a stage generator like
+    `zp.unzip`, on its own thread. Every item the generator yields is
+    appended to the state_file and mapped by `downstream(item)` onto the
+    input of the next stage.
+
+    seed    : items that are waiting from earlier runs, processed first
+    """
+    def __init__(self, logger, name, func, state_file, downstream=None, seed=None, queue_size=QUEUE_SIZE):
+        self.logger     = logger
+        self.name       = name
+        self.func       = func
+        self.state_file = state_file
+        self.downstream = downstream
+        self.seed       = seed or []
+        self.queue      = queue.Queue(maxsize=queue_size)
+        self.next       = None
+        self.error      = None
+        self.count      = 0
+        self.seen       = set()
+        self.drained    = False
+        """whether the end of stream marker of the input was read"""
+        self.thread     = threading.Thread(target=self.run, name=name, daemon=True)
+
+    def put(self, item):
+        """Queue an item for this stage, unless it was queued already."""
+        if item in self.seen:
+            return
+        self.seen.add(item)
+        self.queue.put(item)
+
+    def close(self):
+        self.queue.put(_DONE)
+
+    def items(self):
+        for item in self.seed:
+            if item not in self.seen:
+                self.seen.add(item)
+                yield item
+        while True:
+            item = self.queue.get()
+            if item is _DONE:
+                self.drained = True
+                return
+            yield item
+
+    def run(self):
+        try:
+            for item in self.func(self.items()):
+                with open(self.state_file, "a") as f:
+                    f.write("%s\n" % item)
+                self.count += 1
+                if self.next is not None and self.downstream is not None:
+                    for next_item in self.downstream(item):
+                        self.next.put(next_item)
+        except Exception as e:
+            self.error = e
+            log.error(self.logger, {
+                "name"      : __name__,
+                "method"    : "Stage.run",
+                "stage"     : self.name,
+                "ERROR"     : "stage failed, draining its input",
+                "exception" : str(e),
+                })
+            # keep consuming so that upstream stages are not blocked on a
+            # full queue, until the input ended, e.g. when the stage failed
+            # while it wrapped up, or the reader thread of a `Window.feed`
+            # the stage left behind took the end of stream marker
+            while not self.drained:
+                try:
+                    if self.queue.get(timeout=1) is _DONE:
+                        self.drained = True
+                except queue.Empty:
+                    pass
+        finally:
+            if self.next is not None:
+                self.next.close()
+
+def url2zip(line):
+    """download state line -> zip file name"""
+    return [filesystem.url2filename(line.split("\t")[0], ending=".zip")]
+
+def zip2xml(zip_dir):
+    """unzipped zip file name -> xml file names"""
+    def members(zip_file):
+        if not zip_file:
+            return []
+        with zf.ZipFile(os.path.join(zip_dir, zip_file), 'r') as z:
+            return [m for m in z.namelist() if m.lower().endswith(".xml")]
+    return members
+
+def xml2sql(output_format):
+    """parsed xml file name -> sql or rows file name, see `xmlparser.OUTPUT_FORMATS`"""
+    def output(xml_file):
+        return ["%s%s" % (os.path.splitext(xml_file)[0], xmlparser.OUTPUT_FORMATS[output_format])]
+    return output
+
+def config(feed_dir):
+    """
+    Same directories and state files as the stage scripts in src/.
+    """
+    dirs = dict([(d, os.path.join(feed_dir, d)) for d in ['zip', 'xml', 'sql', 'db']])
+    return {
+            "dirs"          : dirs,
+            "state_files"   : dict([(d, os.path.join(p, "state.txt")) for (d, p) in dirs.items()]),
+            "schema_file"   : os.path.join(feed_dir, "schema.json"),
+            }
+
+def run(logger, manifest, config, queue_size=QUEUE_SIZE):
+    """
+    Run the download, unzip, parse and insert stages concurrently. With
+    the manifest option 'parse_from_zip' there is no unzip stage, see
+    `xmlparser.parse_zip`.
+
+    Return {stage name : items processed}.
+    """
+    chlogger        = logger.getChild(__name__)
+    resource_name   = manifest['name']
+    dirs            = config['dirs']
+    state_files     = config['state_files']
+    for d in dirs.values():
+        if not os.path.exists(d):
+            os.makedirs(d)
+
+    start_date      = datetime.date(*manifest['start_date'])
+    dates           = xtime.range_pairs(xtime.day_range_to_today(start_date))
+    urls            = list(web.generate_urls(logger, dates, manifest['url']))
+    streaming       = manifest.get('parse_streaming', False)
+    schema_file     = config['schema_file'] if manifest.get('parse_schema_cache', True) else None
+    output_format   = manifest.get('parse_format', xmlparser.OUTPUT_FORMAT)
+    validation      = manifest.get('parse_validation', xmlparser.VALIDATION)
+    parse_workers   = manifest.get('parse_workers', xmlparser.PARSE_WORKERS)
+    key_mode        = manifest.get('parse_key_mode', xmlparser.KEY_MODE)
+
+    download = Stage(chlogger, "download",
+            lambda items: web.download(logger, resource_name, manifest['download_delay_secs'], items, state_files['zip'], dirs['zip'],
+                workers=manifest.get('download_workers', web.DOWNLOAD_WORKERS),
+                refresh=manifest.get('download_refresh', False)),
+            state_files['zip'], downstream=url2zip, seed=urls, queue_size=queue_size)
+    if manifest.get('parse_from_zip', False):
+        # no unzip stage, parse reads the xml straight out of the zip files
+        xml_dir = dirs['xml'] if manifest.get('extract_xml', False) else None
+        processed = state.processed_files(state_files['sql'])
+        extract = []
+        parse = Stage(chlogger, "parse",
+            lambda items: xmlparser.parse_zip(logger, resource_name, items, dirs['zip'], dirs['sql'], processed=processed, xml_dir=xml_dir, streaming=streaming, schema_file=schema_file, output_format=output_format, validation=validation, key_mode=key_mode),
+            state_files['sql'], downstream=xml2sql(output_format),
+            seed=sorted(filesystem.glob_dir(dirs['zip'], '.zip')), queue_size=queue_size)
+    else:
+        extract = [Stage(chlogger, "unzip",
+            lambda items: zp.unzip(resource_name, items, dirs['zip'], dirs['xml'], workers=manifest.get('unzip_workers', zp.UNZIP_WORKERS)),
+            state_files['xml'], downstream=zip2xml(dirs['zip']),
+            seed=sorted(state.new_files(resource_name, state_files['xml'], dirs['zip'], '.zip')), queue_size=queue_size)]
+        parse = Stage(chlogger, "parse",
+            lambda items: xmlparser.parse(logger, resource_name, items, dirs['xml'], dirs['sql'], streaming, schema_file, output_format, validation, parse_workers, key_mode),
+            state_files['sql'], downstream=xml2sql(output_format),
+            seed=sorted(state.new_files(resource_name, state_files['sql'], dirs['xml'], '.xml')), queue_size=queue_size)
+    insert = Stage(chlogger, "insert",
+            lambda items: db.insert(logger, resource_name, dirs['sql'], dirs['db'], items, manifest.get('insert_engine', db.DB_ENGINE),
+                manifest.get('insert_batch_files', db.BATCH_FILES), manifest.get('insert_batch_rows', db.BATCH_ROWS),
+                manifest.get('insert_partition'), manifest.get('insert_mode', db.INSERT_MODE), manifest.get('insert_indexes'),
+                manifest.get('insert_workers', db.INSERT_WORKERS)),
+            state_files['db'],
+            seed=sorted([f for ending in db.ENDINGS for f in state.new_files(resource_name, state_files['db'], dirs['sql'], ending)]), queue_size=queue_size)
+    stages = [download] + extract + [parse, insert]
+    for (stage, next_stage) in zip(stages, stages[1:]):
+        stage.next = next_stage
+    # the download stage has no upstream, its only input is the seed
+    stages[0].close()
+    for stage in stages:
+        stage.thread.start()
+    for stage in stages:
+        stage.thread.join()
+    counts = dict([(stage.name, stage.count) for stage in stages])
+    log.info(chlogger, {
+        "name"      : __name__,
+        "method"    : "run",
+        "resource"  : resource_name,
+        "counts"    : counts,
+        })
+    failed = [stage for stage in stages if stage.error is not None]
+    if failed:
+        raise failed[0].error
+    return counts
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        loglevel = sys.argv[1]
+    else:
+        loglevel = "INFO"
+    log.configure_logging()
+    logger = logging.getLogger(__name__)
+    logger.setLevel(loglevel)
+    log.debug(logger, {
+        "name"      : __name__,
+        "method"    : "main",
+        "src"       : "pipeline.py"
+        })
+    with open('manifest.json', 'r') as json_file:
+        m = json.load(json_file)
+        run(logger, m, config(os.path.abspath(os.path.curdir)))
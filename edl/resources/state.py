@@ -23,15 +23,19 @@ def update(generator, state_file):
         with open(state_file, "a") as f:
             f.write("%s\n" % item)
 
+def processed_files(state_file):
+    """Return the set of items in the state file"""
+    if not os.path.exists(state_file):
+        return set()
+    with open(state_file, 'r') as m:
+        return set([l.lstrip().rstrip() for l in m])
+
 def new_files(resource_name, state_file, path, ending):
     """Return a list of files that are not present in the state file""" 
-    processed_file_set = set()
     logging.info({
         "src":resource_name, 
         "action":"new_%s_files" % ending})
-    if os.path.exists(state_file):
-        with open(state_file, 'r') as m:
-            processed_file_set = set([l.lstrip().rstrip() for l in m])
+    processed_file_set = processed_files(state_file)
     existing_file_set = set(filesystem.glob_dir(path, ending))
     new_file_set = existing_file_set - processed_file_set
     logging.info({
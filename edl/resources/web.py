@@ -18,16 +18,78 @@
 web.py : download resources from a URL
 """
 
+from concurrent.futures import ThreadPoolExecutor
 from edl.resources import filesystem
 from edl.resources import log
+from edl.resources.window import Window
+from email.utils import formatdate
+from enum import Enum
 from stat import S_IREAD, S_IRGRP, S_IROTH
+from urllib.parse import urlparse
+import heapq
+import itertools
 import logging
 import os
 import pdb
+import random
 import requests
+import threading
 import time
 import traceback
 
+DOWNLOAD_WORKERS = 4
+"""default number of concurrent downloads, see `download`"""
+
+DOWNLOAD_DELAY = 5.0
+"""seconds between requests to the same host that the upstream servers
+ask for, e.g. OASIS, the usual 'download_delay_secs' of a feed"""
+
+CHUNK_SIZE = 1024 * 1024
+"""bytes per write when streaming a response body to disk"""
+
+PART_SUFFIX = ".part"
+"""suffix of the temp file a download streams into before it is renamed"""
+
+TIMEOUT = (30, 300)
+"""(connect, read) timeout in seconds for every request"""
+
+VALIDATORS = ["etag", "last_modified", "size"]
+"""validators recorded next to each url in the download state file"""
+
+READ_ONLY = S_IREAD|S_IRGRP|S_IROTH
+
+THROTTLE_CODES = set([429, 503])
+"""status codes that mean we are going too fast, see `classify`"""
+
+THROTTLE_DELAY = 2.0
+"""delay in seconds per host after the first throttle response"""
+
+MAX_DELAY = 300.0
+"""cap on the per-host delay and on the retry backoff"""
+
+MAX_ATTEMPTS = 5
+"""attempts per url in one run before it is left for the next run"""
+
+TRANSIENT_ERRORS = (
+        requests.exceptions.ConnectionError,
+        requests.exceptions.Timeout,
+        requests.exceptions.ChunkedEncodingError)
+"""exceptions worth retrying, see `classify`"""
+
+class Outcome(Enum):
+    """
+    What happened to a download attempt, see `classify`.
+    """
+    DOWNLOADED      = 1
+    NOT_MODIFIED    = 2
+    THROTTLED       = 3
+    TRANSIENT       = 4
+    PERMANENT       = 5
+    ERROR           = 6
+
+_local = threading.local()
+
+
 def generate_urls(logger, date_pairs, url_template, date_format="%Y%m%d"):
     """
     Generate download urls for the provided date_pairs.
@@ -55,60 +117,390 @@ def generate_urls(logger, date_pairs, url_template, date_format="%Y%m%d"):
 
 
 
-def download(logger, resource_name, delay, urls, state_file, path, ending=".zip"):
+class TokenBucket():
     """
+    Token bucket rate limiter: `rate` tokens per second accrue up to
+    `capacity`, and every request spends one token.
+    """
+    def __init__(self, rate, capacity=1):
+        self.rate       = rate
+        self.capacity   = capacity
+        self.tokens     = capacity
+        self.last       = time.monotonic()
+        self.lock       = threading.Lock()
+
+    def acquire(self):
+        """Block until a token is available, then spend it."""
+        while True:
+            with self.lock:
+                now         = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+                self.last   = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_secs = (1 - self.tokens) / self.rate
+            time.sleep(wait_secs)
+
+class RateLimiter():
+    """
+    Per-host request rate limiter. Each host gets its own TokenBucket that
+    allows one request every `delay` seconds, which is how the feeds express
+    the expected use requirements of the upstream servers.
+
+    When a server throttles us the delay for every host is doubled, and it
+    creeps back to the configured delay as requests succeed again.
+    """
+    def __init__(self, delay):
+        self.base_delay = delay or 0
+        self.delay      = delay or 0
+        self.buckets    = {}
+        self.lock       = threading.Lock()
+
+    def acquire(self, url):
+        if self.delay <= 0:
+            return
+        host = urlparse(url).netloc
+        with self.lock:
+            if host not in self.buckets:
+                self.buckets[host] = TokenBucket(1.0 / self.delay)
+            bucket = self.buckets[host]
+        bucket.acquire()
+
+    def slow_down(self):
+        with self.lock:
+            self.delay = min(MAX_DELAY, 2 * max(self.delay, THROTTLE_DELAY / 2))
+            self._set_rate()
+
+    def speed_up(self):
+        with self.lock:
+            if self.delay <= self.base_delay:
+                return
+            self.delay = max(self.base_delay, 0.9 * self.delay)
+            if self.delay < THROTTLE_DELAY / 2 and self.base_delay == 0:
+                self.delay = 0
+            self._set_rate()
+
+    def _set_rate(self):
+        for bucket in self.buckets.values():
+            if self.delay > 0:
+                bucket.rate = 1.0 / self.delay
+
+def session():
+    """
+    Return the requests.Session for the calling thread. Sessions pool their
+    connections, so consecutive requests to a host reuse the same keep-alive
+    TCP/TLS connection instead of a new handshake per file.
+    """
+    s = getattr(_local, 'session', None)
+    if s is None:
+        s = _local.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=4)
+        s.mount('http://', adapter)
+        s.mount('https://', adapter)
+    return s
+
+def read_state(state_file):
+    """
+    Return {url : validators} for a download state file.
+
+    Each line holds a url, optionally followed by the tab separated
+    validators of the downloaded file: etag, last_modified and size. When a
+    url appears more than once the last line wins.
+    """
+    state = {}
+    if os.path.exists(state_file):
+        with open(state_file, "r") as f:
+            for line in f:
+                fields = line.rstrip("\n").split("\t")
+                if not fields[0]:
+                    continue
+                fields.extend([""] * (len(VALIDATORS) + 1 - len(fields)))
+                state[fields[0].rstrip()] = dict(zip(VALIDATORS, fields[1:]))
+    return state
+
+def state_line(url, validators=None):
+    """
+    Format a download state file entry, see `read_state`.
+    """
+    if not validators:
+        return url
+    return "\t".join([url] + [str(validators.get(v) or "") for v in VALIDATORS])
+
+def local_validators(target_file):
+    """
+    Validators for a file that was downloaded without recording any, based
+    on its modification time, so a conditional request can still be made.
+    """
+    if not os.path.exists(target_file):
+        return None
+    return {"last_modified": formatdate(os.path.getmtime(target_file), usegmt=True)}
+
+def fetch(url, target_file, chunk_size=CHUNK_SIZE, validators=None):
+    """
+    Stream url to target_file in chunk_size writes.
+
+    The body goes to a temp file which is renamed over target_file only once
+    it is complete, so an interrupted download never leaves a truncated file
+    behind that later looks like a finished one. If a temp file is left over
+    from an earlier attempt, the download resumes from its end with a Range
+    request, guarded by If-Range so that a changed resource starts over.
+    When the server does not honour that range with a 206 for it, e.g. a
+    416 because the temp file is complete already, the temp file is
+    dropped and the download starts over from zero right away.
+
+    validators  : etag/last_modified of the copy we already have. When given
+                  the request is conditional, and 304 means nothing changed.
+
+    Return (http status code, validators of the response).
+    """
+    part_file   = target_file + PART_SUFFIX
+    meta_file   = part_file + ".meta"
+    headers     = {}
+    offset      = 0
+    if validators:
+        if validators.get("etag"):
+            headers["If-None-Match"] = validators["etag"]
+        if validators.get("last_modified"):
+            headers["If-Modified-Since"] = validators["last_modified"]
+    if os.path.exists(part_file) and os.path.exists(meta_file):
+        with open(meta_file, 'r') as f:
+            part_validator = f.read().strip()
+        offset = os.path.getsize(part_file)
+        if offset > 0 and part_validator:
+            headers["Range"]    = "bytes=%d-" % offset
+            headers["If-Range"] = part_validator
+    with session().get(url, headers=headers, stream=True, timeout=TIMEOUT) as r:
+        received = {
+                "etag"          : r.headers.get("ETag"),
+                "last_modified" : r.headers.get("Last-Modified"),
+                }
+        restart = False
+        if r.status_code == 206 and "Range" in headers and r.headers.get("Content-Range", "").startswith("bytes %d-" % offset):
+            mode = 'ab'
+        elif r.status_code == 200:
+            mode = 'wb'
+        elif r.status_code in (206, 416) and "Range" in headers:
+            # our partial file does not match the resource, e.g. it is
+            # complete already, or the server sent another range
+            restart = True
+        else:
+            return (r.status_code, validators if r.status_code == 304 else received)
+        if not restart:
+            part_validator = received["etag"] or received["last_modified"]
+            if mode == 'wb':
+                if part_validator:
+                    with open(meta_file, 'w') as f:
+                        f.write(part_validator)
+                elif os.path.exists(meta_file):
+                    os.remove(meta_file)
+            with open(part_file, mode) as fd:
+                for chunk in r.iter_content(chunk_size=chunk_size):
+                    fd.write(chunk)
+            received["size"] = os.path.getsize(part_file)
+            os.replace(part_file, target_file)
+            if os.path.exists(meta_file):
+                os.remove(meta_file)
+            return (200, received)
+    # start over from zero, without a Range, so this can not loop
+    for f in [part_file, meta_file]:
+        if os.path.exists(f):
+            os.remove(f)
+    return fetch(url, target_file, chunk_size, validators)
+
+def protect(path, ending):
+    """
+    Make all files matching ending in path read only.
+
+    New downloads are protected as they are written, this catches files that
+    were written by older versions or copied into place by hand.
+    """
+    for f in filesystem.glob_dir(path, ending):
+        os.chmod(os.path.join(path, f), READ_ONLY)
+
+def download_file(limiter, url, target_file, validators=None):
+    """
+    Download a single url to a read only target_file once the limiter
+    allows it.
+
+    Return (http status code, validators), see `fetch`.
+    """
+    limiter.acquire(url)
+    (status_code, validators) = fetch(url, target_file, validators=validators)
+    if status_code == 200:
+        os.chmod(target_file, READ_ONLY)
+    return (status_code, validators)
+
+def classify(status_code=None, exception=None):
+    """
+    Classify a download attempt by its http status code, or by the exception
+    it raised:
+
+        THROTTLED   : 429/503, back off and lower the request rate
+        TRANSIENT   : network errors, other 5xx and unexpected partial
+                      content, retry later in this run
+        PERMANENT   : other 4xx like 404/410, record in the failed ledger
+        ERROR       : a local failure (e.g. disk full), neither retried nor
+                      recorded
+    """
+    if exception is not None:
+        if isinstance(exception, TRANSIENT_ERRORS):
+            return Outcome.TRANSIENT
+        return Outcome.ERROR
+    if status_code == 200:
+        return Outcome.DOWNLOADED
+    if status_code == 304:
+        return Outcome.NOT_MODIFIED
+    if status_code in THROTTLE_CODES:
+        return Outcome.THROTTLED
+    if status_code in (206, 416) or status_code == 408 or status_code >= 500:
+        # 206/416 answer a range request we did not make, see `fetch`
+        return Outcome.TRANSIENT
+    return Outcome.PERMANENT
+
+def backoff(attempt):
+    """Seconds to wait before retry number `attempt`, with some jitter."""
+    return min(MAX_DELAY, THROTTLE_DELAY * (2 ** (attempt - 1))) * random.uniform(0.5, 1.0)
+
+def read_failed(failed_file):
+    """Return the set of urls in the failed ledger."""
+    if not os.path.exists(failed_file):
+        return set()
+    with open(failed_file, "r") as f:
+        return set([line.rstrip("\n").split("\t")[0] for line in f])
+
+def download(logger, resource_name, delay, urls, state_file, path, ending=".zip", workers=DOWNLOAD_WORKERS, refresh=False, sweep=True, failed_file=None):
+    """
+    Download urls concurrently and yield a state line (see `state_line`) for
+    each url once the file is on disk, so that `state.update` can append it
+    to the state_file.
+
+    Throttled and transient failures (see `classify`) are retried with an
+    exponential backoff, up to MAX_ATTEMPTS per run. Permanent failures are
+    appended to the failed_file ledger and are not requested again until
+    they are removed from it.
+
+    delay       : minimum seconds between requests to the same host
     urls        : list of urls to download
     state_file  : list of urls that have already been downloaded
     path        : path to write downloaded files to
+    workers     : number of concurrent downloads
+    refresh     : re-check urls in the state_file with conditional requests
+                  and download the ones that changed upstream
+    sweep       : make files already in path read only before starting,
+                  downloaded files are always made read only
+    failed_file : ledger of permanently failed urls, defaults to failed.txt
+                  next to the state_file
     """
     chlogger = logger.getChild(__name__)
-    downloaded = []
-    prev_downloaded = set()
-    if os.path.exists(state_file):
-        with open(state_file, "r") as f:
-            prev_downloaded = set([line.rstrip() for line in f])
+    prev_downloaded = read_state(state_file)
+    if failed_file is None:
+        failed_file = os.path.join(os.path.dirname(state_file), "failed.txt")
+    prev_failed = read_failed(failed_file)
+    if sweep:
+        # ensure that all files in the download directory are read only
+        protect(path, ending)
+
+    status  = {'manifest': 0, 'filesystem': 0, 'ledger': 0, 'downloaded': 0, 'not_modified': 0, 'retried': 0, 'throttled': 0, 'failed': 0, 'error': 0}
+    limiter = RateLimiter(delay)
+    window  = Window(workers)
+    retries = []
+    seq     = itertools.count()
+
+    def submit(job):
+        (url, filename, target_file, validators, attempt) = job
+        window.add(pool.submit(download_file, limiter, url, target_file, validators), job)
 
-    status = {'manifest': 0, 'filesystem': 0, 'downloaded': 0, 'error': 0}
+    def submit_ready():
+        while retries and retries[0][0] <= time.monotonic():
+            submit(heapq.heappop(retries)[2])
 
-    for url in urls:
-        try:
-            filename = filesystem.url2filename(url, ending=ending)
-            if url in prev_downloaded:
+    def retry(job, outcome):
+        (url, filename, target_file, validators, attempt) = job
+        if attempt >= MAX_ATTEMPTS:
+            log.error(chlogger, {"src":resource_name, "action":'download', "url":url, "file":filename, "attempt":attempt, "outcome":outcome.name, "ERROR":'retries exhausted, leaving url for the next run'})
+            status['error'] += 1
+            return
+        status['retried'] += 1
+        wait_secs = backoff(attempt)
+        log.warning(chlogger, {"src":resource_name, "action":'download', "url":url, "file":filename, "attempt":attempt, "outcome":outcome.name, "retry_in":wait_secs, "delay":limiter.delay})
+        heapq.heappush(retries, (time.monotonic() + wait_secs, next(seq), (url, filename, target_file, validators, attempt + 1)))
+
+    def next_retry():
+        return max(0, retries[0][0] - time.monotonic()) if retries else None
+
+    def completed(done):
+        for (future, job) in done:
+            (url, filename, target_file, validators, attempt) = job
+            status_code = None
+            try:
+                (status_code, received) = future.result()
+                outcome = classify(status_code)
+            except Exception as e:
+                outcome = classify(exception=e)
+                log.error(chlogger, {"src":resource_name, "action":'download', "url":url, "outcome":outcome.name, "ERROR": "http_request_failed", "exception" : str(e), "traceback": traceback.format_exc()})
+            if outcome == Outcome.DOWNLOADED:
+                status['downloaded'] += 1
+                limiter.speed_up()
+                log.debug(chlogger, {"src":resource_name, "action":'download', "url":url, "file":filename})
+                yield state_line(url, received)
+            elif outcome == Outcome.NOT_MODIFIED:
+                status['not_modified'] += 1
+                limiter.speed_up()
+                log.debug(chlogger, {"src":resource_name, "action":'skip_download', "url":url, "file":filename, "msg":'not modified upstream'})
+            elif outcome == Outcome.THROTTLED:
+                status['throttled'] += 1
+                limiter.slow_down()
+                retry(job, outcome)
+            elif outcome == Outcome.TRANSIENT:
+                retry(job, outcome)
+            elif outcome == Outcome.PERMANENT:
+                status['failed'] += 1
+                log.error(chlogger, {"src":resource_name, "action":'download', "url":url, "file":filename, "status_code":status_code, "failed_file":failed_file, "ERROR":'http_request_failed'})
+                with open(failed_file, "a") as f:
+                    f.write("%s\t%s\n" % (url, status_code))
+            else:
+                status['error'] += 1
+            log.info(chlogger, {                                        \
+                    "src"                   : resource_name,            \
+                    "action"                : 'download',               \
+                    "url"                   : url,                      \
+                    'skipped_in_manifest'   : status['manifest'],       \
+                    'skipped_in_filesystem' : status['filesystem'],     \
+                    'skipped_in_ledger'     : status['ledger'],         \
+                    'downloaded'            : status['downloaded'],     \
+                    'not_modified'          : status['not_modified'],   \
+                    'retried'               : status['retried'],        \
+                    'throttled'             : status['throttled'],      \
+                    'failed'                : status['failed'],         \
+                    'error'                 : status['error'],          \
+                    })
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for (url, done) in window.feed(urls, timeout=next_retry, more=lambda: bool(retries)):
+            yield from completed(done)
+            submit_ready()
+            if url is None:
+                continue
+            filename    = filesystem.url2filename(url, ending=ending)
+            target_file = os.path.join(path, filename)
+            validators  = None
+            if url in prev_failed:
+                log.debug(chlogger, {"src":resource_name, "action":'skip_download', "url":url, "file":filename, "msg":'url exists in failed ledger'})
+                status['ledger'] += 1
+                continue
+            elif url in prev_downloaded and refresh and os.path.exists(target_file):
+                validators = prev_downloaded[url]
+                if not (validators["etag"] or validators["last_modified"]):
+                    validators = local_validators(target_file)
+            elif url in prev_downloaded and not refresh:
                 log.debug(chlogger, {"src":resource_name, "action":'skip_download', "url":url, "file":filename, "msg":'url exists in download manifest'})
                 status['manifest'] += 1
                 continue
-            target_file = os.path.join(path, filename)
-            if os.path.exists(target_file):
+            elif os.path.exists(target_file):
                 log.debug(chlogger, {"src":resource_name, "action":'skip_download', "url":url, "file":filename, "msg":'file exists locally, updating manifest'})
                 # update the state_file with files that were found on disk
-                downloaded.append(url)
                 status['filesystem'] += 1
+                yield url
                 continue
-            r = requests.get(url)
-            if r.status_code == 200:
-                with open(target_file, 'wb') as fd:
-                    for chunk in r.iter_content(chunk_size=128):
-                        fd.write(chunk)
-                downloaded.append(url)
-                status['downloaded'] += 1
-                log.debug(chlogger, {"src":resource_name, "action":'download', "url":url, "file":filename})
-            else:
-                log.error(chlogger, {"src":resource_name, "action":'download', "url":url, "file":filename, "status_code":r.status_code, "ERROR":'http_request_failed'})
-        except Exception as e:
-            log.error(chlogger, {"src":resource_name, "action":'download', "url":url, "ERROR": "http_request_failed", "exception" : str(e), "traceback": str(tb = traceback.format_exc())})
-            status['error'] += 1
-        # TODO: this is such a hack
-        time.sleep(delay)
-        # ensure that all files in the download directery are read only
-        for f in filesystem.glob_dir(path, ending):
-            os.chmod(os.path.join(path, f), S_IREAD|S_IRGRP|S_IROTH)
-        log.info(chlogger, {                                        \
-                "src"                   : resource_name,            \
-                "action"                : 'download',               \
-                "url"                   : url,                      \
-                'skipped_in_manifest'   : status['manifest'],       \
-                'skipped_in_filesystem' : status['filesystem'],     \
-                'downloaded'            : status['downloaded'],     \
-                'error'                 : status['error'],          \
-                })
-    return downloaded
+            submit((url, filename, target_file, validators, 1))
@@ -0,0 +1,151 @@
+# edl : common library for the energy-dashboard tool-chain
+# Copyright (C) 2019  Todd Greenwood-Geer (Enviro Software Solutions, LLC)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+window.py : a bounded window of futures, for the stage generators that
+hand their items to a pool (`web.download`, `zp.unzip`, `xmlparser.parse`
+and `db.insert`)
+"""
+
+from concurrent.futures import wait, FIRST_COMPLETED
+import queue
+import threading
+import time
+
+_ITEM   = object()
+_WAKE   = object()
+_END    = object()
+_ERROR  = object()
+"""kinds of the events of `Window.feed`"""
+
+class Window():
+    """
+    The futures in flight in a pool, with the job each one runs. At most
+    2 * workers of them are in flight, so the pool always has work queued,
+    while a stream of items is not read far ahead of the workers.
+    """
+    def __init__(self, workers):
+        self.limit      = 2 * workers
+        self.inflight   = {}
+        """future -> job"""
+        self.exhausted  = False
+        """whether the items of `feed` ran out"""
+        self.events     = queue.Queue()
+
+    def __len__(self):
+        return len(self.inflight)
+
+    def add(self, future, job):
+        self.inflight[future] = job
+        future.add_done_callback(lambda future: self.events.put((_WAKE, None)))
+
+    def jobs(self):
+        return list(self.inflight.values())
+
+    def full(self):
+        return len(self.inflight) >= self.limit
+
+    def completed(self):
+        """
+        Remove the futures that are done, and return [(future, job)] of them.
+        """
+        return [(future, self.inflight.pop(future)) for future in [future for future in self.inflight if future.done()]]
+
+    def wait(self, timeout=None):
+        """
+        Wait until a future is done, or for timeout seconds, and return
+        `completed`.
+        """
+        if self.inflight:
+            wait(self.inflight, timeout=timeout, return_when=FIRST_COMPLETED)
+        elif timeout:
+            time.sleep(timeout)
+        return self.completed()
+
+    def wait_all(self):
+        """
+        Wait until all the futures are done, and return `completed`.
+        """
+        wait(self.inflight)
+        return self.completed()
+
+    def feed(self, items, timeout=lambda: None, more=lambda: False):
+        """
+        Yield (item, []) for every item of items, and (None, done) with the
+        [(future, job)] that are done, see `completed`, as soon as they
+        come. Items are read on a thread of their own, so futures that
+        complete while the next item is not there yet are reported right
+        away, e.g. when items are the output of another pipeline stage.
+
+        The caller adds the futures of the items with `add`. No item is read
+        while the window is `full`. The feed ends once items ran out and no
+        future is left in flight, unless more() says that the caller still
+        has jobs to add.
+
+        timeout : seconds until the caller wants (None, []) to add jobs
+                  that are due, or None
+        """
+        items       = iter(items)
+        wanted      = threading.Semaphore(0)
+        closed      = threading.Event()
+        def read():
+            try:
+                while True:
+                    wanted.acquire()
+                    if closed.is_set():
+                        return
+                    try:
+                        item = next(items)
+                    except StopIteration:
+                        self.events.put((_END, None))
+                        return
+                    self.events.put((_ITEM, item))
+            except Exception as e:
+                self.events.put((_ERROR, e))
+        threading.Thread(target=read, daemon=True).start()
+        requested = False
+        try:
+            while True:
+                done = self.completed()
+                if done:
+                    yield (None, done)
+                    continue
+                if self.exhausted or self.full():
+                    if self.exhausted and not self.inflight and not more():
+                        return
+                    yield (None, self.wait(timeout()))
+                    continue
+                if not requested:
+                    wanted.release()
+                    requested = True
+                try:
+                    (kind, value) = self.events.get(timeout=timeout())
+                except queue.Empty:
+                    yield (None, [])
+                    continue
+                if kind is _WAKE:
+                    continue
+                requested = False
+                if kind is _ITEM:
+                    yield (value, [])
+                elif kind is _END:
+                    self.exhausted = True
+                else:
+                    raise value
+        finally:
+            # let the reader go, unless it waits for an item
+            closed.set()
+            wanted.release()
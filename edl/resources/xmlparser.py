@@ -17,10 +17,14 @@
 
 import base64
 import traceback
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from enum import Enum
 import codecs
 import datetime as dt
 import fileinput
+import functools
+import hashlib
 import json
 import logging
 import os
@@ -29,13 +33,51 @@ import pprint
 import re
 import sys
 import uuid
+import zipfile as zf
+from xml.parsers import expat
 #import xmltodict
+from edl.resources import db
 from edl.resources import log
+from edl.resources.window import Window
 from edl.external import xmltodict
 import sqlite3
 
+OUTPUT_FORMATS = {"sql": ".sql", "rows": ".rows"}
+"""output formats of `transform` -> file ending, 'sql' is a script of
+insert statements, 'rows' has batches of parameters, see `db.load_rows`"""
+
+OUTPUT_FORMAT = "rows"
+"""default output format of `transform`"""
+
+BATCH_SIZE = 1000
+"""rows per batch in the 'rows' format"""
+
+VALIDATIONS = ["full", "sample", "off"]
+"""how `transform` checks its output, see Validator"""
+
+VALIDATION = "sample"
+"""default validation of `transform`"""
+
+SAMPLE_ROWS = 10
+"""rows per table checked by the 'sample' validation"""
+
+PARSE_WORKERS = 1
+"""default number of processes parsing files in parallel, see `parse`, a
+feed opts in with the 'parse_workers' manifest option"""
+
+KEY_MODES = ["uuid", "hash", "integer"]
+"""synthetic primary keys, see `XML2SQLTransormer.synthetic_id`"""
+
+KEY_MODE = "uuid"
+"""default synthetic primary keys"""
+
+SANITIZE_CACHE_SIZE = 4096
+"""identifiers and column lists remembered by `sanitize` and friends"""
+
+UNSAFE_IDENTIFIER = re.compile('[^a-zA-Z0-9_]')
+
 class Walker(object):
-    def __init__(self, logger, dict_handler_func=None, list_handler_func=None, item_handler_func=None):
+    def __init__(self, logger, dict_handler_func=None, list_handler_func=None, item_handler_func=None, is_table_func=None, tables=None):
         def default_dict_handler_func(stack):
             pass
         def default_list_handler_func(stack):
@@ -46,26 +88,80 @@ class Walker(object):
         self.dict_handler_func = dict_handler_func or default_dict_handler_func
         self.list_handler_func = list_handler_func or default_list_handler_func
         self.item_handler_func = item_handler_func or default_item_handler_func
+        self.is_table_func = is_table_func
+        """is_table_func(name, obj) : whether a dict or list on the stack is a table"""
+        self.tables = tables if tables is not None else []
+        """positions of the tables in the stack, kept up to date while walking if is_table_func is set"""
 
     def walk(self, name, obj):
-        self._walk([(name, obj)])
+        self.walk_from([(name, obj)])
 
-    def _walk(self, stack):
+    def walk_from(self, stack):
         """
-        Walk object tree and inkoke handlers based on object type (dict, list, or item).
+        Walk object tree at the top of the stack and inkoke handlers based on
+        object type (dict, list, or item), the rest of the stack is the path
+        to it, and self.tables must hold its tables. Handlers are called on a
+        dict or list before its children.
+
+        The walk is not recursive, it updates the stack in place: handlers
+        get the same list every time, so must copy it to keep it. The stack
+        and self.tables are left as they were given.
         """
+        dict_handler_func = self.dict_handler_func
+        list_handler_func = self.list_handler_func
+        item_handler_func = self.item_handler_func
+        is_table_func = self.is_table_func
+        tables = self.tables
+        # iterators over the children of the dicts and lists on the stack
+        children = []
         (name, obj) = stack[-1]
+        if isinstance(obj, (dict, list)) and is_table_func is not None and is_table_func(name, obj):
+            tables.append(len(stack) - 1)
         if isinstance(obj, dict):
-            self.dict_handler_func(stack)
-            for k, v in obj.items():
-                self._walk(stack + [(k, v)])
+            dict_handler_func(stack)
+            children.append(iter(obj.items()))
         elif isinstance(obj, list):
-            self.list_handler_func(stack)
-            for idx, item in enumerate(obj):
-                self._walk(stack + [(idx, item)])
+            list_handler_func(stack)
+            children.append(enumerate(obj))
         else:
-            self.item_handler_func(stack)
-        stack.pop()
+            item_handler_func(stack)
+        while children:
+            for kv in children[-1]:
+                stack.append(kv)
+                obj = kv[1]
+                if isinstance(obj, dict):
+                    if is_table_func is not None and is_table_func(kv[0], obj):
+                        tables.append(len(stack) - 1)
+                    dict_handler_func(stack)
+                    children.append(iter(obj.items()))
+                    break
+                elif isinstance(obj, list):
+                    if is_table_func is not None and is_table_func(kv[0], obj):
+                        tables.append(len(stack) - 1)
+                    list_handler_func(stack)
+                    children.append(enumerate(obj))
+                    break
+                else:
+                    item_handler_func(stack)
+                    stack.pop()
+            else:
+                children.pop()
+                if tables and tables[-1] == len(stack) - 1:
+                    tables.pop()
+                if children:
+                    stack.pop()
+
+DIGITS = r'\d(?:_?\d)*'
+"""digits with single underscores between them, as in int() and float() strings"""
+
+SPACE = r'[^\S\x1c-\x1f]*'
+"""whitespace int() and float() strip, which is all of it but \\x1c-\\x1f"""
+
+INTEGER_PATTERN = re.compile(r'{s}[+-]?{d}{s}\Z'.format(s=SPACE, d=DIGITS))
+"""strings int() accepts"""
+
+REAL_PATTERN = re.compile(r'{s}[+-]?(?:(?:{d}(?:\.(?:{d})?)?|\.{d})(?:[eE][+-]?{d})?|[iI][nN][fF](?:[iI][nN][iI][tT][yY])?|[nN][aA][nN]){s}\Z'.format(s=SPACE, d=DIGITS))
+"""strings float() accepts"""
 
 class SqlTypeEnum(Enum):
     """
@@ -88,9 +184,20 @@ class SqlTypeEnum(Enum):
     def type_of(element):
         """
         Return the SqlType for the element.
+
+        Strings are classified with INTEGER_PATTERN and REAL_PATTERN, which
+        accept what int() and float() accept, without raising exceptions.
         """
         if element is None:
             return SqlTypeEnum.NULL
+        if isinstance(element, str):
+            # fast paths for plain numbers, e.g. '24', '-12.25'
+            digits = element[1:] if element[:1] == '-' else element
+            if digits.isdecimal() or INTEGER_PATTERN.match(element):
+                return SqlTypeEnum.INTEGER
+            if digits.replace('.', '', 1).isdecimal() or REAL_PATTERN.match(element):
+                return SqlTypeEnum.REAL
+            return SqlTypeEnum.TEXT
         try:
             int(element)
             return SqlTypeEnum.INTEGER
@@ -138,6 +245,48 @@ class Table(object):
     def __repr__(self):
         return "name: %s, columns: %s, parent: %s, " % (self.name, self.columns, self.parent)
 
+def get_kv(keys, obj):
+    """
+    Return (sorted keys, their values in obj), all keys must be in obj.
+    """
+    assert isinstance(obj, dict)
+    sortedkeys = sorted(keys)
+    for sk in sortedkeys:
+        if sk not in obj:
+            raise Exception("ERROR: sk: '%s' not in obj keys: '%s'" % (sk, obj.keys()))
+    values = [obj[k] for k in sortedkeys]
+    return (sortedkeys, values)
+
+@functools.lru_cache(maxsize=SANITIZE_CACHE_SIZE)
+def sanitize(s):
+    """
+    Sanitize a table or field name for sqlite. A feed only has a few dozen
+    names, so this is cached.
+    """
+    return UNSAFE_IDENTIFIER.sub('', s).lower()
+
+@functools.lru_cache(maxsize=SANITIZE_CACHE_SIZE)
+def sanitize_columns(parent, local_keys, parent_pk_keys):
+    """
+    Return the sanitized columns of a row as a tuple, the parent primary key
+    columns are prefixed with the parent table, see `XML2SQLTransormer.row`.
+    """
+    columns = [sanitize(k) for k in local_keys]
+    columns.extend(["%s_%s" % (sanitize(parent), sanitize(k)) for k in parent_pk_keys])
+    return tuple(columns)
+
+@functools.lru_cache(maxsize=SANITIZE_CACHE_SIZE)
+def insert_prefix(table, columns):
+    """
+    Return the insert statement for the sanitized table and columns, up to
+    the values.
+    """
+    return "INSERT OR IGNORE INTO {table} ({columns}) VALUES (".format(table=table, columns=", ".join(columns))
+
+class SchemaMismatch(Exception):
+    """document does not fit the schema given to XML2SQLTransormer.use_schema"""
+    pass
+
 class XML2SQLTransormer():
     """
     OASIS Reports have the following nested structure:
@@ -256,11 +405,21 @@ odict_keys(['DATA_ITEM', 'RESOURCE_NAME', 'OPR_DATE', 'INTERVAL_NUM', 'INTERVAL_
     """
     NULL_MIGRATION  = set([SqlTypeEnum.REAL, SqlTypeEnum.INTEGER, SqlTypeEnum.TEXT, SqlTypeEnum.BLOB]) 
     BLOB_MIGRATION  = set([SqlTypeEnum.REAL, SqlTypeEnum.INTEGER, SqlTypeEnum.TEXT]) 
-    def __init__(self, logger, xmlfile):
+    FINAL_TYPES     = set([SqlTypeEnum.REAL, SqlTypeEnum.TEXT])
+    """types that are never upgraded, so values of these columns are not classified"""
+    FITS            = {
+            SqlTypeEnum.INTEGER : set([SqlTypeEnum.NULL, SqlTypeEnum.INTEGER]),
+            SqlTypeEnum.REAL    : set([SqlTypeEnum.NULL, SqlTypeEnum.INTEGER, SqlTypeEnum.REAL]),
+            SqlTypeEnum.BLOB    : set([SqlTypeEnum.NULL, SqlTypeEnum.BLOB]),
+            }
+    """column type -> value types it holds without widening, TEXT holds anything, see `check_row`"""
+    def __init__(self, logger, xmlfile, key_mode=KEY_MODE):
         """
         Following 'Elegant Objects' style, constructor only sets vars. All
         work is delayed until needed.
         """
+        if key_mode not in KEY_MODES:
+            raise Exception("unknown key mode: '%s', expected one of %s" % (key_mode, KEY_MODES))
         self.logger             = logger
         """use log.info(self.logger, {})"""
 
@@ -270,63 +429,225 @@ odict_keys(['DATA_ITEM', 'RESOURCE_NAME', 'OPR_DATE', 'INTERVAL_NUM', 'INTERVAL_
         self.json               = None
         """json : json object (typically a dict) resulting from parsing the xmlfile object"""
 
-        self.sql_types          = {'id': SqlTypeEnum.TEXT}
+        self.sql_types          = {'id': SqlTypeEnum.INTEGER if key_mode == "integer" else SqlTypeEnum.TEXT}
         """sql_types : map : xml element name -> sqlite3 value type"""
 
+        self.key_mode           = key_mode
+        """key_mode : one of KEY_MODES, see `synthetic_id`"""
+
+        self.document_hash      = hashlib.blake2b(digest_size=32)
+        """document_hash : digest of the document, see `digest`"""
+
+        self.key_hash           = None
+        """key_hash : blake2b keyed with the document_hash, see `synthetic_id`"""
+
+        self.key_count          = 0
+        """key_count : synthetic ids assigned so far"""
+
         self.tables             = {}
         """tables : map : table name -> Table(), which are just table definitions for sql inserts"""
 
         self.root               = 'root'
         """root : name of the root node which is really the document root, for which no table is generated"""
 
+        self.table_path         = []
+        """table_path : positions of the tables in the stack being walked, see `walker`"""
+
+        self.table_names        = {}
+        """table_names : map : name -> whether a dict or list with that name is a table, see `is_table`"""
+
+        self.cached             = False
+        """cached : tables and sql_types come from `use_schema` instead of `scan_all`"""
+
     def parse(self):
         """
         Parse the loaded xmlfile and load into the self.json object.
         """
-        self.json = xmltodict.parse(self.xmlfile.read(), process_namespaces=True, strip_namespaces=True)
+        content = self.xmlfile.read()
+        self.digest(content)
+        self.json = xmltodict.parse(content, process_namespaces=True, strip_namespaces=True)
         if self.logger.isEnabledFor(logging.DEBUG):
             print(json.dumps(self.json, indent=4, sort_keys=True))
         # allow method chaining
         return self
 
+    def digest(self, content):
+        """
+        Add content, which is all or the next part of the document, to the
+        digest that the 'hash' and 'integer' keys are derived from.
+        """
+        if self.key_mode == "uuid":
+            return
+        if isinstance(content, str):
+            content = content.encode('utf-8')
+        self.document_hash.update(content)
+
+    def synthetic_id(self):
+        """
+        Return the next synthetic primary key, depending on the key_mode:
+
+        uuid        : a random uuid4 string
+        hash        : 16 hex digits of blake2b(document digest, row ordinal)
+        integer     : the same 8 bytes as a signed int64 (as a string), so
+                      'id' is an INTEGER PRIMARY KEY, i.e. the rowid
+
+        The 'hash' and 'integer' keys only depend on the document and the
+        order of its rows, so parsing a document again gives the same keys,
+        and INSERT OR IGNORE skips rows that were loaded already.
+        """
+        if self.key_mode == "uuid":
+            return str(uuid.uuid4())
+        if self.key_hash is None:
+            self.key_hash = hashlib.blake2b(digest_size=8, key=self.document_hash.digest())
+        self.key_count += 1
+        h = self.key_hash.copy()
+        h.update(self.key_count.to_bytes(8, 'big'))
+        if self.key_mode == "hash":
+            return h.hexdigest()
+        return str(int.from_bytes(h.digest(), 'big', signed=True))
+
     def scan_all(self):
         """
         Recursive scan to build the types, tables, and table relations.
         """
-        def handle_list_or_dict(stack):
-            (child_name, obj, parent_name, pobj) = self.find_parent_child_tables(stack)
-            if child_name == self.root:
-                return
-            if child_name not in self.tables:
-                self.tables[child_name] = Table(name=child_name, parent=parent_name)
-        def handle_item(stack):
-            (item_name, obj) = stack[-1]
-            if item_name not in self.sql_types:
-                sqltype = SqlTypeEnum.type_of(obj)
-                self.sql_types[item_name] = sqltype
-            else:
-                # item_name was already in sql_types, but here we need to allow some flexibilty.
-                # bad formatted xml with blanks or nulls or missing data will leave the item type as NULL
-                # when we know from later data that the type is actually more specific.
-                # so here we allow NULL to be upgraded to something else.
-                # allow NULL    -> REAL, INTEGER, TEXT, BLOB
-                # allow BLOB    -> REAl, INTEGER, TEXT
-                # allow INTEGER -> REAL
-                existing_type = self.sql_types[item_name]
-                new_type = SqlTypeEnum.type_of(obj)
-                if existing_type == SqlTypeEnum.NULL and new_type in XML2SQLTransormer.NULL_MIGRATION:
-                    self.sql_types[item_name] = new_type
-                elif existing_type == SqlTypeEnum.BLOB and new_type in XML2SQLTransormer.BLOB_MIGRATION:
-                    self.sql_types[item_name] = new_type
-                elif existing_type == SqlTypeEnum.INTEGER and new_type == SqlTypeEnum.REAL:
-                    self.sql_types[item_name] = new_type
-            # add item to the table columns
-            (child_name, obj, parent_name, pobj) = self.find_parent_child_tables(stack)
-            t = self.tables[child_name]
-            t.columns.add(item_name)
-
-        Walker(self.logger, item_handler_func=handle_item, list_handler_func=handle_list_or_dict, dict_handler_func=handle_list_or_dict).walk(self.root, self.json)
+        self.walker(item_handler_func=self.scan_item, list_handler_func=self.scan_container, dict_handler_func=self.scan_container).walk(self.root, self.json)
+        return self.finish_scan()
+
+    def schema(self):
+        """
+        Return the tables and types found by `scan_all`, as a json
+        serializable dict for `use_schema`.
+        """
+        return {
+                "tables"    : [{"name": t.name, "parent": t.parent, "columns": sorted(t.columns)} for t in self.tables.values()],
+                "sql_types" : dict([(k, sql_type_str(v)) for (k, v) in self.sql_types.items()]),
+                "key_mode"  : self.key_mode,
+                }
 
+    def use_schema(self, schema):
+        """
+        Use the tables and types of another document of the feed, as returned
+        by `schema`, instead of running `scan_all`. Every row is then checked
+        against them by `check_row`, which raises SchemaMismatch when the
+        document needs a scan of its own.
+        """
+        if schema.get('key_mode', "uuid") != self.key_mode:
+            # the type of the 'id' columns depends on it
+            raise SchemaMismatch("new key mode: %s" % self.key_mode)
+        self.tables = {}
+        for t in schema['tables']:
+            table = Table(name=t['name'], parent=t['parent'])
+            table.columns = set(t['columns'])
+            self.tables[table.name] = table
+        self.sql_types = dict([(k, SqlTypeEnum[v]) for (k, v) in schema['sql_types'].items()])
+        self.cached = True
+        # allow method chaining
+        return self
+
+    def check_row(self, name, parent_name, obj):
+        """
+        Raise SchemaMismatch unless the dict obj fits the schema of table name:
+        same parent, same columns, and values that do not need a wider type.
+        """
+        t = self.tables.get(name)
+        if t is None or t.parent != parent_name:
+            raise SchemaMismatch("new table: %s" % name)
+        columns = 0
+        sql_types = self.sql_types
+        for (k, v) in obj.items():
+            if isinstance(v, (dict, list)):
+                continue
+            if k not in t.columns:
+                raise SchemaMismatch("new column: %s.%s" % (name, k))
+            columns += 1
+            sqltype = sql_types[k]
+            if sqltype == SqlTypeEnum.TEXT or v is None:
+                continue
+            # fast paths for plain numbers, see SqlTypeEnum.type_of
+            if sqltype == SqlTypeEnum.INTEGER and v.isdecimal():
+                continue
+            if sqltype == SqlTypeEnum.REAL and v.replace('.', '', 1).isdecimal():
+                continue
+            if SqlTypeEnum.type_of(v) not in XML2SQLTransormer.FITS[sqltype]:
+                raise SchemaMismatch("wider type: %s.%s" % (name, k))
+        if columns + ('id' not in obj) < len(t.columns):
+            raise SchemaMismatch("missing column: %s" % name)
+
+    def walker(self, **handlers):
+        """
+        Return a Walker that keeps self.table_path up to date, so the
+        handlers can look up their tables in O(1), see `find_parent_child_tables`.
+        """
+        return Walker(self.logger, is_table_func=self.is_table, tables=self.table_path, **handlers)
+
+    def is_table(self, name, obj):
+        """
+        Whether the dict or list obj, named name on the stack, is a table. Same
+        test as `find_table`, with the name lookup memoized.
+        """
+        try:
+            named = self.table_names[name]
+        except KeyError:
+            named = self.table_names[name] = (SqlTypeEnum.type_of(name) == SqlTypeEnum.TEXT)
+        return named and (isinstance(obj, dict) or name != self.root)
+
+    def scan_container(self, stack):
+        """
+        Scan a list or dict at the top of the stack, registering the table it maps to.
+        """
+        (child_name, obj, parent_name, pobj) = self.find_parent_child_tables(stack)
+        if child_name == self.root:
+            return
+        if child_name not in self.tables:
+            self.tables[child_name] = Table(name=child_name, parent=parent_name)
+
+    def scan_item(self, stack):
+        """
+        Scan an item at the top of the stack, updating its type and adding it
+        to the columns of its table.
+        """
+        (item_name, obj) = stack[-1]
+        existing_type = self.sql_types.get(item_name)
+        if existing_type is None:
+            sqltype = SqlTypeEnum.type_of(obj)
+            self.sql_types[item_name] = sqltype
+        elif existing_type == SqlTypeEnum.INTEGER and isinstance(obj, str) and obj.isdecimal():
+            # fast path for plain integers, see `check_row`, most values of
+            # an INTEGER column stay INTEGER
+            pass
+        elif existing_type not in XML2SQLTransormer.FINAL_TYPES:
+            self.sql_types[item_name] = XML2SQLTransormer.widen(existing_type, SqlTypeEnum.type_of(obj))
+        # add item to the table columns
+        (child_name, obj, parent_name, pobj) = self.find_parent_child_tables(stack)
+        t = self.tables[child_name]
+        t.columns.add(item_name)
+
+    @staticmethod
+    def widen(existing_type, new_type):
+        """
+        Return the type of a column of existing_type once it also holds a
+        value of new_type.
+
+        Bad formatted xml with blanks or nulls or missing data will leave the
+        item type as NULL when we know from later data that the type is
+        actually more specific, so we allow some flexibility:
+
+            allow NULL    -> REAL, INTEGER, TEXT, BLOB
+            allow BLOB    -> REAL, INTEGER, TEXT
+            allow INTEGER -> REAL
+        """
+        if existing_type == SqlTypeEnum.NULL and new_type in XML2SQLTransormer.NULL_MIGRATION:
+            return new_type
+        if existing_type == SqlTypeEnum.BLOB and new_type in XML2SQLTransormer.BLOB_MIGRATION:
+            return new_type
+        if existing_type == SqlTypeEnum.INTEGER and new_type == SqlTypeEnum.REAL:
+            return new_type
+        return existing_type
+
+    def finish_scan(self):
+        """
+        Post scan checks and type fixups, once all items were scanned.
+        """
         # post scan add 'id' to empty tables
         for k,v in self.tables.items():
             assert 'id' in v.columns
@@ -361,6 +682,15 @@ odict_keys(['DATA_ITEM', 'RESOURCE_NAME', 'OPR_DATE', 'INTERVAL_NUM', 'INTERVAL_
             x = x + 1
 
     def find_parent_child_tables(self, stack):
+        tables = self.table_path
+        if tables:
+            # stack is being walked, see `walker`
+            (child, obj) = stack[tables[-1]]
+            if len(tables) > 1:
+                (parent, pobj) = stack[tables[-2]]
+            else:
+                (parent, pobj) = (None, None)
+            return (child, obj, parent, pobj)
         (child, obj, cidx) = self.find_table(stack)
         (parent, pobj, pidx) = self.find_table(stack[:cidx].copy())
         return (child, obj, parent, pobj)
@@ -396,79 +726,160 @@ odict_keys(['DATA_ITEM', 'RESOURCE_NAME', 'OPR_DATE', 'INTERVAL_NUM', 'INTERVAL_
 
 
     def insertion_sql(self):
+        return list(self.insertion(self.insert_row))
+
+    def insertion_rows(self):
+        """
+        Return (table, columns, values) for every row, see `insert_values`.
+        """
+        return self.insertion(self.insert_values)
+
+    def insertion_batches(self, batch_size=BATCH_SIZE):
+        """
+        Yield (table, columns, [values]) with up to batch_size rows of the same
+        table and columns, see `insertion_rows`.
+        """
+        batches = {}
+        for (table, columns, values) in self.insertion_rows():
+            key = (table, columns)
+            batch = batches.setdefault(key, [])
+            batch.append(values)
+            if len(batch) >= batch_size:
+                yield (table, columns, batch)
+                batches[key] = []
+        for ((table, columns), batch) in batches.items():
+            if batch:
+                yield (table, columns, batch)
+
+    def insertion(self, render):
+        """
+        Return render(stack) for every dict of the document, unless None.
+        """
         assert self.json is not None
         retval = []
+        def handle_dict(stack):
+            row = render(stack)
+            if row is not None:
+                retval.append(row)
+        self.walker(dict_handler_func=handle_dict).walk(self.root, self.json)
+        return retval
 
-        def sql(name, columns, values):
-            sql_txt = """INSERT OR IGNORE INTO {table} ({columns}) VALUES ({values});""".format(table=name, columns=", ".join(columns), values=", ".join(values))
-            return sql_txt
-       
-        def get_kv(keys:list, obj:dict):
-            assert isinstance(obj, dict)
-            sortedkeys = sorted(keys)
-            for sk in sortedkeys:
-                if sk not in obj:
-                    raise Exception("ERROR: sk: '%s' not in obj keys: '%s'" % (sk, obj.keys()))
-            values = [obj[k] for k in sortedkeys]
-            return (sortedkeys, values)
-
-        def handle_list(stack):
-            (name, obj) = stack[-1]
-            t = self.tables[name]
-            if t.columns == {'id'}:
-                synthetic_id = str(uuid.uuid4())
-                t.last_id = synthetic_id
+    def assign_id(self, t, obj):
+        """
+        Give obj a synthetic primary key, unless it has one already.
+        """
+        if t.primary_key() == ['id'] and 'id' not in obj.keys():
+            synthetic_id = self.synthetic_id()
+            obj['id'] = synthetic_id
+            t.last_id = synthetic_id
 
-        def handle_dict(stack):
-            (realname, obj) = stack[-1]
-            if realname == self.root:
-                return
-            (name, _, parent_name, pobj) = self.find_parent_child_tables(stack)
-
-            t = self.tables[name]
-
-            local_keys          = []
-            local_values        = []
-            parent_pk_keys      = []
-            parent_pk_values    = []
-
-            if t.primary_key() == ['id'] and 'id' not in obj.keys():
-                synthetic_id = str(uuid.uuid4())
-                obj['id'] = synthetic_id
-                t.last_id = synthetic_id
-
-            if t.parent is not None and t.parent != self.root and t.parent == parent_name and parent_name in self.tables:
-                parent_t = self.tables[parent_name]
-                parent_pk = parent_t.primary_key()
-                if isinstance(pobj, list):
-                    assert parent_pk == ['id']
-                    assert parent_t.last_id is not None
-                    parent_pk_keys = parent_pk
-                    parent_pk_values = [parent_t.last_id]
-                else:
-                    (parent_pk_keys, parent_pk_values) = get_kv(parent_pk, pobj)
+    def row(self, stack):
+        """
+        Return (table, keys, values, parent keys, parent values) for the dict
+        at the top of the stack, or None for the document root.
+        """
+        (realname, obj) = stack[-1]
+        if realname == self.root:
+            return None
+        (name, _, parent_name, pobj) = self.find_parent_child_tables(stack)
+        if self.cached:
+            self.check_row(name, parent_name, obj)
+
+        t = self.tables[name]
+
+        local_keys          = []
+        local_values        = []
+        parent_pk_keys      = []
+        parent_pk_values    = []
+
+        self.assign_id(t, obj)
+
+        if t.parent is not None and t.parent != self.root and t.parent == parent_name and parent_name in self.tables:
+            parent_t = self.tables[parent_name]
+            parent_pk = parent_t.primary_key()
+            if isinstance(pobj, list):
+                assert parent_pk == ['id']
+                assert parent_t.last_id is not None
+                parent_pk_keys = parent_pk
+                parent_pk_values = [parent_t.last_id]
+            else:
+                (parent_pk_keys, parent_pk_values) = get_kv(parent_pk, pobj)
 
-            (local_keys, local_values) = get_kv(t.columns, obj)
+        (local_keys, local_values) = get_kv(t.columns, obj)
+        return (t, local_keys, local_values, parent_pk_keys, parent_pk_values)
 
-            columns = []
-            columns.extend(self.sqlite_sanitize_all(local_keys))
-            columns.extend(["%s_%s"%(self.sqlite_sanitize(t.parent), self.sqlite_sanitize(k)) for k in parent_pk_keys])
-    
-            values  = []
-            values.extend(self.sqlite_sanitize_values(local_keys, local_values))
-            values.extend(self.sqlite_sanitize_values(parent_pk_keys, parent_pk_values))
-            
-            retval.append(sql(self.sqlite_sanitize(name), columns, values))
-
-        #Walker(self.logger, dict_handler_func=handle_dict, list_handler_func=handle_list).walk(self.root, self.json)
-        Walker(self.logger, dict_handler_func=handle_dict).walk(self.root, self.json)
-        return retval
+    def row_columns(self, t, local_keys, parent_pk_keys):
+        return sanitize_columns(t.parent, tuple(local_keys), tuple(parent_pk_keys))
+
+    def insert_row(self, stack):
+        """
+        Return the insert statement for the dict at the top of the stack, or
+        None for the document root.
+        """
+        row = self.table_insert_row(stack)
+        if row is None:
+            return None
+        return row[1]
+
+    def table_insert_row(self, stack):
+        """
+        Return (table, insert statement), see `insert_row`.
+        """
+        row = self.row(stack)
+        if row is None:
+            return None
+        (t, local_keys, local_values, parent_pk_keys, parent_pk_values) = row
+
+        columns = self.row_columns(t, local_keys, parent_pk_keys)
+
+        values  = []
+        values.extend(self.sqlite_sanitize_values(local_keys, local_values))
+        values.extend(self.sqlite_sanitize_values(parent_pk_keys, parent_pk_values))
+
+        table   = sanitize(t.name)
+        return (table, "%s%s);" % (insert_prefix(table, columns), ", ".join(values)))
+
+    def insert_values(self, stack):
+        """
+        Return (table, columns, values) for the dict at the top of the stack,
+        or None for the document root. Same row as `insert_row`, but with the
+        values as parameters for `db.insert_statement`.
+        """
+        row = self.row(stack)
+        if row is None:
+            return None
+        (t, local_keys, local_values, parent_pk_keys, parent_pk_values) = row
+
+        columns = self.row_columns(t, local_keys, parent_pk_keys)
+
+        values  = []
+        values.extend(self.sqlite_bind_values(local_keys, local_values))
+        values.extend(self.sqlite_bind_values(parent_pk_keys, parent_pk_values))
+
+        return (sanitize(t.name), columns, tuple(values))
 
+    def sqlite_bind_values(self, columns, values):
+        """
+        Values as parameters, typed like `sqlite_sanitize_values` types them:
+        NULL is "", numbers are left to the column affinity.
+        """
+        b_values = []
+        for (c,v) in zip(columns, values):
+            if v is None or self.sql_types.get(c) == SqlTypeEnum.NULL:
+                b_values.append("")
+            elif self.sql_types.get(c) == SqlTypeEnum.BLOB:
+                b_values.append(base64.b64encode(v).decode('ascii'))
+            else:
+                b_values.append(v)
+        return b_values
 
     def quote_identifier(self, s, errors="strict"):
         """
         https://stackoverflow.com/questions/6514274/how-do-you-escape-strings-for-sqlite-table-column-names-in-python
         """
+        if s.isascii() and "\x00" not in s:
+            # nothing to encode or replace
+            return "\"" + s.replace("\"", "\"\"") + "\""
         encodable = s.encode("utf-8", errors).decode("utf-8")
 
         nul_index = encodable.find("\x00")
@@ -537,9 +948,9 @@ odict_keys(['DATA_ITEM', 'RESOURCE_NAME', 'OPR_DATE', 'INTERVAL_NUM', 'INTERVAL_
 
     def sqlite_sanitize(self, s):
         """
-        Sanitize table names and field names prior for sqlite
+        Sanitize table names and field names prior for sqlite, see `sanitize`
         """
-        return re.sub('[^a-zA-Z0-9_]', '', s).lower()
+        return sanitize(s)
 
     def _find_parent_table(self, table_name, table_relations, table_columns):
         """
@@ -556,7 +967,194 @@ odict_keys(['DATA_ITEM', 'RESOURCE_NAME', 'OPR_DATE', 'INTERVAL_NUM', 'INTERVAL_
             return None
         return parent
 
-def parse(logger, resource_name, input_files, input_dir, output_dir):
+class _StreamingSAXHandler(xmltodict._DictSAXHandler):
+    """
+    xmltodict handler that reports elements as they open and close instead
+    of building the whole document, see StreamingXML2SQLTransformer.
+
+    Handlers get the same stack of (name, obj) as the Walker handlers:
+
+        on_container(stack) : element at the top just turned out to be a dict
+                              (it has attributes or a first child)
+        on_leaf(stack)      : leaf element at the top was closed
+        on_close(stack)     : dict element at the top was closed, its leaves
+                              are complete and its child dicts are gone
+
+    Closed dicts are dropped from their parent, so only the open elements
+    and their leaves are held in memory.
+    """
+    def __init__(self, root, on_container, on_leaf, on_close, is_table_func, tables, **kwargs):
+        super().__init__(**kwargs)
+        self.on_container   = on_container
+        self.on_leaf        = on_leaf
+        self.on_close       = on_close
+        self.is_table_func  = is_table_func
+        self.walk           = [(root, self.dict_constructor())]
+        """walker stack of the open elements"""
+        self.tables         = tables
+        """positions of the tables in the walker stack, see Walker"""
+        if is_table_func(*self.walk[0]):
+            tables.append(0)
+
+    def opened(self):
+        (name, item) = self.walk[-1]
+        if self.is_table_func(name, item):
+            self.tables.append(len(self.walk) - 1)
+        self.on_container(self.walk)
+
+    def container(self):
+        if self.item is None:
+            self.item = self.dict_constructor()
+            self.walk[-1] = (self.walk[-1][0], self.item)
+            self.opened()
+
+    def startElement(self, full_name, attrs):
+        if self.path:
+            # the parent has a child, so it is a dict
+            self.container()
+        super().startElement(full_name, attrs)
+        self.walk.append((self.path[-1][0], self.item))
+        if self.item is not None:
+            # attributes
+            self.opened()
+
+    def endElement(self, full_name):
+        super().endElement(full_name)
+        (name, _) = self.walk[-1]
+        parent = self.item
+        value = parent[name]
+        if isinstance(value, list):
+            # repeated leaf
+            value = value[-1]
+        self.walk[-1] = (name, value)
+        if isinstance(value, dict):
+            self.on_close(self.walk)
+            del parent[name]
+        elif self.on_leaf is not None:
+            self.on_leaf(self.walk)
+        if self.tables and self.tables[-1] == len(self.walk) - 1:
+            self.tables.pop()
+        self.walk.pop()
+
+class StreamingXML2SQLTransformer(XML2SQLTransormer):
+    """
+    Same schema and rows as XML2SQLTransormer, but the document is never
+    loaded as a whole. The xmlfile (which must be seekable) is read twice in
+    chunks: scan_all scans the types and tables, and insertion_sql emits
+    the rows. Memory is bounded by the open elements and their leaves, e.g.
+    a single REPORT_DATA, instead of by the size of the document.
+
+    Rows are emitted when their element closes, so children come before
+    their parents. Ids are assigned when an element opens, so the children
+    can reference them.
+    """
+    CHUNK_SIZE = 64 * 1024
+
+    def parse(self):
+        """
+        Nothing to load, the xmlfile is read by scan_all and insertion_sql.
+        Only the 'hash' and 'integer' keys need a digest of the document
+        before the first row, which takes one extra read.
+        """
+        if self.key_mode != "uuid":
+            self.xmlfile.seek(0)
+            while True:
+                chunk = self.xmlfile.read(self.CHUNK_SIZE)
+                if not chunk:
+                    break
+                self.digest(chunk)
+        return self
+
+    def scan_all(self):
+        for _ in self.feed(self.scan_open, self.scan_item, self.scan_close):
+            pass
+        return self.finish_scan()
+
+    def scan_open(self, stack):
+        self.scan_container(stack)
+        # attributes
+        for (k, v) in stack[-1][1].items():
+            if not isinstance(v, (dict, list)):
+                self.scan_item(stack + [(k, v)])
+
+    def scan_close(self, stack):
+        (name, obj) = stack[-1]
+        if name not in self.tables:
+            self.scan_container(stack)
+        walker = self.walker(item_handler_func=self.scan_item, list_handler_func=self.scan_container, dict_handler_func=self.scan_container)
+        for (k, v) in obj.items():
+            if isinstance(v, (dict, list)):
+                # e.g. namespace declarations
+                walker.walk_from(stack + [(k, v)])
+            elif k == '#text':
+                self.scan_item(stack + [(k, v)])
+
+    def insertion_sql(self):
+        return self.insertion(self.insert_row)
+
+    def insertion(self, render):
+        rows = []
+        def emit_open(stack):
+            (name, obj) = stack[-1]
+            if name not in self.tables:
+                raise SchemaMismatch("new table: %s" % name)
+            self.assign_id(self.tables[name], obj)
+        def emit_row(stack):
+            row = render(stack)
+            if row is not None:
+                rows.append(row)
+        def emit_close(stack):
+            emit_row(stack)
+            walker = self.walker(dict_handler_func=emit_row)
+            for (k, v) in stack[-1][1].items():
+                if isinstance(v, (dict, list)):
+                    walker.walk_from(stack + [(k, v)])
+        for _ in self.feed(emit_open, None, emit_close):
+            yield from rows
+            del rows[:]
+
+    def feed(self, on_container, on_leaf, on_close):
+        """
+        Parse the xmlfile from the start, yielding after every chunk.
+        """
+        handler = _StreamingSAXHandler(self.root, on_container, on_leaf, on_close, self.is_table, self.table_path, strip_namespaces=True)
+        # same parser setup as xmltodict.parse(process_namespaces=True)
+        parser = expat.ParserCreate(None, handler.namespace_separator)
+        parser.ordered_attributes = True
+        parser.StartNamespaceDeclHandler = handler.startNamespaceDecl
+        parser.StartElementHandler = handler.startElement
+        parser.EndElementHandler = handler.endElement
+        parser.CharacterDataHandler = handler.characters
+        parser.buffer_text = True
+        parser.DefaultHandler = lambda x: None
+        parser.ExternalEntityRefHandler = lambda *x: 1
+        self.xmlfile.seek(0)
+        try:
+            while True:
+                chunk = self.xmlfile.read(self.CHUNK_SIZE)
+                parser.Parse(chunk, not chunk)
+                yield
+                if not chunk:
+                    return
+        finally:
+            # the document root
+            del self.table_path[:]
+
+def parse(logger, resource_name, input_files, input_dir, output_dir, streaming=False, schema_file=None, output_format=OUTPUT_FORMAT, validation=VALIDATION, workers=PARSE_WORKERS, key_mode=KEY_MODE):
+    """
+    Parse input_files in input_dir into sql files in output_dir, yielding
+    the name of every parsed file. Files that fail to parse are recorded in
+    output_dir/failed.txt and skipped from then on.
+
+    streaming       : see `transform`
+    schema_file     : if set, the schema cache of the feed, see `transform`
+    output_format   : see `transform`
+    validation      : one of VALIDATIONS, see `Validator`, the validation
+                      db is shared by all the files
+    workers         : number of processes parsing files in parallel, files
+                      are then yielded in the order they complete
+    key_mode        : see `transform`
+    """
     failed_state        = os.path.join(output_dir, 'failed.txt')
     failed_input_files  = []
 
@@ -565,53 +1163,116 @@ def parse(logger, resource_name, input_files, input_dir, output_dir):
             failed_input_files = [l.rstrip().rstrip() for l in fh]
 
     s_failed_input_files= set(failed_input_files) 
-    s_input_files       = set(input_files)
-    s_unprocessed_files = s_input_files - s_failed_input_files
-    unprocessed_files   = sorted(list(s_unprocessed_files))
+    # input_files may be a stream of files as they arrive (see pipeline.py)
+    unprocessed_files   = (f for f in input_files if f not in s_failed_input_files)
+    options             = (logger, resource_name, input_dir, output_dir, streaming, schema_file, output_format, validation, key_mode)
+    if workers <= 1:
+        results = _parse_serial(options, unprocessed_files)
+    else:
+        results = _parse_parallel(options, unprocessed_files, workers)
 
     with open(failed_state, 'a') as fh:
-        for f in unprocessed_files:
-            try:
-                yield parse_file(logger, resource_name, f, input_dir, output_dir)
-            except Exception as e:
-                fh.write("%s\n" % f)
-                tb = traceback.format_exc()
-                log.error(logger, {
-                    "src"       : resource_name, 
-                    "action"    : "parse",
-                    "xml_file"  : f,
-                    "msg"       : "parse failed",
-                    "ERROR"     : "Failed to parse xml file",
-                    "exception" : str(e),
-                    "trace"     : str(tb),
-                    })
+        for (f, error, tb) in results:
+            if error is None:
+                yield f
+                continue
+            fh.write("%s\n" % f)
+            fh.flush()
+            log.error(logger, {
+                "src"       : resource_name, 
+                "action"    : "parse",
+                "xml_file"  : f,
+                "msg"       : "parse failed",
+                "ERROR"     : "Failed to parse xml file",
+                "exception" : error,
+                "trace"     : str(tb),
+                })
+
+_parse_worker = {}
+"""the options, schema cache and validator of a parse worker process, see
+`_init_parse_worker`"""
 
-def parse_file(logger, resource_name, xml_input_file_name, input_dir, output_dir):
+def _init_parse_worker(options):
+    (logger, resource_name, input_dir, output_dir, streaming, schema_file, output_format, validation, key_mode) = options
+    _parse_worker["options"]        = options
+    _parse_worker["schema_cache"]   = SchemaCache(schema_file) if schema_file is not None else None
+    _parse_worker["validator"]      = Validator(validation)
+
+def _parse_one(f):
+    """
+    Parse file f with the state of the worker process, see `_parse_serial`.
+    """
+    (logger, resource_name, input_dir, output_dir, streaming, schema_file, output_format, validation, key_mode) = _parse_worker["options"]
+    try:
+        parse_file(logger, resource_name, f, input_dir, output_dir, streaming, _parse_worker["schema_cache"], output_format, _parse_worker["validator"], key_mode)
+        return (f, None, None)
+    except Exception as e:
+        return (f, str(e), traceback.format_exc())
+
+def _parse_serial(options, input_files):
+    """
+    Parse input_files in this process, yielding (file, error, trace) where
+    error is None for parsed files.
+    """
+    _init_parse_worker(options)
+    try:
+        for f in input_files:
+            yield _parse_one(f)
+    finally:
+        _parse_worker["validator"].close()
+        _parse_worker.clear()
+
+def _parse_parallel(options, input_files, workers):
+    """
+    Parse input_files in `workers` processes, see `_parse_serial`. Each
+    worker keeps its own schema cache and validator for all its files.
+
+    A worker that dies (e.g. killed for running out of memory) breaks the
+    pool and every file in flight with it. Those files are parsed again
+    one at a time, each in its own pool, so only the file that kills its
+    worker again fails, and a new pool takes the remaining files.
+    """
+    window      = Window(workers)
+    pool        = None
+    try:
+        for (f, done) in window.feed(input_files):
+            suspects = []
+            for (future, g) in done:
+                if isinstance(future.exception(), BrokenProcessPool):
+                    suspects.append(g)
+                else:
+                    yield future.result()
+            if f is not None:
+                if pool is None:
+                    pool = ProcessPoolExecutor(max_workers=workers, initializer=_init_parse_worker, initargs=(options,))
+                try:
+                    window.add(pool.submit(_parse_one, f), f)
+                except BrokenProcessPool:
+                    suspects.append(f)
+            if not suspects:
+                continue
+            for (future, g) in window.wait_all():
+                if isinstance(future.exception(), BrokenProcessPool):
+                    suspects.append(g)
+                else:
+                    yield future.result()
+            pool.shutdown()
+            pool = None
+            for g in suspects:
+                with ProcessPoolExecutor(max_workers=1, initializer=_init_parse_worker, initargs=(options,)) as alone:
+                    try:
+                        yield alone.submit(_parse_one, g).result()
+                    except BrokenProcessPool:
+                        yield (g, "worker process died", None)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+def parse_file(logger, resource_name, xml_input_file_name, input_dir, output_dir, streaming=False, schema_cache=None, output_format=OUTPUT_FORMAT, validator=None, key_mode=KEY_MODE):
     chlogger = logger.getChild(__name__)
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
-    (base, ext) = os.path.splitext(xml_input_file_name)
-    outfile = os.path.join(output_dir, "%s.sql" % (base))
     infile  = os.path.join(input_dir, xml_input_file_name)
-    total_ddl = 0
-    total_sql = 0
-    with open(outfile, 'w') as outfh:
-        with open(infile, 'r') as infh:
-            # all the work happens here
-            xst = XML2SQLTransormer(chlogger, infh).parse().scan_all()
-            # check that the ddl and sql is correct
-            # if this fails then it means the ddl/sql combination is incorrect
-            sqllst = []
-            for ddl in xst.ddl():
-                sqllst.append(ddl)
-            for sql in xst.insertion_sql():
-                sqllst.append(sql)
-            sqltext = "\n".join(sqllst)
-            #db = sqlite3.connect("file::memory:?cache=shared")
-            db = sqlite3.connect(":memory:")
-            db.executescript(sqltext)
-            # all good
-            outfh.write(sqltext)
+    with open(infile, 'rb') as infh:
+        outfile = transform(chlogger, infh, xml_input_file_name, output_dir, streaming, schema_cache, output_format, validator, key_mode)
     log.info(chlogger, {
         "src":resource_name, 
         "action":"parse_file",
@@ -620,6 +1281,332 @@ def parse_file(logger, resource_name, xml_input_file_name, input_dir, output_dir
         })
     return xml_input_file_name
 
+class SchemaCache():
+    """
+    Schema of the documents of a feed, kept in a json file next to the
+    manifest, see `transform`.
+    """
+    def __init__(self, schema_file):
+        self.schema_file    = schema_file
+        self.schema         = None
+        if os.path.exists(schema_file):
+            with open(schema_file, 'r') as f:
+                self.schema = json.load(f)
+
+    def update(self, schema):
+        """
+        Merge schema, as returned by `XML2SQLTransormer.schema`, into the
+        cached one, see `merge`, and save the result when it changed.
+        """
+        if os.path.exists(self.schema_file):
+            # other parse workers may have merged their documents since
+            with open(self.schema_file, 'r') as f:
+                self.schema = json.load(f)
+        schema = self.merge(schema)
+        if schema == self.schema:
+            return
+        self.schema = schema
+        # parse workers may update the file concurrently
+        tmpfile = "%s.%d.tmp" % (self.schema_file, os.getpid())
+        with open(tmpfile, 'w') as f:
+            f.write(json.dumps(schema, indent=4, sort_keys=True))
+        os.replace(tmpfile, self.schema_file)
+
+    def merge(self, schema):
+        """
+        Return the cached schema with the tables and columns of schema added,
+        and the types widened like `XML2SQLTransormer.scan_item` does, so the
+        documents of both fit it. A table keeps its cached parent. A new key
+        mode replaces the cached schema.
+        """
+        cached = self.schema
+        if cached is None or cached.get('key_mode', "uuid") != schema.get('key_mode', "uuid"):
+            return schema
+        tables = dict([(t['name'], t) for t in cached['tables']])
+        for t in schema['tables']:
+            if t['name'] in tables:
+                known = tables[t['name']]
+                t = dict(known, columns=sorted(set(known['columns']) | set(t['columns'])))
+            tables[t['name']] = t
+        sql_types = dict(cached['sql_types'])
+        for (k, v) in schema['sql_types'].items():
+            if k in sql_types:
+                v = sql_type_str(XML2SQLTransormer.widen(SqlTypeEnum[sql_types[k]], SqlTypeEnum[v]))
+            sql_types[k] = v
+        return {
+                "tables"    : [tables[name] for name in sorted(tables)],
+                "sql_types" : sql_types,
+                "key_mode"  : schema['key_mode'],
+                }
+
+class Validator():
+    """
+    Checks what `transform` writes by loading it into an in memory db, in a
+    transaction that is rolled back after every file, so one db serves all
+    the files of a run.
+
+    policy      : 'full' loads everything, 'sample' loads the ddl and the
+                  first sample_rows rows of every table, 'off' loads nothing
+    """
+    def __init__(self, policy=VALIDATION, sample_rows=SAMPLE_ROWS):
+        if policy not in VALIDATIONS:
+            raise Exception("unknown validation: '%s', expected one of %s" % (policy, VALIDATIONS))
+        self.policy         = policy
+        self.sample_rows    = sample_rows
+        self.counts         = {}
+        """rows loaded per table for the current file"""
+        self.cnx            = None
+        if policy != "off":
+            self.cnx = sqlite3.connect(":memory:", isolation_level=None)
+
+    def begin(self):
+        self.counts = {}
+        if self.cnx is not None:
+            self.cnx.execute("BEGIN")
+
+    def rollback(self):
+        if self.cnx is not None and self.cnx.in_transaction:
+            self.cnx.execute("ROLLBACK")
+
+    def close(self):
+        if self.cnx is not None:
+            self.cnx.close()
+            self.cnx = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def wanted(self, table, count):
+        """number of the next count rows of table to load"""
+        if self.policy == "full":
+            return count
+        if self.policy == "off":
+            return 0
+        loaded = self.counts.get(table, 0)
+        wanted = max(0, min(count, self.sample_rows - loaded))
+        self.counts[table] = loaded + wanted
+        return wanted
+
+    def ddl(self, statements):
+        if self.cnx is not None:
+            for ddl in statements:
+                self.cnx.execute(ddl)
+
+    def sql(self, table, sql):
+        if self.wanted(table, 1):
+            self.cnx.execute(sql)
+
+    def rows(self, table, columns, rows):
+        wanted = self.wanted(table, len(rows))
+        if wanted:
+            self.cnx.executemany(db.insert_statement(table, columns), rows[:wanted])
+
+def transform(logger, infh, xml_input_file_name, output_dir, streaming=False, schema_cache=None, output_format=OUTPUT_FORMAT, validator=None, key_mode=KEY_MODE):
+    """
+    Transform the xml document read from infh, an open text or binary file,
+    into output_dir/<base><ending> where base is xml_input_file_name without
+    its extension, and ending depends on the output_format.
+
+    streaming       : use StreamingXML2SQLTransformer, which does not load
+                      the document, infh must be seekable
+    schema_cache    : SchemaCache of the feed, when the document fits the
+                      cached schema it is transformed without `scan_all`,
+                      otherwise it is scanned (infh must be seekable) and
+                      its schema is merged into the cached one
+    output_format   : one of OUTPUT_FORMATS
+    validator       : Validator that checks the output, by default a new one
+                      with the VALIDATION policy
+    key_mode        : one of KEY_MODES, see `XML2SQLTransormer.synthetic_id`,
+                      the 'id' columns of an existing db keep their type, so
+                      the key mode of a feed should not change
+
+    Return the path of the output file.
+    """
+    if validator is None:
+        with Validator() as validator:
+            return transform(logger, infh, xml_input_file_name, output_dir, streaming, schema_cache, output_format, validator, key_mode)
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    (base, ext) = os.path.splitext(xml_input_file_name)
+    outfile = os.path.join(output_dir, "%s%s" % (base, OUTPUT_FORMATS[output_format]))
+    transformer = StreamingXML2SQLTransformer if streaming else XML2SQLTransormer
+    write = write_rows if output_format == "rows" else write_sql
+    if schema_cache is not None and schema_cache.schema is not None:
+        try:
+            write(transformer(logger, infh, key_mode).parse().use_schema(schema_cache.schema), outfile, validator)
+            return outfile
+        except SchemaMismatch as e:
+            log.info(logger, {
+                "name"      : __name__,
+                "method"    : "transform",
+                "xml_file"  : xml_input_file_name,
+                "schema"    : schema_cache.schema_file,
+                "message"   : "schema changed, scanning",
+                "reason"    : str(e),
+                })
+            infh.seek(0)
+    # all the work happens here
+    xst = transformer(logger, infh, key_mode).parse().scan_all()
+    write(xst, outfile, validator)
+    if schema_cache is not None:
+        schema_cache.update(xst.schema())
+    return outfile
+
+def write_sql(xst, outfile, validator):
+    """
+    Write the ddl and insertion sql of the transformer xst to outfile, which
+    is only created once all of it was checked by the validator.
+    """
+    tmpfile = "%s.tmp" % outfile
+    # check that the ddl and sql is correct
+    # if this fails then it means the ddl/sql combination is incorrect
+    validator.begin()
+    try:
+        with open(tmpfile, 'w') as outfh:
+            ddl = list(xst.ddl())
+            validator.ddl(ddl)
+            outfh.write("\n".join(ddl))
+            for (table, sql) in xst.insertion(xst.table_insert_row):
+                validator.sql(table, sql)
+                outfh.write("\n")
+                outfh.write(sql)
+        # all good
+        os.replace(tmpfile, outfile)
+    finally:
+        validator.rollback()
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+
+def write_rows(xst, outfile, validator):
+    """
+    Write the ddl and insertion batches of the transformer xst to outfile in
+    the 'rows' format (see `db.load_rows`), which is only created once all
+    of it was checked by the validator.
+    """
+    tmpfile = "%s.tmp" % outfile
+    # check that the ddl and rows load, same as in write_sql
+    validator.begin()
+    try:
+        with open(tmpfile, 'w') as outfh:
+            ddl = list(xst.ddl())
+            validator.ddl(ddl)
+            outfh.write(json.dumps({"ddl": ddl}))
+            outfh.write("\n")
+            for (table, columns, rows) in xst.insertion_batches():
+                validator.rows(table, columns, rows)
+                outfh.write(json.dumps({"table": table, "columns": columns, "rows": rows}))
+                outfh.write("\n")
+        # all good
+        os.replace(tmpfile, outfile)
+    finally:
+        validator.rollback()
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+
+def read_zip_index(index_file):
+    """
+    Return {zip file : [xml members]} from a zip index, which has a line
+    'zip<TAB>member' per member, or 'zip<TAB>' for a zip without xml members.
+    """
+    index = {}
+    if os.path.exists(index_file):
+        with open(index_file, 'r') as fh:
+            for line in fh:
+                (zip_file, _, member) = line.rstrip("\n").partition("\t")
+                members = index.setdefault(zip_file, [])
+                if member:
+                    members.append(member)
+    return index
+
+def parse_zip(logger, resource_name, zip_files, zip_dir, output_dir, processed=None, xml_dir=None, streaming=False, schema_file=None, output_format=OUTPUT_FORMAT, validation=VALIDATION, key_mode=KEY_MODE):
+    """
+    Parse the xml members of zip_files straight out of the archives, instead
+    of parsing files that `zp.unzip` extracted. Yield the name of each parsed
+    member, so the state file lists parsed xml files just like with `parse`.
+
+    processed       : names of xml files that were parsed already, e.g. the
+                      lines of the state file, these are skipped
+    xml_dir         : if set, parsed members are also extracted here for
+                      debugging
+    streaming       : see `transform`
+    schema_file     : see `parse`
+    output_format   : see `transform`
+    validation      : see `parse`
+    key_mode        : see `transform`
+
+    The zip index (output_dir/zip_index.txt) records the members of every
+    archive, so archives whose members are all processed are not reopened.
+    Members that fail to parse go to output_dir/failed.txt, like in `parse`.
+    """
+    chlogger        = logger.getChild(__name__)
+    processed       = set(processed or [])
+    index_file      = os.path.join(output_dir, 'zip_index.txt')
+    failed_state    = os.path.join(output_dir, 'failed.txt')
+    index           = read_zip_index(index_file)
+    failed          = set()
+    schema_cache    = SchemaCache(schema_file) if schema_file is not None else None
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    if os.path.exists(failed_state):
+        with open(failed_state, 'r') as fh:
+            failed = set([l.rstrip() for l in fh])
+
+    with open(failed_state, 'a') as fh, open(index_file, 'a') as ih, Validator(validation) as validator:
+        for zip_file in zip_files:
+            members = index.get(zip_file)
+            if members is not None and all(m in processed or m in failed for m in members):
+                continue
+            try:
+                with zf.ZipFile(os.path.join(zip_dir, zip_file), 'r') as z:
+                    if members is None:
+                        members = [m for m in z.namelist() if m.lower().endswith(".xml")]
+                        for m in members or [""]:
+                            ih.write("%s\t%s\n" % (zip_file, m))
+                        ih.flush()
+                        index[zip_file] = members
+                    for m in members:
+                        if m in processed or m in failed:
+                            continue
+                        try:
+                            with z.open(m) as infh:
+                                outfile = transform(chlogger, infh, m, output_dir, streaming, schema_cache, output_format, validator, key_mode)
+                            if xml_dir is not None:
+                                z.extract(m, xml_dir)
+                            processed.add(m)
+                            log.info(chlogger, {
+                                "src"       : resource_name,
+                                "action"    : "parse_zip",
+                                "zip_file"  : zip_file,
+                                "xml_file"  : m,
+                                "outfile"   : outfile,
+                                })
+                            yield m
+                        except Exception as e:
+                            fh.write("%s\n" % m)
+                            fh.flush()
+                            failed.add(m)
+                            log.error(chlogger, {
+                                "src"       : resource_name,
+                                "action"    : "parse_zip",
+                                "zip_file"  : zip_file,
+                                "xml_file"  : m,
+                                "msg"       : "parse failed",
+                                "ERROR"     : "Failed to parse xml file",
+                                "exception" : str(e),
+                                "trace"     : traceback.format_exc(),
+                                })
+            except Exception as e:
+                log.error(chlogger, {
+                    "src"       : resource_name,
+                    "action"    : "parse_zip",
+                    "zip_file"  : zip_file,
+                    "ERROR"     : "Failed to read zip file",
+                    "exception" : str(e),
+                    })
+
 if __name__ == "__main__":
     infile = sys.argv[1]
     if len(sys.argv) > 2:
@@ -14,46 +14,156 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+from concurrent.futures import ProcessPoolExecutor
+from edl.resources.window import Window
 import os
 import logging
 import zipfile as zf
 
-def unzip(resource_name, zip_files, input_dir, output_dir):
+UNZIP_WORKERS = 1
+"""default number of processes decompressing archives in parallel, see
+`unzip`, a feed opts in with the 'unzip_workers' manifest option"""
+
+INDEX_FILE = "index.txt"
+"""name of the unzip index in the output directory, see `read_index`"""
+
+def read_index(index_file):
+    """
+    Return {member : (zip file, size, crc)} for the unzip index, which has a
+    line 'zip<TAB>member<TAB>size<TAB>crc' for every extracted member. When a
+    member was extracted more than once the last line wins.
+    """
+    index = {}
+    if os.path.exists(index_file):
+        with open(index_file, 'r') as f:
+            for line in f:
+                (zip_file, member, size, crc) = line.rstrip("\n").split("\t")
+                index[member] = (zip_file, int(size), int(crc))
+    return index
+
+def unzip(resource_name, zip_files, input_dir, output_dir, workers=UNZIP_WORKERS):
     """
     Unzip the zip files in input dir to the output directory.
 
     Return a list of unzipped artifacts that will later be appended
     to the state_file.
+
+    Archives are decompressed by `workers` processes. Every extracted member
+    is recorded with its size and CRC in the index (see `read_index`), so a
+    member is only extracted again when its CRC changes, without looking at
+    the filesystem. The members to extract are picked here, before an
+    archive is handed to a worker, so a member that is in several archives
+    of a run is only extracted once.
     """
-    for f in zip_files:
-        yield unzip_file(f, resource_name, input_dir, output_dir)
+    index_file  = os.path.join(output_dir, INDEX_FILE)
+    index       = read_index(index_file)
+    claimed     = {}
+    """member -> crc picked for extraction in this run, see `select`"""
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
 
-def unzip_file(f, resource_name, input_dir, output_dir):
+    def record(ih, f, result):
+        (zip_file, entries, error) = result
+        if error is not None:
+            logging.error({
+                "src":resource_name, 
+                "action":"new_zip_files",
+                "file":f,
+                "error": error
+                })
+            return ""
+        for (member, size, crc, extracted) in entries:
+            index[member] = (zip_file, size, crc)
+            ih.write("%s\t%s\t%d\t%d\n" % (zip_file, member, size, crc))
+        ih.flush()
+        logging.info({
+            "src":resource_name, 
+            "action":"unzip",
+            "zip_file":f,
+            "extracted":sum([1 for e in entries if e[3]]),
+            "skipped":len(entries) - sum([1 for e in entries if e[3]]),
+            })
+        return f
+
+    def completed(ih, done):
+        for (future, (f, names)) in done:
+            yield record(ih, f, future.result())
+
+    with open(index_file, 'a') as ih:
+        if workers <= 1:
+            for f in zip_files:
+                yield record(ih, f, extract(f, input_dir, output_dir, select(f, input_dir, output_dir, index, claimed)))
+            return
+        window = Window(workers)
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for (f, done) in window.feed(zip_files):
+                yield from completed(ih, done)
+                if f is None:
+                    continue
+                selected = select(f, input_dir, output_dir, index, claimed)
+                names = set([member for (member, size, crc) in selected[0]])
+                # a member that changed between two archives of the run is
+                # extracted in their order, as it is with one worker
+                while any(names & busy for (g, busy) in window.jobs()):
+                    yield from completed(ih, window.wait())
+                window.add(pool.submit(extract, f, input_dir, output_dir, selected), (f, names))
+
+def select(f, input_dir, output_dir, index, claimed):
+    """
+    Pick the members of zip file f to extract: those that are not in the
+    index with the same CRC, and not in claimed with the same CRC, the
+    members already picked from other archives in this run. Members missing from the index but
+    present on disk were extracted before the index existed, they are
+    recorded but not extracted again. Picked members are added to claimed.
+
+    Return ([(member, size, crc)] to extract, [(member, size, crc)] to
+    record only, error).
+    """
+    members = []
+    known_members = []
     try:
         with zf.ZipFile(os.path.join(input_dir, f), 'r') as t:
-            for zip_item in t.namelist():
-                target_artifact = os.path.join(output_dir, zip_item)
-                if not os.path.exists(target_artifact):
-                    t.extract(zip_item, output_dir)
-                    logging.info({
-                        "src":resource_name, 
-                        "action":"unzip",
-                        "zip_file":f,
-                        "zip_item":zip_item,
-                        "msg": "item extracted"})
-                else:
-                    logging.info({
-                        "src":resource_name, 
-                        "action":"unzip",
-                        "zip_file":f,
-                        "zip_item":zip_item,
-                        "msg": "item skipped (exists already)"})
-            return f
+            for info in t.infolist():
+                if info.is_dir():
+                    continue
+                known = index.get(info.filename)
+                if known is not None and known[2] == info.CRC:
+                    continue
+                if claimed.get(info.filename) == info.CRC:
+                    continue
+                if known is None and os.path.exists(os.path.join(output_dir, info.filename)):
+                    known_members.append((info.filename, info.file_size, info.CRC))
+                    continue
+                claimed[info.filename] = info.CRC
+                members.append((info.filename, info.file_size, info.CRC))
+        return (members, known_members, None)
     except Exception as e:
-        logging.error({
-            "src":resource_name, 
-            "action":"new_zip_files",
-            "file":f,
-            "error": e
-            })
-        return ""
+        return ([], [], str(e))
+
+def extract(f, input_dir, output_dir, selected):
+    """
+    Extract the members of zip file f that `select` picked.
+
+    Runs in a worker process, so only returns data:
+
+        (zip file, [(member, size, crc, extracted)], error)
+    """
+    (members, known_members, error) = selected
+    if error is not None:
+        return (f, [], error)
+    entries = [(member, size, crc, False) for (member, size, crc) in known_members]
+    try:
+        with zf.ZipFile(os.path.join(input_dir, f), 'r') as t:
+            for (member, size, crc) in members:
+                t.extract(member, output_dir)
+                entries.append((member, size, crc, True))
+        return (f, entries, None)
+    except Exception as e:
+        return (f, entries, str(e))
+
+def unzip_file(f, resource_name, input_dir, output_dir):
+    """
+    Unzip a single zip file f, see `unzip`.
+    """
+    for result in unzip(resource_name, [f], input_dir, output_dir, workers=1):
+        return result
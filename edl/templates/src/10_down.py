@@ -67,9 +67,11 @@ def run(logger, manifest, config):
     resource_name   = manifest['name']
     resource_url    = manifest['url']
     delay           = manifest['download_delay_secs']
+    workers         = manifest.get('download_workers', web.DOWNLOAD_WORKERS)
+    refresh         = manifest.get('download_refresh', False)
     download_dir    = config['working_dir']
     state_file      = config['state_file']
-    # sleep for N seconds in between downloads to meet caiso expected use requirements
+    # at most one request every N seconds per host to meet caiso expected use requirements
     dates   = xtime.range_pairs(xtime.day_range_to_today(start_date))
     urls    = list(web.generate_urls(logger, dates, resource_url))
     log.debug(logger, {
@@ -78,6 +80,8 @@ def run(logger, manifest, config):
         "resource"  : resource_name,
         "url"       : resource_url,
         "delay"     : delay,
+        "workers"   : workers,
+        "refresh"   : refresh,
         "download_dir": download_dir,
         "state_file": state_file,
         "start_date": str(start_date),
@@ -90,7 +94,9 @@ def run(logger, manifest, config):
                 delay,
                 urls,
                 state_file,
-                download_dir),
+                download_dir,
+                workers=workers,
+                refresh=refresh),
             state_file
             )
 
@@ -63,6 +63,15 @@ def run(logger, manifest, config):
     zip_dir         = config['source_dir']
     state_file      = config['state_file']
     resource_url    = manifest['url']
+    if manifest.get('parse_from_zip', False):
+        # the parse stage reads the xml straight out of the zip files
+        log.info(logger, {
+            "name"      : __name__,
+            "method"    : "run",
+            "resource"  : resource_name,
+            "message"   : "skipped, manifest sets parse_from_zip",
+            })
+        return
     new_files = state.new_files(resource_name, state_file, zip_dir, '.zip')
     log.debug(logger, {
         "name"      : __name__,
@@ -79,7 +88,8 @@ def run(logger, manifest, config):
                 resource_name,
                 new_files,
                 zip_dir,
-                xml_dir),
+                xml_dir,
+                workers=manifest.get('unzip_workers', zp.UNZIP_WORKERS)),
             state_file)
 
 
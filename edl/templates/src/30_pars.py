@@ -20,6 +20,7 @@
 # 30_pars.py : parse resources from an xml file into SQL for later insertion
 # -----------------------------------------------------------------------------
 
+from edl.resources import filesystem
 from edl.resources import log
 from edl.resources import state
 from edl.resources import xmlparser
@@ -39,15 +40,19 @@ def config():
     """
     config = {
             "source_dir"    : location of the xml files
+            "zip_dir"       : location of the zip files, see 'parse_from_zip'
             "working_dir"   : location of the database
             "state_file"    : fqpath to file that lists the inserted xml files
+            "schema_file"   : fqpath to the schema cache, see 'parse_schema_cache'
             }
     """
     cwd                     = os.path.abspath(os.path.curdir)
     config = {
             "source_dir"    : os.path.join(cwd, "xml"),
+            "zip_dir"       : os.path.join(cwd, "zip"),
             "working_dir"   : os.path.join(cwd, "sql"),
-            "state_file"    : os.path.join(cwd, "sql", "state.txt")
+            "state_file"    : os.path.join(cwd, "sql", "state.txt"),
+            "schema_file"   : os.path.join(cwd, "schema.json")
             }
     return config
 
@@ -60,7 +65,36 @@ def run(logger, manifest, config):
     resource_url    = manifest['url']
     xml_dir         = config['source_dir']
     sql_dir         = config['working_dir']
+    zip_dir         = config['zip_dir']
     state_file      = config['state_file']
+    streaming       = manifest.get('parse_streaming', False)
+    schema_file     = config['schema_file'] if manifest.get('parse_schema_cache', True) else None
+    output_format   = manifest.get('parse_format', xmlparser.OUTPUT_FORMAT)
+    validation      = manifest.get('parse_validation', xmlparser.VALIDATION)
+    parse_workers   = manifest.get('parse_workers', xmlparser.PARSE_WORKERS)
+    key_mode        = manifest.get('parse_key_mode', xmlparser.KEY_MODE)
+    if manifest.get('parse_from_zip', False):
+        # read the xml straight out of the zip files, xml_dir is only
+        # written to when 'extract_xml' is set, for debugging
+        zip_files = sorted(filesystem.glob_dir(zip_dir, '.zip'))
+        log.debug(logger, {
+            "name"      : __name__,
+            "method"    : "run",
+            "resource"  : resource_name,
+            "url"       : resource_url,
+            "zip_dir"   : zip_dir,
+            "sql_dir"   : sql_dir,
+            "state_file": state_file,
+            "zip_files_count" : len(zip_files),
+            })
+        state.update(
+                xmlparser.parse_zip(logger, resource_name, zip_files, zip_dir, sql_dir,
+                    processed=state.processed_files(state_file),
+                    xml_dir=xml_dir if manifest.get('extract_xml', False) else None,
+                    streaming=streaming, schema_file=schema_file, output_format=output_format,
+                    validation=validation, key_mode=key_mode),
+                state_file)
+        return
     new_files = state.new_files(resource_name, state_file, xml_dir, '.xml')
     log.debug(logger, {
         "name"      : __name__,
@@ -73,7 +107,7 @@ def run(logger, manifest, config):
         "new_files_count" : len(new_files),
         })
     state.update(
-            xmlparser.parse(logger, resource_name, new_files, xml_dir, sql_dir), 
+            xmlparser.parse(logger, resource_name, sorted(new_files), xml_dir, sql_dir, streaming, schema_file, output_format, validation, parse_workers, key_mode), 
             state_file)
 
 # -----------------------------------------------------------------------------
@@ -64,7 +64,9 @@ def run(logger, manifest, config):
     sql_dir         = config['source_dir']
     db_dir          = config['working_dir']
     state_file      = config['state_file']
-    new_files = state.new_files(resource_name, state_file, sql_dir, '.sql')
+    engine          = manifest.get('insert_engine', db.DB_ENGINE)
+    # sql scripts and row batches, see the manifest option 'parse_format'
+    new_files = sorted([f for ending in db.ENDINGS for f in state.new_files(resource_name, state_file, sql_dir, ending)])
     log.info(logger, {
         "name"      : __name__,
         "method"    : "run",
@@ -75,7 +77,10 @@ def run(logger, manifest, config):
         "new_files_count" : len(new_files),
         "message"   : "started processing sql files",
         })
-    state.update(db.insert(logger, resource_name, sql_dir, db_dir, new_files), state_file)
+    state.update(db.insert(logger, resource_name, sql_dir, db_dir, new_files, engine,
+        manifest.get('insert_batch_files', db.BATCH_FILES), manifest.get('insert_batch_rows', db.BATCH_ROWS),
+        manifest.get('insert_partition'), manifest.get('insert_mode', db.INSERT_MODE), manifest.get('insert_indexes'),
+        manifest.get('insert_workers', db.INSERT_WORKERS)), state_file)
     log.info(logger, {
         "name"      : __name__,
         "method"    : "run",
@@ -3,16 +3,25 @@
 # -----------------------------------------------------------------------------
 # 60_dist.sh : create distribution to archive
 # -----------------------------------------------------------------------------
+#
+# dist is updated in place: only zip files and dbs that are newer than their
+# copy in dist are copied (and compressed) again, so rclone sync in
+# 70_arch.py only uploads what changed, e.g. the shards of the current month
+# with the manifest option 'insert_partition'.
 
-if [ -d ./dist ]; then
-    chmod -R +w ./dist
-    rm -rf ./dist
-fi
 mkdir -p ./dist/zip
 mkdir -p ./dist/db
-cp -r ./zip/*.zip ./dist/zip/.
-cp -r ./zip/state.txt ./dist/zip/.
-chmod +w ./dist/zip/*
-cp ./db/*.db ./dist/db/.
-chmod +w ./dist/db/*
-pigz ./dist/db/*.db
+chmod -R +w ./dist
+cp -p -u ./zip/*.zip ./dist/zip/.
+cp -p ./zip/state.txt ./dist/zip/.
+for db in ./db/*.db; do
+    gz="./dist/db/$(basename "$db").gz"
+    if [ ! -f "$gz" ] || [ "$db" -nt "$gz" ]; then
+        if ! pigz -c "$db" > "$gz.tmp"; then
+            rm -f "$gz.tmp"
+            exit 1
+        fi
+        mv "$gz.tmp" "$gz"
+        touch -r "$db" "$gz"
+    fi
+done
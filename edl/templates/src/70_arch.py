@@ -76,7 +76,8 @@ def run(logger, manifest, config):
             "service"   : "digitalocean",
             "stdout"   : str(output),
             })
-    shutil.rmtree(os.path.join(os.curdir, 'dist'))
+    # dist is kept, so 60_dist.sh only compresses the dbs that changed and
+    # rclone sync only uploads those
 
 # -----------------------------------------------------------------------------
 # Main
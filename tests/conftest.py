@@ -0,0 +1,45 @@
+# edl : common library for the energy-dashboard tool-chain
+# Copyright (C) 2019  Todd Greenwood-Geer (Enviro Software Solutions, LLC)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import pytest
+import threading
+
+class Stream():
+    """
+    Items arriving one at a time, like the output of an upstream pipeline
+    stage: the items after the first one only arrive once the stage under
+    test reported a result, see `result`. So a stage that holds its results
+    back until it reads its next item never gets it.
+    """
+    def __init__(self, items, timeout=60):
+        self.items      = items
+        self.timeout    = timeout
+        self.results    = []
+        self.first      = threading.Event()
+
+    def result(self, result):
+        self.results.append(result)
+        self.first.set()
+
+    def __iter__(self):
+        yield self.items[0]
+        assert self.first.wait(self.timeout), "no result before the next item"
+        yield from self.items[1:]
+
+@pytest.fixture
+def stream():
+    return Stream
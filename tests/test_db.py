@@ -0,0 +1,148 @@
+# edl : common library for the energy-dashboard tool-chain
+# Copyright (C) 2019  Todd Greenwood-Geer (Enviro Software Solutions, LLC)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from edl.resources import db
+from edl.resources import xmlparser
+import gzip
+import io
+import json
+import logging
+import os
+import pytest
+import sqlite3
+
+DDL = "CREATE TABLE IF NOT EXISTS report_data (id TEXT, opr_date TEXT, value REAL, PRIMARY KEY (id));"
+
+@pytest.fixture
+def feed(tmp_path):
+    for d in ["sql", "db", "save"]:
+        os.makedirs(str(tmp_path / d))
+    return tmp_path
+
+def write_rows(sql_dir, name, rows, ddl=DDL, broken=False, table="report_data", columns=["id", "opr_date", "value"]):
+    with open(os.path.join(str(sql_dir), name), 'w') as f:
+        f.write(json.dumps({"ddl": [ddl]}) + "\n")
+        f.write(json.dumps({"table": table, "columns": columns, "rows": rows}) + "\n")
+        if broken:
+            f.write("{not json\n")
+    return name
+
+def insert(feed, names, **kwargs):
+    return list(db.insert(logging.getLogger(__name__), "feed", str(feed / "sql"), str(feed / "db"), names, **kwargs))
+
+def query(feed, db_file, sql):
+    cnx = sqlite3.connect(str(feed / "db" / db_file))
+    try:
+        return cnx.execute(sql).fetchall()
+    finally:
+        cnx.close()
+
+def test_direct_insert_does_not_analyze(feed):
+    insert(feed, [write_rows(feed / "sql", "a.rows", [["1", "2019-09-01", 1.0]])])
+    assert query(feed, "feed_00.db", "SELECT name FROM sqlite_master WHERE name = 'sqlite_stat1'") == []
+
+def test_staged_insert_analyzes(feed):
+    insert(feed, [write_rows(feed / "sql", "a.rows", [["1", "2019-09-01", 1.0]])], mode="staged")
+    assert query(feed, "feed_00.db", "SELECT name FROM sqlite_master WHERE name = 'sqlite_stat1'") == [("sqlite_stat1",)]
+
+def test_indexes_are_sanitized_and_unmatched_ones_logged(feed, caplog):
+    with caplog.at_level(logging.WARNING):
+        insert(feed, [write_rows(feed / "sql", "a.rows", [["1", "2019-09-01", 1.0]])], indexes=["OPR_DATE", ["interval_start_gmt"]])
+    assert query(feed, "feed_00.db", "SELECT name FROM sqlite_master WHERE type = 'index' AND name LIKE 'ix_%'") == [("ix_report_data_opr_date",)]
+    assert "interval_start_gmt" in caplog.text
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_failed_file_does_not_claim_its_schema(feed, workers):
+    other = "CREATE TABLE IF NOT EXISTS report_data (id TEXT, opr_date TEXT, value REAL, PRIMARY KEY (id, opr_date));"
+    unrelated = "CREATE TABLE IF NOT EXISTS report_item (id TEXT, opr_date TEXT, value REAL, PRIMARY KEY (id));"
+    names = [write_rows(feed / "sql", "a.rows", [["1", "2019-09-01", "x"]], ddl=other, broken=True),
+             write_rows(feed / "sql", "c.rows", [["3", "2019-09-01", 3.0]], ddl=unrelated, table="report_item")]
+    assert insert(feed, names, workers=workers) == ["c.rows"]
+    names = [write_rows(feed / "sql", "b.rows", [["2", "2019-09-01", 2.0]])]
+    assert insert(feed, names, workers=workers) == ["b.rows"]
+    shards = db.read_shards(str(feed / "db" / db.SHARDS_FILE))
+    assert sorted(shards) == ["feed_00.db"]
+    assert shards["feed_00.db"]["tables"] == db.table_fingerprints([DDL, unrelated])
+    assert query(feed, "feed_00.db", "SELECT id FROM report_data") == [("2",)]
+
+def test_failed_file_in_a_run_does_not_claim_its_schema(feed):
+    other = "CREATE TABLE IF NOT EXISTS report_data (id TEXT, opr_date TEXT, value REAL, PRIMARY KEY (id, opr_date));"
+    names = [write_rows(feed / "sql", "a.rows", [["1", "2019-09-01", "x"]], ddl=other, broken=True),
+             write_rows(feed / "sql", "b.rows", [["2", "2019-09-01", 2.0]])]
+    assert insert(feed, names) == ["b.rows"]
+    assert sorted(db.read_shards(str(feed / "db" / db.SHARDS_FILE))) == ["feed_00.db"]
+
+def test_declared_types_do_not_split_shards(feed):
+    integer = "CREATE TABLE IF NOT EXISTS report_data (id TEXT, opr_date TEXT, value INTEGER, PRIMARY KEY (id));"
+    names = [write_rows(feed / "sql", "a.rows", [["1", "2019-09-01", 10]], ddl=integer),
+             write_rows(feed / "sql", "b.rows", [["2", "2019-09-01", 1.5]])]
+    assert insert(feed, names) == names
+    assert sorted(db.read_shards(str(feed / "db" / db.SHARDS_FILE))) == ["feed_00.db"]
+    assert query(feed, "feed_00.db", "SELECT id, value FROM report_data ORDER BY id") == [("1", 10), ("2", 1.5)]
+
+def test_subset_of_columns_goes_to_the_same_shard(feed):
+    subset = "CREATE TABLE IF NOT EXISTS report_data (id TEXT, value REAL, PRIMARY KEY (id));"
+    superset = "CREATE TABLE IF NOT EXISTS report_data (id TEXT, opr_date TEXT, value REAL, note TEXT, PRIMARY KEY (id));"
+    names = [write_rows(feed / "sql", "a.rows", [["1", "2019-09-01", 1.0]]),
+             write_rows(feed / "sql", "b.rows", [["2", 2.0]], ddl=subset, columns=["id", "value"]),
+             write_rows(feed / "sql", "c.rows", [["3", "2019-09-01", 3.0]], ddl=superset)]
+    assert insert(feed, names) == names
+    assert sorted(db.read_shards(str(feed / "db" / db.SHARDS_FILE))) == ["feed_00.db", "feed_01.db"]
+    assert query(feed, "feed_00.db", "SELECT id, opr_date FROM report_data ORDER BY id") == [("1", "2019-09-01"), ("2", None)]
+    assert query(feed, "feed_01.db", "SELECT id FROM report_data") == [("3",)]
+
+def test_parsed_documents_with_integer_and_real_values_share_a_shard(feed):
+    logger = logging.getLogger(__name__)
+    xml_dir = feed / "xml"
+    os.makedirs(str(xml_dir))
+    names = []
+    for (i, value) in enumerate(["10", "1.5", "3"]):
+        names.append("report_%d.xml" % i)
+        with open(str(xml_dir / names[-1]), 'w') as f:
+            f.write('<?xml version="1.0" encoding="UTF-8"?><OASISReport xmlns="http://www.caiso.com/soa/OASISReport_v1.xsd">'
+                    '<MessagePayload><RTO><REPORT_ITEM><REPORT_DATA><OPR_DATE>2019-09-05</OPR_DATE><VALUE>%s</VALUE></REPORT_DATA>'
+                    '</REPORT_ITEM></RTO></MessagePayload></OASISReport>' % value)
+    schema_file = str(feed / "schema.json")
+    assert list(xmlparser.parse(logger, "feed", names, str(xml_dir), str(feed / "sql"), schema_file=schema_file, key_mode="hash")) == names
+    rows = ["report_%d.rows" % i for i in range(3)]
+    assert insert(feed, rows) == rows
+    assert sorted(db.read_shards(str(feed / "db" / db.SHARDS_FILE))) == ["feed_00.db"]
+    assert sorted(query(feed, "feed_00.db", "SELECT value FROM report_data")) == [(1.5,), (3,), (10,)]
+
+def test_statements_keep_quoted_semicolons_and_newlines():
+    script = io.StringIO("\n".join([
+        DDL,
+        "INSERT INTO report_data VALUES ('1', '2019-09-01', 'a; b');",
+        "INSERT INTO report_data VALUES ('2', '2019-09-01', 'c;",
+        "d');",
+        "INSERT INTO report_data VALUES ('3', '2019-09-01', 3.0)",
+        ]))
+    assert list(db.statements(script)) == [
+        DDL + "\n",
+        "INSERT INTO report_data VALUES ('1', '2019-09-01', 'a; b');\n",
+        "INSERT INTO report_data VALUES ('2', '2019-09-01', 'c;\nd');\n",
+        "INSERT INTO report_data VALUES ('3', '2019-09-01', 3.0)",
+        ]
+
+def test_gzipped_files_are_inserted(feed):
+    write_rows(feed / "sql", "a.rows", [["1", "2019-09-01", 1.0]])
+    with open(str(feed / "sql" / "a.rows"), 'rb') as f, gzip.open(str(feed / "sql" / "a.rows.gz"), 'wb') as gz:
+        gz.write(f.read())
+    os.remove(str(feed / "sql" / "a.rows"))
+    with gzip.open(str(feed / "sql" / "b.sql.gz"), 'wt') as gz:
+        gz.write(DDL + "\nINSERT INTO report_data VALUES ('2', '2019-09-01', 'x;\ny');\n")
+    assert insert(feed, ["a.rows.gz", "b.sql.gz"]) == ["a.rows.gz", "b.sql.gz"]
+    assert query(feed, "feed_00.db", "SELECT id, value FROM report_data ORDER BY id") == [("1", 1.0), ("2", "x;\ny")]
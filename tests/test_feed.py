@@ -0,0 +1,27 @@
+# edl : common library for the energy-dashboard tool-chain
+# Copyright (C) 2019  Todd Greenwood-Geer (Enviro Software Solutions, LLC)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from edl.cli import feed
+import logging
+import os
+
+def test_prune_parse_removes_every_output_format(tmp_path):
+    sql_dir = tmp_path / "data" / "testfeed" / "sql"
+    os.makedirs(str(sql_dir))
+    for name in ["a.sql", "b.rows", "c.sql.gz", "d.rows.gz", "state.txt", "failed.txt"]:
+        (sql_dir / name).write_text("")
+    feed.prune(logging.getLogger(__name__), "testfeed", str(tmp_path), "parse")
+    assert sorted(os.listdir(str(sql_dir))) == ["failed.txt", "state.txt"]
@@ -0,0 +1,55 @@
+# edl : common library for the energy-dashboard tool-chain
+# Copyright (C) 2019  Todd Greenwood-Geer (Enviro Software Solutions, LLC)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from edl.resources import pipeline
+import logging
+
+def run_stages(stages, timeout=10):
+    for (stage, next_stage) in zip(stages, stages[1:]):
+        stage.next = next_stage
+    stages[0].close()
+    for stage in stages:
+        stage.thread.start()
+    for stage in stages:
+        stage.thread.join(timeout)
+    return [stage.thread.is_alive() for stage in stages]
+
+def test_stage_fails_after_input_ended(tmp_path):
+    logger = logging.getLogger(__name__)
+    def fail_when_done(items):
+        for item in items:
+            yield item
+        # e.g. db.insert failing in finish, after its input ended
+        raise Exception("failed while wrapping up")
+    first = pipeline.Stage(logger, "first", lambda items: items, str(tmp_path / "first.txt"), downstream=lambda item: [item], seed=["a", "b"])
+    second = pipeline.Stage(logger, "second", fail_when_done, str(tmp_path / "second.txt"), downstream=lambda item: [item])
+    third = pipeline.Stage(logger, "third", lambda items: items, str(tmp_path / "third.txt"))
+    assert run_stages([first, second, third]) == [False, False, False]
+    assert str(second.error) == "failed while wrapping up"
+    assert third.error is None
+    assert third.count == 2
+
+def test_stage_fails_before_input_ended(tmp_path):
+    logger = logging.getLogger(__name__)
+    def fail_first(items):
+        for item in items:
+            raise Exception("failed on %s" % item)
+        yield None
+    first = pipeline.Stage(logger, "first", lambda items: items, str(tmp_path / "first.txt"), downstream=lambda item: [item], seed=["f%03d" % i for i in range(50)], queue_size=2)
+    second = pipeline.Stage(logger, "second", fail_first, str(tmp_path / "second.txt"))
+    assert run_stages([first, second]) == [False, False]
+    assert first.count == 50
+    assert str(second.error) == "failed on f000"
@@ -0,0 +1,112 @@
+# edl : common library for the energy-dashboard tool-chain
+# Copyright (C) 2019  Todd Greenwood-Geer (Enviro Software Solutions, LLC)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from edl.resources import web
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import logging
+import os
+import pytest
+import threading
+
+BODY = b"0123456789" * 1000
+
+ETAG = '"v1"'
+
+def serve(bad_range):
+    """
+    Serve BODY with an ETag, honouring Range requests like a real server
+    (416 past the end), or answering every Range with a 206 for the wrong
+    range when bad_range is set.
+    """
+    requests = []
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            requests.append(self.headers.get("Range"))
+            status = 200
+            (start, body) = (0, BODY)
+            if self.headers.get("Range"):
+                start = 0 if bad_range else int(self.headers["Range"][len("bytes="):].rstrip("-"))
+                if start >= len(BODY):
+                    self.send_response(416)
+                    self.send_header("Content-Range", "bytes */%d" % len(BODY))
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                (status, body) = (206, BODY[start:])
+            self.send_response(status)
+            self.send_header("ETag", ETAG)
+            if status == 206:
+                self.send_header("Content-Range", "bytes %d-%d/%d" % (start, len(BODY) - 1, len(BODY)))
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        def log_message(self, *args):
+            pass
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return (server, requests)
+
+def download_with_part(tmp_path, bad_range, part):
+    (server, requests) = serve(bad_range)
+    try:
+        url = "http://127.0.0.1:%d/report" % server.server_address[1]
+        target_file = str(tmp_path / web.filesystem.url2filename(url, ending=".zip"))
+        with open(target_file + web.PART_SUFFIX, 'wb') as f:
+            f.write(part)
+        with open(target_file + web.PART_SUFFIX + ".meta", 'w') as f:
+            f.write(ETAG)
+        lines = list(web.download(logging.getLogger(__name__), "test", 0, [url], str(tmp_path / "state.txt"), str(tmp_path)))
+    finally:
+        server.shutdown()
+    return (url, target_file, lines, requests)
+
+def test_complete_part_file_starts_over(tmp_path):
+    (url, target_file, lines, requests) = download_with_part(tmp_path, False, BODY)
+    assert [l.split("\t")[0] for l in lines] == [url]
+    assert requests == ["bytes=%d-" % len(BODY), None]
+    with open(target_file, 'rb') as f:
+        assert f.read() == BODY
+    assert not os.path.exists(target_file + web.PART_SUFFIX)
+    assert not os.path.exists(str(tmp_path / "failed.txt"))
+
+def test_unexpected_range_starts_over(tmp_path):
+    (url, target_file, lines, requests) = download_with_part(tmp_path, True, BODY[:100])
+    assert [l.split("\t")[0] for l in lines] == [url]
+    assert requests == ["bytes=100-", None]
+    with open(target_file, 'rb') as f:
+        assert f.read() == BODY
+    assert not os.path.exists(str(tmp_path / "failed.txt"))
+
+def test_partial_part_file_resumes(tmp_path):
+    (url, target_file, lines, requests) = download_with_part(tmp_path, False, BODY[:100])
+    assert requests == ["bytes=100-"]
+    with open(target_file, 'rb') as f:
+        assert f.read() == BODY
+
+@pytest.mark.parametrize("status_code", [206, 416])
+def test_classify_unexpected_range(status_code):
+    assert web.classify(status_code) == web.Outcome.TRANSIENT
+
+def test_local_error_does_not_stop_other_downloads(tmp_path):
+    (server, requests) = serve(False)
+    try:
+        url = "http://127.0.0.1:%d/a" % server.server_address[1]
+        lines = list(web.download(logging.getLogger(__name__), "test", 0, [url, "unsupported://127.0.0.1/b"], str(tmp_path / "state.txt"), str(tmp_path)))
+    finally:
+        server.shutdown()
+    assert [l.split("\t")[0] for l in lines] == [url]
+    # a local error is neither retried nor recorded in the ledger
+    assert not os.path.exists(str(tmp_path / "failed.txt"))
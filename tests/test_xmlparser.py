@@ -0,0 +1,153 @@
+# edl : common library for the energy-dashboard tool-chain
+# Copyright (C) 2019  Todd Greenwood-Geer (Enviro Software Solutions, LLC)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from edl.resources import xmlparser
+import io
+import json
+import logging
+import os
+import pytest
+import zipfile as zf
+
+def test_parse_parallel_yields_files_as_they_complete(tmp_path, stream):
+    options = (logging.getLogger(__name__), "test", str(tmp_path), str(tmp_path), False, None, xmlparser.OUTPUT_FORMAT, "off", xmlparser.KEY_MODE)
+    files = stream(["missing_%d.xml" % i for i in range(3)])
+    for result in xmlparser._parse_parallel(options, files, 4):
+        files.result(result)
+    assert sorted([f for (f, error, tb) in files.results]) == files.items
+
+DOCUMENT = "\r\n".join([
+    '<?xml version="1.0" encoding="UTF-8"?>',
+    '<OASISReport xmlns="http://www.caiso.com/soa/OASISReport_v1.xsd">',
+    '<MessageHeader><TimeDate>2019-09-07T14:50:16-00:00</TimeDate><Source>OASIS</Source></MessageHeader>',
+    '<MessagePayload><RTO><name>CAISO</name>',
+    '<DISCLAIMER_ITEM><DISCLAIMER>Subject to change – see caiso.com</DISCLAIMER></DISCLAIMER_ITEM>',
+    '<REPORT_ITEM><REPORT_HEADER><SYSTEM>OASIS</SYSTEM><REPORT>AS_MILEAGE_CALC</REPORT></REPORT_HEADER>',
+    '<REPORT_DATA><DATA_ITEM>RMD_AVG_MIL</DATA_ITEM><OPR_DATE>2019-09-05</OPR_DATE><INTERVAL_NUM>1</INTERVAL_NUM><VALUE>1.5</VALUE></REPORT_DATA>',
+    '<REPORT_DATA><DATA_ITEM>RMD_AVG_MIL</DATA_ITEM><OPR_DATE>2019-09-05</OPR_DATE><INTERVAL_NUM>2</INTERVAL_NUM><VALUE>2.5</VALUE></REPORT_DATA>',
+    '</REPORT_ITEM></RTO></MessagePayload></OASISReport>',
+    ]).encode('utf-8')
+
+def read_output(output_dir):
+    with open(os.path.join(output_dir, "report.rows")) as f:
+        return f.read()
+
+@pytest.mark.parametrize("streaming", [False, True])
+def test_hash_keys_do_not_depend_on_parse_from_zip(tmp_path, streaming):
+    logger = logging.getLogger(__name__)
+    (xml_dir, zip_dir) = (str(tmp_path / "xml"), str(tmp_path / "zip"))
+    (from_file, from_zip) = (str(tmp_path / "sql_file"), str(tmp_path / "sql_zip"))
+    for d in [xml_dir, zip_dir]:
+        os.makedirs(d)
+    with open(os.path.join(xml_dir, "report.xml"), 'wb') as f:
+        f.write(DOCUMENT)
+    with zf.ZipFile(os.path.join(zip_dir, "report.zip"), 'w') as z:
+        z.writestr("report.xml", DOCUMENT)
+    xmlparser.parse_file(logger, "test", "report.xml", xml_dir, from_file, streaming=streaming, key_mode="hash")
+    assert list(xmlparser.parse_zip(logger, "test", ["report.zip"], zip_dir, from_zip, streaming=streaming, key_mode="hash")) == ["report.xml"]
+    assert read_output(from_file) == read_output(from_zip)
+    assert '"id"' in read_output(from_file)
+
+def report(value="1.5", note=None, disclaimer=False):
+    """an OASIS document with one REPORT_DATA row"""
+    return "".join([
+        '<?xml version="1.0" encoding="UTF-8"?>',
+        '<OASISReport xmlns="http://www.caiso.com/soa/OASISReport_v1.xsd">',
+        '<MessagePayload><RTO><name>CAISO</name>',
+        '<DISCLAIMER_ITEM><DISCLAIMER>Subject to change</DISCLAIMER></DISCLAIMER_ITEM>' if disclaimer else '',
+        '<REPORT_ITEM><REPORT_HEADER><SYSTEM>OASIS</SYSTEM></REPORT_HEADER>',
+        '<REPORT_DATA><OPR_DATE>2019-09-05</OPR_DATE><VALUE>%s</VALUE>%s</REPORT_DATA>' % (value, '' if note is None else '<NOTE>%s</NOTE>' % note),
+        '</REPORT_ITEM></RTO></MessagePayload></OASISReport>',
+        ]).encode('utf-8')
+
+def transformer(document):
+    return xmlparser.XML2SQLTransormer(logging.getLogger(__name__), io.BytesIO(document), "hash").parse()
+
+def check(document, schema):
+    """run `check_row` on every row of document"""
+    xst = transformer(document).use_schema(schema)
+    xst.insertion(xst.row)
+
+def fits(document, schema):
+    try:
+        check(document, schema)
+        return True
+    except xmlparser.SchemaMismatch:
+        return False
+
+@pytest.mark.parametrize("first,second,reason", [
+    (report(), report(note="late"), "new column"),
+    (report(value="10"), report(value="1.5"), "wider type"),
+    (report(), report(disclaimer=True), "new table"),
+    ])
+def test_schema_cache_merges_schemas(tmp_path, first, second, reason):
+    cache = xmlparser.SchemaCache(str(tmp_path / "schema.json"))
+    cache.update(transformer(first).scan_all().schema())
+    with pytest.raises(xmlparser.SchemaMismatch, match=reason):
+        check(second, cache.schema)
+    cache.update(transformer(second).scan_all().schema())
+    assert fits(second, cache.schema)
+    # the first document only misses a column of the merged schema
+    assert fits(first, cache.schema) == (reason != "new column")
+    # and a document like the first does not undo the merge
+    cache.update(transformer(first).scan_all().schema())
+    assert fits(second, cache.schema)
+    assert xmlparser.SchemaCache(cache.schema_file).schema == cache.schema
+
+NESTED = "".join([
+    '<?xml version="1.0" encoding="UTF-8"?>',
+    '<OASISReport xmlns="http://www.caiso.com/soa/OASISReport_v1.xsd">',
+    '<MessageHeader><TimeDate>2019-09-07T14:50:16-00:00</TimeDate><Source>OASIS</Source></MessageHeader>',
+    '<MessagePayload><RTO><name>CAISO</name>',
+    ] + [
+    '<REPORT_ITEM><REPORT_HEADER><SYSTEM>OASIS</SYSTEM><REPORT>AS_MILEAGE_CALC</REPORT></REPORT_HEADER>%s</REPORT_ITEM>' % "".join([
+        '<REPORT_DATA><DATA_ITEM>RMD_AVG_MIL_%d</DATA_ITEM><OPR_DATE>2019-09-05</OPR_DATE><INTERVAL_NUM>%d</INTERVAL_NUM><VALUE>%s</VALUE></REPORT_DATA>' % (item, interval, value)
+        for (interval, value) in enumerate(["1", "2.5", "", "-3"], 1)])
+    for item in range(3)
+    ] + [
+    '</RTO></MessagePayload></OASISReport>',
+    ]).encode('utf-8')
+
+def ddl_and_rows(outfile):
+    """
+    Return (ddl, {table : sorted rows}) of a 'sql' or 'rows' file, rows are
+    compared as sets, since the streaming transformer emits a parent after
+    its children.
+    """
+    (ddl, rows) = ([], {})
+    with open(outfile) as f:
+        for line in [line.rstrip("\n") for line in f]:
+            if line.startswith("CREATE"):
+                ddl.append(line)
+            elif line.startswith("INSERT"):
+                rows.setdefault(line.split(" ")[4], []).append(line)
+            elif "ddl" in json.loads(line):
+                ddl.extend(json.loads(line)["ddl"])
+            else:
+                batch = json.loads(line)
+                rows.setdefault(batch["table"], []).extend([json.dumps(dict(zip(batch["columns"], row)), sort_keys=True) for row in batch["rows"]])
+    return (ddl, dict([(table, sorted(r)) for (table, r) in rows.items()]))
+
+@pytest.mark.parametrize("output_format", sorted(xmlparser.OUTPUT_FORMATS))
+def test_streaming_transform_matches_dom_transform(tmp_path, output_format):
+    outputs = []
+    for streaming in [False, True]:
+        output_dir = str(tmp_path / str(streaming))
+        outputs.append(ddl_and_rows(xmlparser.transform(logging.getLogger(__name__), io.BytesIO(NESTED), "nested.xml", output_dir, streaming, output_format=output_format, key_mode="hash")))
+    assert outputs[0] == outputs[1]
+    (ddl, rows) = outputs[0]
+    assert len(rows["report_data"]) == 12
+    assert len(set([row for r in rows.values() for row in r])) == sum([len(r) for r in rows.values()])
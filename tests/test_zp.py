@@ -0,0 +1,54 @@
+# edl : common library for the energy-dashboard tool-chain
+# Copyright (C) 2019  Todd Greenwood-Geer (Enviro Software Solutions, LLC)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from edl.resources import zp
+import os
+import zipfile as zf
+
+def write_zip(zip_dir, name, members):
+    with zf.ZipFile(os.path.join(zip_dir, name), 'w') as z:
+        for (member, content) in members.items():
+            z.writestr(member, content)
+    return name
+
+def index_lines(xml_dir, member):
+    with open(os.path.join(xml_dir, zp.INDEX_FILE)) as f:
+        return [line.split("\t")[0] for line in f if line.split("\t")[1] == member]
+
+def test_shared_member_is_extracted_once(tmp_path):
+    (zip_dir, xml_dir) = (str(tmp_path / "zip"), str(tmp_path / "xml"))
+    os.makedirs(zip_dir)
+    zips = [write_zip(zip_dir, "%d.zip" % i, {"shared.xml": "same", "own_%d.xml" % i: "own"}) for i in range(4)]
+    assert sorted(zp.unzip("test", zips, zip_dir, xml_dir, workers=4)) == zips
+    assert index_lines(xml_dir, "shared.xml") == ["0.zip"]
+    assert len(os.listdir(xml_dir)) == 6
+
+def test_changed_member_keeps_run_order(tmp_path):
+    (zip_dir, xml_dir) = (str(tmp_path / "zip"), str(tmp_path / "xml"))
+    os.makedirs(zip_dir)
+    zips = [write_zip(zip_dir, "%d.zip" % i, {"shared.xml": "version %d" % i}) for i in range(4)]
+    assert sorted(zp.unzip("test", zips, zip_dir, xml_dir, workers=4)) == zips
+    with open(os.path.join(xml_dir, "shared.xml")) as f:
+        assert f.read() == "version 3"
+    assert zp.read_index(os.path.join(xml_dir, zp.INDEX_FILE))["shared.xml"][0] == "3.zip"
+
+def test_unzip_yields_archives_as_they_complete(tmp_path, stream):
+    (zip_dir, xml_dir) = (str(tmp_path / "zip"), str(tmp_path / "xml"))
+    os.makedirs(zip_dir)
+    zips = stream([write_zip(zip_dir, "%d.zip" % i, {"%d.xml" % i: "report"}) for i in range(3)])
+    for result in zp.unzip("test", zips, zip_dir, xml_dir, workers=4):
+        zips.result(result)
+    assert sorted(zips.results) == zips.items